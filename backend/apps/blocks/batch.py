@@ -0,0 +1,176 @@
+"""
+Many changes to the blocks of one note, applied together.
+
+The note's block positions are read once and every new key is worked out in
+memory. Rows are then written with one statement per kind of change, and
+the new versions with a single bulk INSERT.
+"""
+import bisect
+from django.utils import timezone
+from rest_framework import serializers
+from apps.notes.changes import record_changes
+from apps.notes.revisions import bump
+from apps.search.backends import get_backend
+from .fractional import keys_between
+from .images import variant_fields
+from .models import Block, BlockVersion
+from .ordering import REBALANCE_KEY_LENGTH, schedule_rebalance
+from .serializers import validate_block_content
+from .versioning import prepare_versions
+
+
+class BatchRejected(Exception):
+    def __init__(self, message, index):
+        super().__init__(message)
+        self.index = index
+
+
+class _Order:
+    """The positions of a note's blocks, kept sorted while a batch applies."""
+    
+    def __init__(self, note_id):
+        rows = Block.objects.filter(note_id=note_id).values_list('pk', 'position')
+        self.positions = {str(pk): position for pk, position in rows}
+        self.keys = sorted(self.positions.values())
+    
+    def add(self, block_id, key):
+        self.positions[block_id] = key
+        bisect.insort(self.keys, key)
+    
+    def remove(self, block_id):
+        key = self.positions.pop(block_id)
+        del self.keys[bisect.bisect_left(self.keys, key)]
+    
+    def keys_for(self, count, after_id=None, before_id=None):
+        """`count` keys between two sibling blocks; at the end without either."""
+        low = high = None
+        if after_id:
+            low = self.positions.get(str(after_id))
+            if low is None:
+                raise KeyError(after_id)
+        if before_id:
+            high = self.positions.get(str(before_id))
+            if high is None:
+                raise KeyError(before_id)
+        
+        if after_id and not before_id:
+            index = bisect.bisect_right(self.keys, low)
+            high = self.keys[index] if index < len(self.keys) else None
+        elif before_id and not after_id:
+            index = bisect.bisect_left(self.keys, high)
+            low = self.keys[index - 1] if index > 0 else None
+        elif not after_id:
+            low = self.keys[-1] if self.keys else None
+        return keys_between(low or None, high or None, count)
+
+
+def _keys_for(order, index, count, op):
+    try:
+        return order.keys_for(count, op.get('after_id'), op.get('before_id'))
+    except KeyError:
+        raise BatchRejected("Sibling block not found in this note", index)
+    except ValueError:
+        raise BatchRejected("after_id must come before before_id", index)
+
+
+def apply_batch(note_id, operations, user):
+    """
+    Apply validated operations (see BlockBatchSerializer) in order. Must run
+    in a transaction; raises BatchRejected if any operation cannot apply.
+    
+    Returns (created, updated, deleted): new blocks in operation order,
+    other blocks that changed, and the ids of deleted blocks.
+    """
+    order = _Order(note_id)
+    targets = {op['id'] for op in operations if 'id' in op}
+    blocks = {
+        str(block.pk): block
+        for block in Block.objects.filter(note_id=note_id, pk__in=targets).select_for_update()
+    }
+    original = {block_id: block.content for block_id, block in blocks.items()}
+    now = timezone.now()
+    
+    created = []
+    updated = {}
+    deleted = set()
+    
+    index = 0
+    while index < len(operations):
+        op = operations[index]
+        
+        if op['op'] == 'create':
+            # Creates without a sibling follow the create before them, so a
+            # pasted run of blocks gets evenly spaced keys in one go
+            end = index + 1
+            while end < len(operations) and operations[end]['op'] == 'create' and not (
+                operations[end].get('after_id') or operations[end].get('before_id')
+            ):
+                end += 1
+            keys = _keys_for(order, index, end - index, op)
+            
+            for item, key in zip(operations[index:end], keys):
+                block = Block(
+                    note_id=note_id,
+                    block_type=item['block_type'],
+                    content={**item['content'], **variant_fields(item['block_type'], item['content'])},
+                    position=key,
+                    created_at=now,
+                    updated_at=now
+                )
+                order.add(str(block.pk), key)
+                created.append(block)
+            index = end
+            continue
+        
+        block_id = str(op['id'])
+        block = blocks.get(block_id)
+        if block is None or block_id in deleted:
+            raise BatchRejected("Block not found in this note", index)
+        
+        if op['op'] == 'delete':
+            deleted.add(block_id)
+            updated.pop(block_id, None)
+            order.remove(block_id)
+        elif op['op'] == 'move':
+            order.remove(block_id)
+            block.position = _keys_for(order, index, 1, op)[0]
+            order.add(block_id, block.position)
+            updated[block_id] = block
+        else:
+            block_type = op.get('block_type', block.block_type)
+            content = op.get('content', block.content)
+            try:
+                validate_block_content(block_type, content)
+            except serializers.ValidationError as error:
+                raise BatchRejected(error.detail[0], index)
+            block.block_type = block_type
+            block.content = {**content, **variant_fields(block_type, content)}
+            updated[block_id] = block
+        index += 1
+    
+    if deleted:
+        # Into the trash, as apps.notes.trash.trash_blocks() does
+        Block.objects.filter(pk__in=deleted).update(deleted_at=now)
+        get_backend().remove_blocks(deleted)
+    Block.objects.bulk_create(created)
+    for block in updated.values():
+        block.updated_at = now
+    Block.objects.bulk_update(list(updated.values()), ['block_type', 'content', 'position', 'updated_at'])
+    
+    versions = [(block.pk, block.content, None) for block in created] + [
+        (block.pk, block.content, original[block_id])
+        for block_id, block in updated.items()
+        if block.content != original[block_id]
+    ]
+    BlockVersion.objects.bulk_create(prepare_versions(versions, user))
+    
+    # None of the bulk writes send signals
+    bump([note_id], listing=bool(created or deleted))
+    record_changes(blocks=[(note_id, block_id) for block_id in [*(block.pk for block in created), *updated, *deleted]])
+    get_backend().index_blocks(created + [
+        block for block_id, block in updated.items() if block.content != original[block_id]
+    ])
+    if any(len(block.position) > REBALANCE_KEY_LENGTH for block in [*created, *updated.values()]):
+        schedule_rebalance(note_id)
+    
+    return created, list(updated.values()), deleted
@@ -0,0 +1,133 @@
+"""
+Structural deltas between two JSON values.
+
+A delta is a small JSON document that turns an old value into a new one:
+
+    {'=': value}                     replace the value outright
+    {'d': {key: delta}, 'x': [key]}  patch a dict: change/add keys, drop keys
+    {'l': {index: delta}, 'n': len} patch a list in place and resize it
+    {'t': [[start, end, text]]}      splice ranges of a string
+
+Dict and list patches recurse, so editing one table cell or a few characters
+of a long code block stores only that change.
+"""
+import hashlib
+import json
+from difflib import SequenceMatcher
+
+# Strings shorter than this are replaced outright; splicing is not worth it
+MIN_SPLICE_LENGTH = 64
+
+# Changed regions longer than this are stored as one splice instead of being
+# run through SequenceMatcher, which is quadratic in the worst case
+MAX_MATCH_LENGTH = 4000
+
+
+def canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def content_hash(value):
+    return hashlib.sha256(canonical_json(value).encode('utf-8')).hexdigest()
+
+
+def _text_ops(old, new):
+    # Most edits are local, so trim the common prefix and suffix first
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+    if len(old_middle) + len(new_middle) > MAX_MATCH_LENGTH:
+        return [[prefix, prefix + len(old_middle), new_middle]]
+    
+    matcher = SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+    return [
+        [prefix + i1, prefix + i2, new_middle[j1:j2]]
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != 'equal'
+    ]
+
+
+def diff(old, new):
+    """Return a delta turning `old` into `new`, or None if they are equal."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key, value in new.items():
+            if key not in old:
+                changes[key] = {'=': value}
+            else:
+                delta = diff(old[key], value)
+                if delta is not None:
+                    changes[key] = delta
+        removed = [key for key in old if key not in new]
+        if not changes and not removed:
+            return None
+        
+        delta = {}
+        if changes:
+            delta['d'] = changes
+        if removed:
+            delta['x'] = removed
+        return delta
+    
+    if isinstance(old, list) and isinstance(new, list):
+        changes = {}
+        for index, value in enumerate(new):
+            if index >= len(old):
+                changes[str(index)] = {'=': value}
+            else:
+                delta = diff(old[index], value)
+                if delta is not None:
+                    changes[str(index)] = delta
+        if not changes and len(old) == len(new):
+            return None
+        return {'l': changes, 'n': len(new)}
+    
+    # bool is an int subclass, so 1 == True; compare types as well
+    if old == new and type(old) is type(new):
+        return None
+    
+    if isinstance(old, str) and isinstance(new, str) and len(old) + len(new) >= MIN_SPLICE_LENGTH:
+        return {'t': _text_ops(old, new)}
+    
+    return {'=': new}
+
+
+def apply(old, delta):
+    """Apply a delta produced by diff() to `old` and return the new value."""
+    if delta is None:
+        return old
+    
+    if '=' in delta:
+        return delta['=']
+    
+    if 't' in delta:
+        pieces = []
+        cursor = 0
+        for start, end, text in delta['t']:
+            pieces.append(old[cursor:start])
+            pieces.append(text)
+            cursor = end
+        pieces.append(old[cursor:])
+        return ''.join(pieces)
+    
+    if 'l' in delta:
+        size = delta['n']
+        value = list(old[:size]) + [None] * max(size - len(old), 0)
+        for index, change in delta['l'].items():
+            index = int(index)
+            value[index] = apply(old[index] if index < len(old) else None, change)
+        return value
+    
+    value = dict(old)
+    for key, change in delta.get('d', {}).items():
+        value[key] = apply(old.get(key), change)
+    for key in delta.get('x', []):
+        value.pop(key, None)
+    return value
@@ -0,0 +1,112 @@
+"""
+Fractional order keys.
+
+A key is a string of base-36 digits read as the fraction 0.<digits>, so plain
+string comparison gives the block order and a new key can always be generated
+between any two existing ones without touching other rows. Keys never end in
+the lowest digit, which guarantees there is always room below a key.
+"""
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+
+# Appending steps by one unit at this many digits. A key that has no room
+# left at its width moves to twice the width, so repeated appends make
+# keys only logarithmically longer: 6 characters after about 23 thousand
+# appends to a rebalanced note, 12 after another 46 thousand, and so on.
+APPEND_WIDTH = 3
+
+
+def _midpoint(a, b):
+    # a < b, b is None for "no upper bound", a may be '' for "no lower bound"
+    if b is not None:
+        # Copy the shared prefix; missing digits of a count as zeros
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else BASE
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    
+    # The first digits are consecutive
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _to_int(key, width):
+    value = 0
+    for char in key.ljust(width, DIGITS[0]):
+        value = value * BASE + DIGITS.index(char)
+    return value
+
+
+def _to_digits(value, width):
+    chars = []
+    for _ in range(width):
+        value, remainder = divmod(value, BASE)
+        chars.append(DIGITS[remainder])
+    return ''.join(reversed(chars))
+
+
+def _increment(a):
+    # Widths are APPEND_WIDTH doubled, whatever trailing zeros were dropped
+    width = APPEND_WIDTH
+    while width < len(a):
+        width *= 2
+    while True:
+        value = _to_int(a, width) + 1
+        if value < BASE ** width:
+            return _to_digits(value, width).rstrip(DIGITS[0])
+        width *= 2
+
+
+def validate_key(key):
+    if not key or key[-1] == DIGITS[0] or any(char not in DIGITS for char in key):
+        raise ValueError(f"Invalid order key: {key!r}")
+
+
+def key_between(a=None, b=None):
+    """Return a key that sorts strictly between a and b (either may be None)."""
+    if a:
+        validate_key(a)
+    if b:
+        validate_key(b)
+    if a and b and a >= b:
+        raise ValueError(f"Order keys out of order: {a!r} >= {b!r}")
+    if a and not b:
+        return _increment(a)
+    return _midpoint(a or '', b or None)
+
+
+def keys_between(a, b, count):
+    """Return `count` ascending keys between a and b, splitting the gap evenly."""
+    if count <= 0:
+        return []
+    if count == 1:
+        return [key_between(a, b)]
+    
+    middle = count // 2
+    key = key_between(a, b)
+    return keys_between(a, key, middle) + [key] + keys_between(key, b, count - middle - 1)
+
+
+def evenly_spaced_keys(count):
+    """
+    Return `count` short, evenly spaced keys; used when rebalancing a note.
+    They fill the lower half of the key space and leave the upper half free
+    for appends, with at least one free slot between neighbours.
+    """
+    width = 1
+    while BASE ** width < 4 * (count + 1):
+        width += 1
+    
+    span = BASE ** width // 2
+    return [
+        _to_digits(span * (index + 1) // (count + 1), width).rstrip(DIGITS[0])
+        for index in range(count)
+    ]
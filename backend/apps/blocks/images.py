@@ -0,0 +1,200 @@
+"""
+Responsive variants of uploaded images, made in the background.
+
+Storing a new ImageAsset queues it on the image-variants channel. A worker
+(python manage.py runworker image-variants; run several for a pool) decodes
+the original once and writes a WebP copy at each configured width next to
+it, plus a tiny blurred WebP placeholder kept inline as a data URI. Image
+blocks showing the image then get `variants` and `placeholder` in their
+content, and collaborators on those notes are sent the updated blocks.
+
+Blocks that start showing the image later, or whose editing session saves
+content without them, get the same fields when they are written; see
+variant_fields().
+"""
+import base64
+import io
+import logging
+import os
+import re
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageFilter, ImageOps
+from apps.notes.changes import record_changes
+from apps.notes.outbox import announce
+from apps.notes.revisions import bump
+from .models import Block, ImageAsset
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'WIDTHS': [320, 640, 1280, 1920],
+    'QUALITY': 80,
+    'PLACEHOLDER_WIDTH': 16,
+}
+
+VARIANT_SETTINGS = {**DEFAULTS, **getattr(settings, 'IMAGE_VARIANTS', {})}
+
+VARIANTS_CHANNEL = 'image-variants'
+
+# Assets are stored as images/<sha256>.<extension>, possibly with a suffix
+# from the storage backend; see uploads.store_image()
+ASSET_URL = re.compile(r'/images/(?P<sha256>[0-9a-f]{64})[^/]*$')
+
+
+def schedule_variants(asset_id):
+    """Queue variant generation for an asset once the current transaction commits."""
+    def send():
+        try:
+            async_to_sync(get_channel_layer().send)(
+                VARIANTS_CHANNEL,
+                {'type': 'image.variants', 'asset_id': asset_id}
+            )
+        except Exception:
+            logger.exception("Could not queue variants for image %s", asset_id)
+    
+    transaction.on_commit(send)
+
+
+def _encode(image, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', **options)
+    return buffer.getvalue()
+
+
+def _resized(image, width):
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), resample=Image.LANCZOS)
+
+
+def generate_variants(asset):
+    """Write the asset's variants and placeholder and record them on it."""
+    base = os.path.splitext(asset.path)[0]
+    with default_storage.open(asset.path, 'rb') as original:
+        image = Image.open(original)
+        animated = getattr(image, 'n_frames', 1) > 1
+        if image.format == 'JPEG':
+            # Let the decoder scale down by up to 8x when even the largest
+            # variant is much smaller than the original
+            largest = max(VARIANT_SETTINGS['WIDTHS'])
+            image.draft('RGB', (largest, round(image.height * largest / image.width)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    
+    variants = []
+    if not animated:
+        # Never upscale: widths past the original collapse into one
+        for width in sorted({min(width, image.width) for width in VARIANT_SETTINGS['WIDTHS']}):
+            resized = _resized(image, width) if width < image.width else image
+            name = default_storage.save(
+                f'{base}-{width}w.webp',
+                ContentFile(_encode(resized, quality=VARIANT_SETTINGS['QUALITY'], method=4))
+            )
+            variants.append({'width': resized.width, 'height': resized.height, 'path': name})
+    
+    tiny = _resized(image, min(VARIANT_SETTINGS['PLACEHOLDER_WIDTH'], image.width))
+    tiny = tiny.filter(ImageFilter.GaussianBlur(1))
+    placeholder = 'data:image/webp;base64,' + base64.b64encode(_encode(tiny, quality=30)).decode()
+    
+    asset.width, asset.height = image.size
+    asset.variants = variants
+    asset.placeholder = placeholder
+    asset.processed_at = timezone.now()
+    asset.save(update_fields=['width', 'height', 'variants', 'placeholder', 'processed_at'])
+    return asset
+
+
+def image_content(asset, url):
+    """
+    Content fields describing the asset's variants, for an image block
+    whose `url` is the asset's original. Variants sit next to the original,
+    so their URLs are derived from it. Empty until the variants exist.
+    """
+    if asset.processed_at is None:
+        return {}
+    folder = url.rsplit('/', 1)[0]
+    return {
+        'variants': [
+            {
+                'width': variant['width'],
+                'height': variant['height'],
+                'url': f"{folder}/{os.path.basename(variant['path'])}"
+            }
+            for variant in asset.variants
+        ],
+        'placeholder': asset.placeholder,
+    }
+
+
+def variant_fields(block_type, content):
+    """
+    The fields image_content() would add to a block about to be saved with
+    `content`, or {} if it has them already or shows no processed asset.
+    Call it in the transaction that saves the block: the asset row is
+    locked, so the save either sees the variants or finishes before the
+    worker records them, and attach_variants() then finds the block.
+    """
+    if block_type != 'image' or not isinstance(content, dict) or content.get('placeholder'):
+        return {}
+    url = content.get('url')
+    match = ASSET_URL.search(url) if isinstance(url, str) else None
+    if match is None:
+        return {}
+    asset = ImageAsset.objects.select_for_update().filter(sha256=match['sha256']).first()
+    if asset is None or not url.endswith(f'/{asset.path}'):
+        return {}
+    return image_content(asset, url)
+
+
+def attach_variants(asset):
+    """
+    Add the asset's variants to every image block showing it and announce
+    the blocks to collaborators; returns them by note.
+    """
+    # serializers -> uploads -> images
+    from .serializers import BlockSerializer
+    
+    by_note = {}
+    with transaction.atomic():
+        # Locked, so an editing session's flush in progress is not overwritten
+        blocks = list(Block.objects.select_for_update().filter(
+            block_type='image', content__url__endswith=f'/{asset.path}'
+        ))
+        merge = {}
+        for block in blocks:
+            merge[block.pk] = image_content(asset, block.content['url'])
+            block.content = {**block.content, **merge[block.pk]}
+            by_note.setdefault(block.note_id, []).append(block)
+        
+        Block.objects.bulk_update(blocks, ['content'])
+        bump(by_note, listing=False)
+        record_changes(blocks=[(block.note_id, block.pk) for block in blocks])
+        for note_id, note_blocks in by_note.items():
+            # Sessions add the fields to what they hold, unsaved edits included
+            announce(
+                note_id, 'blocks_batch', 
+                merge={block.pk: merge[block.pk] for block in note_blocks}, 
+                created=[], updated=BlockSerializer(note_blocks, many=True).data, deleted=[]
+            )
+    return by_note
+
+
+def process_asset(asset_id):
+    """Worker entry point: generate variants, then update and announce the blocks."""
+    asset = ImageAsset.objects.filter(pk=asset_id).first()
+    if asset is None or asset.processed_at is not None:
+        return
+    
+    try:
+        generate_variants(asset)
+    except Exception:
+        # Blocks keep showing the original
+        logger.exception("Could not make variants of image %s", asset.path)
+        return
+    
+    attach_variants(asset)
@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from apps.blocks.uploads import UPLOAD_SETTINGS, clear_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked image uploads that were abandoned before completion'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=UPLOAD_SETTINGS['EXPIRY'], help='Seconds since the last chunk')
+    
+    def handle(self, *args, **options):
+        count = clear_stale_uploads(timezone.now() - timedelta(seconds=options['max_age']))
+        self.stdout.write(f'{count} stale uploads deleted')
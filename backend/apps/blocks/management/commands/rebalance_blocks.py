@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models.functions import Length
+from apps.blocks.models import Block
+from apps.blocks.ordering import REBALANCE_KEY_LENGTH, rebalance_note
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the order keys of notes whose keys have grown too long'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--note', help='Rebalance only this note')
+        parser.add_argument('--min-length', type=int, default=REBALANCE_KEY_LENGTH)
+    
+    def handle(self, *args, **options):
+        if options['note']:
+            note_ids = [options['note']]
+        else:
+            note_ids = Block.objects.values('note_id').annotate(
+                longest=Max(Length('position'))
+            ).filter(longest__gt=options['min_length']).values_list('note_id', flat=True)
+        
+        for note_id in note_ids:
+            moved = rebalance_note(note_id)
+            self.stdout.write(f'Note {note_id}: {moved} blocks rekeyed')
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0002_remove_block_blocks_bloc_note_id_d88fcf_idx_and_more'),
+        ('notes', '0004_backfill_note_access'),
+    ]
+    
+    operations = [
+        migrations.RemoveIndex(
+            model_name='block',
+            name='blocks_bloc_note_id_7332bb_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='block',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='position',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(fields=['note', 'position'], name='blocks_bloc_note_id_1a9278_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:24
+
+from itertools import groupby
+from django.db import migrations
+from apps.blocks.fractional import evenly_spaced_keys
+
+
+def backfill_positions(apps, schema_editor):
+    Block = apps.get_model('blocks', 'Block')
+    
+    blocks = Block.objects.order_by('note_id', 'order', 'created_at').only('id', 'note_id', 'order')
+    for note_id, note_blocks in groupby(blocks.iterator(chunk_size=2000), key=lambda block: block.note_id):
+        note_blocks = list(note_blocks)
+        for block, key in zip(note_blocks, evenly_spaced_keys(len(note_blocks))):
+            block.position = key
+        Block.objects.bulk_update(note_blocks, ['position'], batch_size=1000)
+
+
+def backfill_order(apps, schema_editor):
+    Block = apps.get_model('blocks', 'Block')
+    
+    blocks = Block.objects.order_by('note_id', 'position', 'created_at').only('id', 'note_id', 'position')
+    for note_id, note_blocks in groupby(blocks.iterator(chunk_size=2000), key=lambda block: block.note_id):
+        note_blocks = list(note_blocks)
+        for index, block in enumerate(note_blocks):
+            block.order = index
+        Block.objects.bulk_update(note_blocks, ['order'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0003_block_position'),
+    ]
+    
+    operations = [
+        migrations.RunPython(backfill_positions, backfill_order),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:24
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0004_backfill_block_position'),
+    ]
+    
+    operations = [
+        migrations.AlterModelOptions(
+            name='block',
+            options={'ordering': ['position', 'created_at']},
+        ),
+        migrations.RemoveField(
+            model_name='block',
+            name='order',
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0005_remove_block_order'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockversion',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='blockversion',
+            name='delta',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='blockversion',
+            name='kind',
+            field=models.CharField(choices=[('snapshot', 'Snapshot'), ('delta', 'Delta'), ('reference', 'Reference')], default='snapshot', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='blockversion',
+            name='reference',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='blocks.blockversion'),
+        ),
+        migrations.AlterField(
+            model_name='blockversion',
+            name='content',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='blockversion',
+            index=models.Index(fields=['block', 'content_hash'], name='blocks_bloc_block_i_93cda2_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:28
+
+from itertools import groupby
+from django.db import migrations
+from apps.blocks.deltas import apply, canonical_json, content_hash, diff
+
+KEYFRAME_INTERVAL = 20
+
+FIELDS = ['kind', 'content', 'delta', 'content_hash', 'reference']
+
+
+def _block_histories(BlockVersion):
+    rows = BlockVersion.objects.order_by('block_id', 'version_number').iterator(chunk_size=2000)
+    for block_id, versions in groupby(rows, key=lambda version: version.block_id):
+        yield list(versions)
+
+
+def compress_versions(apps, schema_editor):
+    BlockVersion = apps.get_model('blocks', 'BlockVersion')
+    
+    for versions in _block_histories(BlockVersion):
+        previous = None
+        stored = {}
+        for index, version in enumerate(versions):
+            content = version.content
+            digest = content_hash(content)
+            version.content_hash = digest
+            
+            if digest in stored:
+                version.kind = 'reference'
+                version.reference_id = stored[digest]
+                version.content = None
+            elif index % KEYFRAME_INTERVAL != 0:
+                delta = diff(previous, content)
+                if len(canonical_json(delta)) < len(canonical_json(content)):
+                    version.kind = 'delta'
+                    version.delta = delta
+                    version.content = None
+            
+            if version.kind != 'reference':
+                stored[digest] = version.id
+            previous = content
+        
+        BlockVersion.objects.bulk_update(versions, FIELDS, batch_size=500)
+
+
+def expand_versions(apps, schema_editor):
+    BlockVersion = apps.get_model('blocks', 'BlockVersion')
+    
+    for versions in _block_histories(BlockVersion):
+        contents = {}
+        content = None
+        for version in versions:
+            if version.kind == 'delta':
+                content = apply(content, version.delta)
+            elif version.kind == 'reference':
+                content = contents[version.reference_id]
+            else:
+                content = version.content
+            contents[version.id] = content
+            
+            version.kind = 'snapshot'
+            version.content = content
+            version.delta = None
+            version.reference_id = None
+        
+        BlockVersion.objects.bulk_update(versions, FIELDS, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0006_blockversion_deltas'),
+    ]
+    
+    operations = [
+        migrations.RunPython(compress_versions, expand_versions),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0008_image_uploads'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='imageasset',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='placeholder',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='variants',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
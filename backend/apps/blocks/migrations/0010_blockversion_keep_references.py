@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:52
+
+import apps.blocks.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0009_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blockversion',
+            name='reference',
+            field=models.ForeignKey(blank=True, null=True, on_delete=apps.blocks.models.keep_referencing_versions, related_name='+', to='blocks.blockversion'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blocks', '0010_blockversion_keep_references'),
+        ('notes', '0006_trash'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', False)), fields=['deleted_at'], name='blocks_trashed_idx'),
+        ),
+    ]
@@ -1,10 +1,18 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from apps.notes.models import Note
 
 
+class BlockManager(models.Manager):
+    def get_queryset(self):
+        # Blocks in the trash are left out everywhere; see apps.notes.trash
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Block(models.Model):
     BLOCK_TYPES = [
         ('text', 'Text'),
@@ -20,21 +28,46 @@ class Block(models.Model):
     note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='blocks')
     block_type = models.CharField(max_length=20, choices=BLOCK_TYPES, default='text')
     content = models.JSONField(default=dict)
-    order = models.PositiveIntegerField(default=0)
+    # Fractional order key, compared as a plain string; see ordering.py
+    position = models.CharField(max_length=255, blank=True, default='')
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
+    # Set while the block is in the trash
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = BlockManager()
+    # Includes blocks in the trash
+    all_objects = models.Manager()
     
     class Meta:
-        ordering = ['order', 'created_at']
+        ordering = ['position', 'created_at']
         indexes = [
-            models.Index(fields=['note', 'order']),
+            models.Index(fields=['note', 'position']),
             models.Index(fields=['block_type']),
+            models.Index(
+                fields=['deleted_at'], 
+                condition=models.Q(deleted_at__isnull=False), 
+                name='blocks_trashed_idx'
+            ),
         ]
-        unique_together = ['note', 'order']
     
     def __str__(self):
         return f"{self.block_type.title()} Block in {self.note.title}"
     
+    def save(self, *args, **kwargs):
+        if not self.position:
+            from .ordering import position_at_end
+            self.position = position_at_end(self.note_id)
+        
+        from .images import variant_fields
+        # post_save receivers log the change; they commit with the row
+        with transaction.atomic():
+            # Images that were processed before the block showed them
+            fields = variant_fields(self.block_type, self.content)
+            if fields:
+                self.content = {**self.content, **fields}
+            super().save(*args, **kwargs)
+    
     def get_content_preview(self, max_length=50):
         if self.block_type == 'text' and 'text' in self.content:
             text = self.content['text']
@@ -50,10 +83,56 @@ class Block(models.Model):
         return f"{self.block_type.title()} Block"
 
 
+def keep_referencing_versions(collector, field, sub_objs, using):
+    """
+    on_delete for BlockVersion.reference. Versions that point at a deleted
+    version are rewritten as snapshots of their content, unless their own
+    block is being deleted too; a duplicated note can share its source's
+    versions this way (see apps.notes.duplication).
+    """
+    from .versioning import reconstruct
+    
+    deleting = {block.pk for block in collector.data.get(Block, ())}
+    deleted = {version.pk for version in collector.data.get(BlockVersion, ())}
+    for version in sub_objs:
+        if version.block_id in deleting or version.pk in deleted:
+            continue
+        BlockVersion.objects.using(using).filter(pk=version.pk).update(
+            kind=BlockVersion.KIND_SNAPSHOT,
+            content=reconstruct(version),
+            reference=None
+        )
+
+
 class BlockVersion(models.Model):
+    """
+    One entry in a block's history. Only snapshots store the full content;
+    deltas store a diff against the previous version and references point at
+    an earlier version with identical content. Use apps.blocks.versioning to
+    read content back.
+    """
+    KIND_SNAPSHOT = 'snapshot'
+    KIND_DELTA = 'delta'
+    KIND_REFERENCE = 'reference'
+    KINDS = [
+        (KIND_SNAPSHOT, 'Snapshot'),
+        (KIND_DELTA, 'Delta'),
+        (KIND_REFERENCE, 'Reference'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     block = models.ForeignKey(Block, on_delete=models.CASCADE, related_name='versions')
-    content = models.JSONField()
+    kind = models.CharField(max_length=10, choices=KINDS, default=KIND_SNAPSHOT)
+    content = models.JSONField(null=True, blank=True)
+    delta = models.JSONField(null=True, blank=True)
+    reference = models.ForeignKey(
+        'self', 
+        on_delete=keep_referencing_versions, 
+        null=True, 
+        blank=True, 
+        related_name='+'
+    )
+    content_hash = models.CharField(max_length=64, blank=True, default='')
     created_at = models.DateTimeField(default=timezone.now)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='block_versions')
     version_number = models.PositiveIntegerField(default=1)
@@ -62,9 +141,71 @@ class BlockVersion(models.Model):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['block', '-created_at']),
+            models.Index(fields=['block', 'content_hash']),
             models.Index(fields=['created_by']),
         ]
         unique_together = ['block', 'version_number']
     
     def __str__(self):
         return f"Version {self.version_number} of {self.block}"
+
+
+
+class ImageAsset(models.Model):
+    """An uploaded image, stored once per distinct content under its SHA-256."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=50)
+    size = models.PositiveBigIntegerField()
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    # WebP copies at several widths, [{width, height, path}], and a tiny
+    # inline preview; filled in by the image-variants worker (images.py)
+    variants = models.JSONField(default=list, blank=True)
+    placeholder = models.TextField(blank=True, default='')
+    processed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return self.path
+
+
+class ImageUpload(models.Model):
+    """A chunked image upload in progress; see apps.blocks.uploads."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='image_uploads')
+    filename = models.CharField(max_length=255, blank=True, default='')
+    content_type = models.CharField(max_length=50)
+    size = models.PositiveBigIntegerField()
+    # Bytes received so far; the next chunk starts here
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at']),
+        ]
+    
+    def __str__(self):
+        return f"Upload of {self.filename or self.pk} ({self.offset}/{self.size})"
+
+
+@receiver(post_save, sender=Block)
+def bump_revision_on_save(sender, instance, created, **kwargs):
+    from apps.notes.changes import record_changes
+    from apps.notes.revisions import bump
+    # Lists show block counts, not content
+    bump([instance.note_id], listing=created)
+    record_changes(blocks=[(instance.note_id, instance.pk)])
+
+
+@receiver(post_delete, sender=Block)
+def bump_revision_on_delete(sender, instance, origin=None, **kwargs):
+    from apps.notes.changes import record_changes
+    from apps.notes.revisions import bump
+    if origin is not None and origin is not instance:
+        # Deleted along with its note, or in bulk by a caller that bumps once
+        return
+    bump([instance.note_id])
+    record_changes(blocks=[(instance.note_id, instance.pk)])
@@ -0,0 +1,234 @@
+"""
+Position helpers for blocks.
+
+Blocks are ordered by a fractional key (see fractional.py), so inserting,
+moving or duplicating a block writes only that block's row. Keys grow when
+one spot is split over and over; once a key passes REBALANCE_KEY_LENGTH the
+note is queued for a background rebalance that rewrites all keys short. A
+key that would pass MAX_KEY_LENGTH, half of what the column holds, is not
+used: the note is rebalanced right away and the key worked out again.
+Rebalancing announces blocks_rebalanced with the new keys, so clients
+(and the ?after= / ?before= cursors they hold) can switch to them.
+"""
+import bisect
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from apps.notes.changes import record_changes
+from apps.notes.outbox import announce
+from apps.notes.revisions import bump
+from .fractional import evenly_spaced_keys, key_between, keys_between
+from .models import Block
+
+logger = logging.getLogger(__name__)
+
+REBALANCE_KEY_LENGTH = getattr(settings, 'BLOCK_REBALANCE_KEY_LENGTH', 32)
+
+MAX_KEY_LENGTH = Block._meta.get_field('position').max_length // 2
+
+MAINTENANCE_CHANNEL = 'block-maintenance'
+
+
+def _note_blocks(note_id, exclude=None):
+    queryset = Block.objects.filter(note_id=note_id).order_by('position', 'created_at')
+    if exclude is not None:
+        queryset = queryset.exclude(pk=exclude)
+    return queryset
+
+
+def _new_key(note_id, before, after):
+    if before and before == after:
+        # Two blocks share a key (e.g. concurrent inserts); spread them out
+        # and let the caller look up the neighbours again
+        rebalance_note(note_id)
+        return None
+    
+    key = key_between(before, after)
+    if len(key) > MAX_KEY_LENGTH:
+        # Too close to the column's limit to wait for the worker
+        rebalance_note(note_id)
+        return None
+    if len(key) > REBALANCE_KEY_LENGTH:
+        schedule_rebalance(note_id)
+    return key
+
+
+def position_at_end(note_id):
+    for _ in range(2):
+        last = Block.objects.filter(note_id=note_id).order_by('-position').values_list('position', flat=True).first()
+        key = _new_key(note_id, last or None, None)
+        if key is not None:
+            return key
+    raise ValueError("Could not allocate a block position")
+
+
+def position_at_index(note_id, index, exclude=None):
+    """Key that places a block at `index` among the note's other blocks."""
+    positions = _note_blocks(note_id, exclude).values_list('position', flat=True)
+    # Anything past the last block means the end; keeps OFFSET in range
+    index = min(index, 2 ** 31 - 1)
+    
+    for _ in range(2):
+        if index <= 0:
+            before, after = None, positions.first()
+        else:
+            neighbours = list(positions[index - 1:index + 1])
+            if not neighbours:
+                return position_at_end(note_id)
+            before = neighbours[0]
+            after = neighbours[1] if len(neighbours) > 1 else None
+        
+        key = _new_key(note_id, before, after)
+        if key is not None:
+            return key
+    raise ValueError("Could not allocate a block position")
+
+
+def position_after(block):
+    """Key directly after `block`, before whatever currently follows it."""
+    for _ in range(2):
+        following = Block.objects.filter(
+            note_id=block.note_id,
+            position__gt=block.position
+        ).order_by('position').values_list('position', flat=True).first()
+        
+        key = _new_key(block.note_id, block.position, following)
+        if key is not None:
+            return key
+        block.refresh_from_db(fields=['position'])
+    raise ValueError("Could not allocate a block position")
+
+
+def position_between(note_id, after_id=None, before_id=None, exclude=None):
+    """Key between two sibling blocks given by id; either side may be omitted."""
+    if not after_id and not before_id:
+        return position_at_end(note_id)
+    
+    blocks = _note_blocks(note_id, exclude).values_list('position', flat=True)
+    for _ in range(2):
+        positions = dict(Block.objects.filter(
+            note_id=note_id,
+            pk__in=[pk for pk in (after_id, before_id) if pk]
+        ).values_list('pk', 'position'))
+        positions = {str(pk): position for pk, position in positions.items()}
+        
+        before = positions.get(str(after_id)) if after_id else None
+        after = positions.get(str(before_id)) if before_id else None
+        if after_id and before is None or before_id and after is None:
+            raise Block.DoesNotExist("Sibling block not found in this note")
+        
+        if not before_id:
+            after = blocks.filter(position__gt=before).first()
+        elif not after_id:
+            before = blocks.filter(position__lt=after).last()
+        
+        key = _new_key(note_id, before, after)
+        if key is not None:
+            return key
+    raise ValueError("Could not allocate a block position")
+
+
+def _longest_increasing(values):
+    """Indexes of one longest strictly increasing subsequence of `values`."""
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(values)
+    
+    for index, value in enumerate(values):
+        slot = bisect.bisect_left(tails, value)
+        if slot > 0:
+            previous[index] = tail_indexes[slot - 1]
+        if slot == len(tails):
+            tails.append(value)
+            tail_indexes.append(index)
+        else:
+            tails[slot] = value
+            tail_indexes[slot] = index
+    
+    result = []
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        result.append(index)
+        index = previous[index]
+    return set(result)
+
+
+def apply_order(note_id, block_ids):
+    """
+    Reorder blocks to match `block_ids` while rewriting as few keys as possible.
+    
+    Blocks whose keys already form the longest increasing run keep them; only
+    the others get new keys, written in a single bulk UPDATE. Returns the
+    number of blocks moved.
+    """
+    block_ids = list(dict.fromkeys(str(block_id) for block_id in block_ids))
+    current = {
+        str(pk): position
+        for pk, position in Block.objects.filter(
+            note_id=note_id, pk__in=block_ids
+        ).values_list('pk', 'position')
+    }
+    sequence = [block_id for block_id in block_ids if block_id in current]
+    keep = _longest_increasing([current[block_id] for block_id in sequence])
+    
+    moved = []
+    index = 0
+    while index < len(sequence):
+        if index in keep:
+            index += 1
+            continue
+        
+        # Collect the run of blocks that need keys between two kept blocks
+        start = index
+        while index < len(sequence) and index not in keep:
+            index += 1
+        before = current[sequence[start - 1]] if start > 0 else None
+        after = current[sequence[index]] if index < len(sequence) else None
+        
+        for block_id, key in zip(sequence[start:index], keys_between(before, after, index - start)):
+            moved.append(Block(pk=block_id, position=key))
+    
+    if moved:
+        Block.objects.bulk_update(moved, ['position'], batch_size=1000)
+        bump([note_id], listing=False)
+        record_changes(blocks=[(note_id, block.pk) for block in moved])
+        if max(len(block.position) for block in moved) > REBALANCE_KEY_LENGTH:
+            schedule_rebalance(note_id)
+    return len(moved)
+
+
+def rebalance_note(note_id):
+    """Rewrite every key of the note to short, evenly spaced values."""
+    with transaction.atomic():
+        blocks = list(_note_blocks(note_id).select_for_update().only('pk', 'position'))
+        changed = []
+        for block, key in zip(blocks, evenly_spaced_keys(len(blocks))):
+            if block.position != key:
+                block.position = key
+                changed.append(block)
+        Block.objects.bulk_update(changed, ['position'], batch_size=1000)
+        if changed:
+            bump([note_id], listing=False)
+            record_changes(blocks=[(note_id, block.pk) for block in changed])
+            announce(note_id, 'blocks_rebalanced', positions={str(block.pk): block.position for block in changed})
+    return len(changed)
+
+
+def schedule_rebalance(note_id):
+    """Queue a rebalance on the block-maintenance worker, at most once a minute."""
+    if not cache.add(f'block-rebalance:{note_id}', True, timeout=60):
+        return
+    
+    def send():
+        try:
+            async_to_sync(get_channel_layer().send)(
+                MAINTENANCE_CHANNEL,
+                {'type': 'rebalance.note', 'note_id': str(note_id)}
+            )
+        except Exception:
+            logger.exception("Could not queue rebalance for note %s", note_id)
+    
+    transaction.on_commit(send)
@@ -1,40 +1,139 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Block, BlockVersion
-from apps.notes.models import Note
+from django.db.models import Prefetch
+from .models import Block, BlockVersion, ImageUpload
+from apps.notes.access import has_access
+from apps.notes.sparse import SparseFieldsetMixin
+from .ordering import position_at_index
+from .uploads import CONTENT_TYPES, UPLOAD_SETTINGS
+from .versioning import materialize, reconstruct, record_version
+
+
+# Versions included by ?expand=versions
+RECENT_VERSIONS = 10
+
+# Operations accepted by one /api/blocks/batch/ request
+MAX_BATCH_OPERATIONS = getattr(settings, 'BLOCK_BATCH_MAX_OPERATIONS', 1000)
+
+
+def recent_versions_prefetch():
+    """The versions ?expand=versions shows, for all listed blocks in one query."""
+    return Prefetch(
+        'versions',
+        queryset=BlockVersion.objects.select_related('created_by').order_by('-version_number')[:RECENT_VERSIONS],
+        to_attr='recent_versions'
+    )
+
+
+def validate_block_content(block_type, value):
+    """Check that `value` has the fields a block of `block_type` needs."""
+    if block_type == 'text':
+        if not isinstance(value, dict) or 'text' not in value:
+            raise serializers.ValidationError("Text blocks must have 'text' field in content")
+    
+    elif block_type == 'heading':
+        if not isinstance(value, dict) or 'text' not in value:
+            raise serializers.ValidationError("Heading blocks must have 'text' field in content")
+        level = value.get('level', 1)
+        if not isinstance(level, int) or level < 1 or level > 6:
+            raise serializers.ValidationError("Heading level must be between 1 and 6")
+    
+    elif block_type == 'code':
+        if not isinstance(value, dict) or 'code' not in value:
+            raise serializers.ValidationError("Code blocks must have 'code' field in content")
+    
+    elif block_type == 'latex':
+        if not isinstance(value, dict) or 'formula' not in value:
+            raise serializers.ValidationError("LaTeX blocks must have 'formula' field in content")
+    
+    elif block_type == 'image':
+        if not isinstance(value, dict) or 'url' not in value:
+            raise serializers.ValidationError("Image blocks must have 'url' field in content")
+    
+    elif block_type == 'table':
+        if not isinstance(value, dict) or 'rows' not in value:
+            raise serializers.ValidationError("Table blocks must have 'rows' field in content")
+    
+    elif block_type == 'list':
+        if not isinstance(value, dict) or 'items' not in value:
+            raise serializers.ValidationError("List blocks must have 'items' field in content")
+    
+    return value
+
+
+class BlockVersionListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        versions = list(data.all() if hasattr(data, 'all') else data)
+        # Rebuild every listed version from one pass over the delta chain,
+        # unless a list of blocks already did so for all of them
+        contents = self.context.get('contents')
+        self.contents = contents if contents is not None else materialize(versions)
+        return super().to_representation(versions)
 
 
 class BlockVersionSerializer(serializers.ModelSerializer):
+    content = serializers.SerializerMethodField()
     created_by = serializers.StringRelatedField(read_only=True)
     
     class Meta:
         model = BlockVersion
+        list_serializer_class = BlockVersionListSerializer
         fields = ['id', 'content', 'created_at', 'created_by', 'version_number']
         read_only_fields = ['id', 'created_at', 'created_by', 'version_number']
+    
+    def get_content(self, obj):
+        contents = getattr(self.parent, 'contents', None)
+        if contents is not None and obj.id in contents:
+            return contents[obj.id]
+        return reconstruct(obj)
 
 
-class BlockSerializer(serializers.ModelSerializer):
-    versions = BlockVersionSerializer(many=True, read_only=True)
+class BlockRowsSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        blocks = list(data.all() if hasattr(data, 'all') else data)
+        # Versions prefetched for ?expand=versions are rebuilt for all the
+        # blocks at once
+        versions = [version for block in blocks for version in getattr(block, 'recent_versions', ())]
+        self.version_contents = materialize(versions) if versions else None
+        return super().to_representation(blocks)
+
+
+class BlockSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # Only with ?expand=versions; the full history is paginated at
+    # /api/blocks/{id}/versions/
+    versions = serializers.SerializerMethodField()
     content_preview = serializers.SerializerMethodField()
+    # Index hint: the block is placed at this index among its siblings
+    order = serializers.IntegerField(write_only=True, required=False, min_value=0)
     
     class Meta:
         model = Block
         fields = [
-            'id', 'note', 'block_type', 'content', 'order', 
+            'id', 'note', 'block_type', 'content', 'position', 'order',
             'created_at', 'updated_at', 'content_preview', 'versions'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'position', 'created_at', 'updated_at']
+        expandable_fields = ['versions']
+        list_serializer_class = BlockRowsSerializer
     
     def get_content_preview(self, obj):
         return obj.get_content_preview()
     
+    def get_versions(self, obj):
+        # Prefetched by BlockViewSet (recent_versions_prefetch()) for lists
+        recent = getattr(obj, 'recent_versions', None)
+        if recent is None:
+            recent = BlockVersion.objects.filter(block=obj).select_related('created_by').order_by('-version_number')[:RECENT_VERSIONS]
+        contents = getattr(self.parent, 'version_contents', None)
+        return BlockVersionSerializer(recent, many=True, context={'contents': contents}).data
+    
     def validate_note(self, value):
         request = self.context.get('request')
         if not request:
             raise serializers.ValidationError("Request context is required")
         
-        user = request.user
-        if value.owner != user and not value.collaborators.filter(id=user.id).exists():
+        if not has_access(request.user, value.pk):
             raise serializers.ValidationError("You don't have permission to modify this note")
         
         return value
@@ -46,49 +145,17 @@ class BlockSerializer(serializers.ModelSerializer):
         else:
             block_type = self.initial_data.get('block_type', 'text')
         
-        if block_type == 'text':
-            if not isinstance(value, dict) or 'text' not in value:
-                raise serializers.ValidationError("Text blocks must have 'text' field in content")
-        
-        elif block_type == 'heading':
-            if not isinstance(value, dict) or 'text' not in value:
-                raise serializers.ValidationError("Heading blocks must have 'text' field in content")
-            level = value.get('level', 1)
-            if not isinstance(level, int) or level < 1 or level > 6:
-                raise serializers.ValidationError("Heading level must be between 1 and 6")
-        
-        elif block_type == 'code':
-            if not isinstance(value, dict) or 'code' not in value:
-                raise serializers.ValidationError("Code blocks must have 'code' field in content")
-        
-        elif block_type == 'latex':
-            if not isinstance(value, dict) or 'formula' not in value:
-                raise serializers.ValidationError("LaTeX blocks must have 'formula' field in content")
-        
-        elif block_type == 'image':
-            if not isinstance(value, dict) or 'url' not in value:
-                raise serializers.ValidationError("Image blocks must have 'url' field in content")
-        
-        elif block_type == 'table':
-            if not isinstance(value, dict) or 'rows' not in value:
-                raise serializers.ValidationError("Table blocks must have 'rows' field in content")
-        
-        elif block_type == 'list':
-            if not isinstance(value, dict) or 'items' not in value:
-                raise serializers.ValidationError("List blocks must have 'items' field in content")
-        
-        return value
+        return validate_block_content(block_type, value)
     
     def create(self, validated_data):
+        index = validated_data.pop('order', None)
+        if index is not None:
+            validated_data['position'] = position_at_index(validated_data['note'].pk, index)
+        
         block = super().create(validated_data)
         
         # Create initial version
-        BlockVersion.objects.create(
-            block=block,
-            content=block.content,
-            created_by=self.context['request'].user,
-            version_number=1
-        )
+        record_version(block, block.content, self.context['request'].user)
         
         return block
     
@@ -96,20 +163,16 @@ class BlockSerializer(serializers.ModelSerializer):
         # Store old content for version history
         old_content = instance.content
         
+        index = validated_data.pop('order', None)
+        if index is not None:
+            validated_data['position'] = position_at_index(instance.note_id, index, exclude=instance.pk)
+        
         # Update the block
         block = super().update(instance, validated_data)
         
         # Create new version if content changed
         if old_content != block.content:
-            latest_version = BlockVersion.objects.filter(block=block).order_by('-version_number').first()
-            next_version = (latest_version.version_number + 1) if latest_version else 1
-            
-            BlockVersion.objects.create(
-                block=block,
-                content=block.content,
-                created_by=self.context['request'].user,
-                version_number=next_version
-            )
+            record_version(block, block.content, self.context['request'].user, previous_content=old_content)
         
         return block
 
@@ -119,7 +182,7 @@ class BlockListSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Block
-        fields = ['id', 'block_type', 'content_preview', 'order', 'updated_at']
+        fields = ['id', 'block_type', 'content_preview', 'position', 'updated_at']
     
     def get_content_preview(self, obj):
         return obj.get_content_preview()
@@ -138,12 +201,8 @@ class BlockReorderSerializer(serializers.Serializer):
         if not request or not note_id:
             raise serializers.ValidationError("Invalid context")
         
-        try:
-            note = Note.objects.get(id=note_id)
-            if note.owner != request.user and not note.collaborators.filter(id=request.user.id).exists():
-                raise serializers.ValidationError("You don't have permission to reorder blocks in this note")
-        except Note.DoesNotExist:
-            raise serializers.ValidationError("Note not found")
+        if not has_access(request.user, note_id):
+            raise serializers.ValidationError("You don't have permission to reorder blocks in this note")
         
         # Validate that all blocks exist and belong to the note
         existing_blocks = Block.objects.filter(
@@ -154,4 +213,57 @@ class BlockReorderSerializer(serializers.Serializer):
         if len(existing_blocks) != len(value):
             raise serializers.ValidationError("Some blocks don't exist or don't belong to this note")
         
-        return value
\ No newline at end of file
+        return value
+
+
+class BlockBatchOperationSerializer(serializers.Serializer):
+    OPERATIONS = ['create', 'update', 'delete', 'move']
+    
+    op = serializers.ChoiceField(choices=OPERATIONS)
+    id = serializers.UUIDField(required=False)
+    block_type = serializers.ChoiceField(choices=Block.BLOCK_TYPES, required=False)
+    content = serializers.JSONField(required=False)
+    # Siblings to place a created or moved block between
+    after_id = serializers.UUIDField(required=False, allow_null=True)
+    before_id = serializers.UUIDField(required=False, allow_null=True)
+    
+    def validate(self, attrs):
+        if attrs['op'] == 'create':
+            if 'id' in attrs:
+                raise serializers.ValidationError("Created blocks are given their id by the server")
+            if 'content' not in attrs:
+                raise serializers.ValidationError("content is required")
+            attrs.setdefault('block_type', 'text')
+            validate_block_content(attrs['block_type'], attrs['content'])
+        elif 'id' not in attrs:
+            raise serializers.ValidationError("id is required")
+        elif attrs['op'] == 'update' and 'content' not in attrs and 'block_type' not in attrs:
+            raise serializers.ValidationError("Nothing to update")
+        return attrs
+
+
+class BlockBatchSerializer(serializers.Serializer):
+    note_id = serializers.UUIDField()
+    operations = BlockBatchOperationSerializer(many=True, allow_empty=False, max_length=MAX_BATCH_OPERATIONS)
+
+
+class ImageUploadSerializer(serializers.ModelSerializer):
+    chunk_size = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = ImageUpload
+        fields = ['id', 'filename', 'content_type', 'size', 'offset', 'chunk_size', 'created_at']
+        read_only_fields = ['id', 'offset', 'created_at']
+    
+    def get_chunk_size(self, obj):
+        return UPLOAD_SETTINGS['CHUNK_SIZE']
+    
+    def validate_content_type(self, value):
+        if value not in CONTENT_TYPES:
+            raise serializers.ValidationError("Invalid file type. Only JPEG, PNG, GIF, and WebP images are allowed.")
+        return value
+    
+    def validate_size(self, value):
+        if not 0 < value <= UPLOAD_SETTINGS['MAX_SIZE']:
+            raise serializers.ValidationError(f"File too large. Maximum size is {UPLOAD_SETTINGS['MAX_SIZE'] // (1024 * 1024)}MB.")
+        return value
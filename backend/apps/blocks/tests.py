@@ -1,3 +1,514 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APITestCase
+from apps.notes.models import Change, Note, OutboxMessage
+from . import deltas, images, uploads, views
+from .fractional import evenly_spaced_keys, key_between, keys_between
+from .models import Block, BlockVersion, ImageAsset
+from .ordering import MAX_KEY_LENGTH, position_between, rebalance_note
+from .textops import INSERT, DELETE, apply_ops, transform
+from .versioning import KEYFRAME_INTERVAL, materialize, reconstruct, record_version
 
-# Create your tests here.
+
+class DeltaTests(SimpleTestCase):
+    def assertRoundTrip(self, old, new):
+        delta = deltas.diff(old, new)
+        self.assertEqual(deltas.apply(old, delta), new)
+        return delta
+    
+    def test_equal_values_need_no_delta(self):
+        self.assertIsNone(deltas.diff({'text': 'a', 'items': [1, 2]}, {'items': [1, 2], 'text': 'a'}))
+        self.assertIsNotNone(deltas.diff({'checked': 1}, {'checked': True}))
+    
+    def test_round_trips(self):
+        for old, new in [
+            ({'text': 'a'}, {'text': 'b', 'level': 2}),
+            ({'text': 'a', 'level': 2}, {'text': 'a'}),
+            ({'rows': [['a', 'b'], ['c']]}, {'rows': [['a', 'x'], ['c', 'd'], ['e']]}),
+            ({'rows': [['a'], ['b'], ['c']]}, {'rows': [['a']]}),
+            ({'value': [1, 2]}, {'value': 'now a string'}),
+            ({'checked': 1}, {'checked': True}),
+            ('', 'x' * 100),
+        ]:
+            with self.subTest(old=old, new=new):
+                self.assertRoundTrip(old, new)
+    
+    def test_long_text_is_spliced(self):
+        old = {'code': 'line\n' * 500}
+        new = {'code': old['code'][:1000] + 'changed' + old['code'][1003:]}
+        delta = self.assertRoundTrip(old, new)
+        self.assertIn('t', delta['d']['code'])
+        self.assertLess(len(deltas.canonical_json(delta)), 100)
+    
+    def test_random_text_edits(self):
+        rng = random.Random(5)
+        text = ''.join(rng.choice('abc \n') for _ in range(300))
+        for _ in range(200):
+            start = rng.randrange(len(text) + 1)
+            end = min(len(text), start + rng.randrange(20))
+            new = text[:start] + ''.join(rng.choice('abcd') for _ in range(rng.randrange(20))) + text[end:]
+            self.assertRoundTrip(text, new)
+            text = new
+
+
+class VersioningTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        note = Note.objects.create(owner=self.user)
+        self.block = Block.objects.create(note=note, block_type='code', content={'code': ''})
+    
+    def record(self, contents):
+        versions = []
+        for content in contents:
+            version = record_version(self.block, content, self.user)
+            if version is not None:
+                versions.append(version)
+        return versions
+    
+    def test_deltas_and_snapshots(self):
+        contents = [{'code': 'print(1)\n' * 20 + str(number)} for number in range(KEYFRAME_INTERVAL * 2 + 3)]
+        versions = self.record(contents)
+        
+        kinds = [version.kind for version in versions]
+        self.assertEqual(kinds[0], BlockVersion.KIND_SNAPSHOT)
+        self.assertEqual(kinds[KEYFRAME_INTERVAL], BlockVersion.KIND_SNAPSHOT)
+        self.assertEqual(kinds.count(BlockVersion.KIND_SNAPSHOT), 3)
+        self.assertIsNone(versions[1].content)
+        
+        for version, content in zip(versions, contents):
+            self.assertEqual(reconstruct(version), content)
+        stored = list(BlockVersion.objects.filter(block=self.block))
+        self.assertEqual(sorted(materialize(stored).values(), key=str), sorted(contents, key=str))
+    
+    def test_unchanged_content_is_not_stored(self):
+        self.assertEqual(len(self.record([{'code': 'a'}, {'code': 'a'}])), 1)
+    
+    def test_reverted_content_references_earlier_version(self):
+        contents = [{'code': 'a' * 80}, {'code': 'b' * 80}, {'code': 'c' * 80}, {'code': 'a' * 80}]
+        versions = self.record(contents)
+        
+        self.assertEqual(versions[-1].kind, BlockVersion.KIND_REFERENCE)
+        self.assertEqual(versions[-1].reference_id, versions[0].pk)
+        # Reverting to the reverted content refers past the reference
+        versions += self.record([{'code': 'b' * 80}, {'code': 'a' * 80}])
+        self.assertEqual(versions[-1].reference_id, versions[0].pk)
+        
+        materialized = materialize(versions)
+        for version, content in zip(versions, contents + [{'code': 'b' * 80}, {'code': 'a' * 80}]):
+            self.assertEqual(reconstruct(version), content)
+            self.assertEqual(materialized[version.pk], content)
+
+
+class TextOpsTests(SimpleTestCase):
+    def random_ops(self, rng, text):
+        ops = []
+        for _ in range(rng.randrange(1, 4)):
+            if text and rng.random() < 0.5:
+                at = rng.randrange(len(text))
+                op = (DELETE, at, rng.randrange(1, len(text) - at + 1))
+            else:
+                op = (INSERT, rng.randrange(len(text) + 1), rng.choice(['x', 'yy', 'zzz']))
+            ops.append(op)
+            text = apply_ops(text, [op])
+        return ops
+    
+    def assertConverges(self, text, ops, against):
+        ops_after, against_after = transform(ops, against)
+        self.assertEqual(
+            apply_ops(apply_ops(text, against), ops_after),
+            apply_ops(apply_ops(text, ops), against_after)
+        )
+    
+    def test_concurrent_inserts_at_one_position(self):
+        ops, against = transform([(INSERT, 2, 'b')], [(INSERT, 2, 'a')])
+        # The side applied first wins the tie
+        self.assertEqual(apply_ops(apply_ops('xxxx', [(INSERT, 2, 'a')]), ops), 'xxabxx')
+        self.assertEqual(apply_ops(apply_ops('xxxx', [(INSERT, 2, 'b')]), against), 'xxabxx')
+    
+    def test_insert_inside_concurrent_delete_survives(self):
+        text = 'abcdefgh'
+        ops, against = transform([(DELETE, 2, 4)], [(INSERT, 4, 'XY')])
+        self.assertEqual(apply_ops(apply_ops(text, [(INSERT, 4, 'XY')]), ops), 'abXYgh')
+        self.assertConverges(text, [(DELETE, 2, 4)], [(INSERT, 4, 'XY')])
+    
+    def test_overlapping_deletes(self):
+        self.assertConverges('abcdefgh', [(DELETE, 1, 4)], [(DELETE, 3, 4)])
+        self.assertConverges('abcdefgh', [(DELETE, 2, 2)], [(DELETE, 0, 8)])
+    
+    def test_random_operations_converge(self):
+        rng = random.Random(7)
+        for _ in range(2000):
+            text = ''.join(rng.choice('abcdef') for _ in range(rng.randrange(12)))
+            ops, against = self.random_ops(rng, text), self.random_ops(rng, text)
+            with self.subTest(text=text, ops=ops, against=against):
+                self.assertConverges(text, ops, against)
+
+
+class KeyBetweenTests(SimpleTestCase):
+    def test_between(self):
+        rng = random.Random(3)
+        keys = evenly_spaced_keys(50)
+        for _ in range(1000):
+            index = rng.randrange(len(keys) + 1)
+            low = keys[index - 1] if index else None
+            high = keys[index] if index < len(keys) else None
+            key = key_between(low, high)
+            self.assertTrue((low is None or low < key) and (high is None or key < high))
+            keys.insert(index, key)
+        self.assertEqual(keys, sorted(keys))
+    
+    def test_rejects_keys_out_of_order(self):
+        with self.assertRaises(ValueError):
+            key_between('b', 'a')
+        with self.assertRaises(ValueError):
+            key_between('a0')
+    
+    def test_keys_between_split_the_gap(self):
+        keys = keys_between('a', 'b', 100)
+        self.assertEqual(len(set(keys)), 100)
+        self.assertEqual(keys, sorted(keys))
+        self.assertTrue('a' < keys[0] and keys[-1] < 'b')
+        self.assertLessEqual(max(map(len, keys)), 4)
+    
+    def test_evenly_spaced_keys_are_short(self):
+        keys = evenly_spaced_keys(1000)
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertLessEqual(max(map(len, keys)), 3)
+    
+    def test_appends_grow_keys_slowly(self):
+        keys = [evenly_spaced_keys(10)[-1]]
+        for _ in range(50000):
+            keys.append(key_between(keys[-1]))
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertLessEqual(len(keys[-1]), 12)
+    
+    def test_inserts_at_one_place_grow_keys_linearly(self):
+        low, high = evenly_spaced_keys(2)
+        for _ in range(200):
+            high = key_between(low, high)
+        # About one character per five inserts, well inside MAX_KEY_LENGTH
+        self.assertLessEqual(len(high), 60)
+
+
+class RebalanceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.note = Note.objects.create(owner=self.user)
+        self.blocks = [
+            Block.objects.create(note=self.note, block_type='text', content={'text': str(index)}, position=position)
+            for index, position in enumerate(['h' * 40, 'h' * 40 + '1', 'i'])
+        ]
+    
+    def announced(self):
+        messages = [json.loads(message.body) for message in OutboxMessage.objects.filter(note_id=self.note.pk)]
+        return [message for message in messages if message['type'] == 'blocks_rebalanced']
+    
+    def test_rebalance_announces_new_keys(self):
+        rebalance_note(self.note.pk)
+        
+        positions = dict(Block.objects.filter(note=self.note).values_list('pk', 'position'))
+        [message] = self.announced()
+        self.assertEqual(message['positions'], {str(pk): position for pk, position in positions.items()})
+        self.assertEqual(
+            sorted(positions, key=positions.get), [block.pk for block in self.blocks]
+        )
+    
+    def test_key_past_the_limit_rebalances_at_once(self):
+        first, second, _ = self.blocks
+        Block.objects.filter(pk=second.pk).update(position='h' * MAX_KEY_LENGTH + '1')
+        Block.objects.filter(pk=first.pk).update(position='h' * MAX_KEY_LENGTH)
+        
+        key = position_between(self.note.pk, after_id=first.pk, before_id=second.pk)
+        
+        self.assertLessEqual(len(key), 4)
+        self.assertEqual(len(self.announced()), 1)
+
+
+class BatchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(owner=self.user)
+        self.block = Block.objects.create(note=self.note, block_type='text', content={'text': 'kept'})
+    
+    def batch(self, operations):
+        return self.client.post(
+            '/api/blocks/batch/', {'note_id': str(self.note.pk), 'operations': operations}, format='json'
+        )
+    
+    def test_rejected_batch_changes_nothing(self):
+        self.note.refresh_from_db()
+        revision = self.note.revision
+        changes = Change.objects.count()
+        versions = BlockVersion.objects.count()
+        
+        response = self.batch([
+            {'op': 'create', 'content': {'text': 'new'}},
+            {'op': 'update', 'id': str(self.block.pk), 'content': {'text': 'changed'}},
+            {'op': 'delete', 'id': str(self.block.pk)},
+            {'op': 'update', 'id': str(self.block.pk), 'content': {'text': 'after delete'}},
+        ])
+        
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['operation'], 3)
+        self.assertEqual(list(Block.objects.filter(note=self.note).values_list('content', flat=True)), [{'text': 'kept'}])
+        self.note.refresh_from_db()
+        self.assertEqual(self.note.revision, revision)
+        self.assertEqual(Change.objects.count(), changes)
+        self.assertEqual(BlockVersion.objects.count(), versions)
+        self.assertFalse(OutboxMessage.objects.exists())
+    
+    def test_invalid_content_is_rejected(self):
+        response = self.batch([
+            {'op': 'create', 'content': {'text': 'new'}},
+            {'op': 'update', 'id': str(self.block.pk), 'block_type': 'heading', 'content': {'text': 'x', 'level': 9}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['operation'], 1)
+        self.assertEqual(Block.objects.filter(note=self.note).count(), 1)
+    
+    def test_accepted_batch_applies_in_order(self):
+        response = self.batch([
+            {'op': 'create', 'content': {'text': 'one'}},
+            {'op': 'create', 'content': {'text': 'two'}},
+            {'op': 'create', 'content': {'text': 'zero'}, 'before_id': str(self.block.pk)},
+        ])
+        self.assertEqual(response.status_code, 200)
+        texts = [block.content['text'] for block in Block.objects.filter(note=self.note).order_by('position')]
+        self.assertEqual(texts, ['zero', 'kept', 'one', 'two'])
+
+
+class ExpandVersionsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(owner=self.user)
+    
+    def add_blocks(self, count):
+        for _ in range(count):
+            block = Block.objects.create(note=self.note, block_type='code', content={'code': ''})
+            for number in range(3):
+                record_version(block, {'code': 'x' * 80 + str(number)}, self.user)
+    
+    def list_blocks(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/blocks/', {'note_id': str(self.note.pk), 'expand': 'versions'})
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+    
+    def test_query_count_does_not_grow_with_blocks(self):
+        self.add_blocks(2)
+        # Access and revision lookups are cached after the first request
+        self.list_blocks()
+        _, few = self.list_blocks()
+        self.add_blocks(10)
+        data, many = self.list_blocks()
+        
+        self.assertEqual(few, many)
+        blocks = data['results'] if isinstance(data, dict) else data
+        self.assertEqual(len(blocks), 12)
+        for block in blocks:
+            self.assertEqual(
+                [version['content'] for version in block['versions']], 
+                [{'code': 'x' * 80 + str(number)} for number in (2, 1, 0)]
+            )
+
+
+class StreamTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(owner=self.user)
+        self.blocks = [
+            Block.objects.create(note=self.note, block_type='text', content={'text': str(index)}, position=position)
+            for index, position in enumerate(['a', 'a', 'b', 'c', 'd'])
+        ]
+    
+    def test_streams_every_block_in_order_by_chunks(self):
+        with mock.patch.object(views, 'STREAM_CHUNK_SIZE', 2):
+            response = self.client.get('/api/blocks/stream/', {'note_id': str(self.note.pk)})
+            # Under WSGI a plain generator, read one chunk at a time
+            chunks = list(response.streaming_content)
+        
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(chunks), 3)
+        rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        expected = sorted(self.blocks, key=lambda block: (block.position, block.created_at, block.pk))
+        self.assertEqual([row['id'] for row in rows], [str(block.pk) for block in expected])
+    
+    def test_unreadable_note(self):
+        self.client.force_authenticate(User.objects.create_user('bob'))
+        response = self.client.get('/api/blocks/stream/', {'note_id': str(self.note.pk)})
+        self.assertEqual(response.status_code, 404)
+
+
+def png_bytes(width=40, height=30, color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class MediaTestCase(APITestCase):
+    """Stores files under a temporary MEDIA_ROOT."""
+    
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        patcher = mock.patch.dict(uploads.UPLOAD_SETTINGS, STAGING_DIR=os.path.join(media, 'uploads'), CHUNK_SIZE=64)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+    
+    def start(self, data):
+        response = self.client.post('/api/uploads/images/', {
+            'filename': 'red.png', 'content_type': 'image/png', 'size': len(data)
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+    
+    def send(self, upload_id, data, offset):
+        return self.client.patch(
+            f'/api/uploads/images/{upload_id}/', data, 
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+    
+    def upload(self, data):
+        upload_id = self.start(data)
+        for offset in range(0, len(data), 64):
+            self.assertEqual(self.send(upload_id, data[offset:offset + 64], offset).status_code, 200)
+        response = self.client.post(f'/api/uploads/images/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+
+class ChunkedUploadTests(MediaTestCase):
+    def test_resume_from_the_reported_offset(self):
+        data = png_bytes()
+        upload_id = self.start(data)
+        self.assertEqual(self.send(upload_id, data[:64], 0).data['offset'], 64)
+        
+        # A retried chunk is refused with the offset to resume from
+        response = self.send(upload_id, data[:64], 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 64)
+        self.assertEqual(self.client.get(f'/api/uploads/images/{upload_id}/').data['offset'], 64)
+        
+        # As if the next chunk went to another process
+        uploads._hashers.clear()
+        for offset in range(64, len(data), 64):
+            self.send(upload_id, data[offset:offset + 64], offset)
+        response = self.client.post(f'/api/uploads/images/{upload_id}/complete/')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['deduplicated'])
+        asset = ImageAsset.objects.get()
+        self.assertEqual(asset.sha256, hashlib.sha256(data).hexdigest())
+        with default_storage.open(asset.path) as stored:
+            self.assertEqual(stored.read(), data)
+    
+    def test_same_bytes_stored_once(self):
+        data = png_bytes()
+        first = self.upload(data)
+        second = self.upload(data)
+        self.assertTrue(second['deduplicated'])
+        self.assertEqual(second['url'], first['url'])
+        self.assertEqual(ImageAsset.objects.count(), 1)
+    
+    def test_rejected_chunks(self):
+        data = png_bytes()
+        upload_id = self.start(data)
+        self.assertEqual(self.send(upload_id, data[:65], 0).status_code, 409)
+        missing_offset = self.client.patch(
+            f'/api/uploads/images/{upload_id}/', data[:64], content_type='application/offset+octet-stream'
+        )
+        self.assertEqual(missing_offset.status_code, 400)
+        response = self.client.post(f'/api/uploads/images/{upload_id}/complete/')
+        self.assertEqual((response.status_code, response.data['offset']), (400, 0))
+    
+    def test_not_an_image(self):
+        data = b'not an image' * 4
+        upload_id = self.start(data)
+        self.send(upload_id, data, 0)
+        self.assertEqual(self.client.post(f'/api/uploads/images/{upload_id}/complete/').status_code, 400)
+    
+    def test_uploads_are_private(self):
+        upload_id = self.start(png_bytes())
+        self.client.force_authenticate(User.objects.create_user('bob'))
+        self.assertEqual(self.client.get(f'/api/uploads/images/{upload_id}/').status_code, 404)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ImageVariantTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(images.VARIANT_SETTINGS, WIDTHS=[320, 640, 1280])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.note = Note.objects.create(owner=self.user)
+    
+    def upload_asset(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            url = self.upload(png_bytes(800, 600))['url']
+        return ImageAsset.objects.get(), url
+    
+    def test_new_asset_queued_for_a_worker(self):
+        asset, _ = self.upload_asset()
+        message = async_to_sync(get_channel_layer().receive)(images.VARIANTS_CHANNEL)
+        self.assertEqual(message, {'type': 'image.variants', 'asset_id': asset.pk})
+    
+    def test_variants_attached_to_blocks(self):
+        asset, url = self.upload_asset()
+        block = Block.objects.create(note=self.note, block_type='image', content={'url': url})
+        
+        images.process_asset(asset.pk)
+        
+        asset.refresh_from_db()
+        # Never wider than the original
+        self.assertEqual([variant['width'] for variant in asset.variants], [320, 640, 800])
+        for variant in asset.variants:
+            self.assertTrue(default_storage.exists(variant['path']))
+        block.refresh_from_db()
+        self.assertEqual([variant['width'] for variant in block.content['variants']], [320, 640, 800])
+        self.assertTrue(block.content['placeholder'].startswith('data:image/webp;base64,'))
+        self.assertEqual(block.content['url'], url)
+        
+        message = OutboxMessage.objects.get(note_id=self.note.pk)
+        self.assertEqual(json.loads(message.body)['type'], 'blocks_batch')
+        self.assertEqual(list(message.merge), [str(block.pk)])
+    
+    def test_blocks_saved_later_get_the_variants(self):
+        asset, url = self.upload_asset()
+        images.process_asset(asset.pk)
+        
+        response = self.client.post('/api/blocks/', {
+            'note': str(self.note.pk), 'block_type': 'image', 'content': {'url': url}
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        block = Block.objects.get(pk=response.data['id'])
+        self.assertEqual(len(block.content['variants']), 3)
+        self.assertIn('placeholder', block.content)
+    
+    def test_complete_reports_known_variants(self):
+        asset, _ = self.upload_asset()
+        images.process_asset(asset.pk)
+        response = self.upload(png_bytes(800, 600))
+        self.assertTrue(response['deduplicated'])
+        self.assertEqual(len(response['variants']), 3)
@@ -0,0 +1,117 @@
+"""
+Positional edit operations on a block's text, with operational transform.
+
+On the wire an operation is {'insert': text, 'at': index} or
+{'delete': count, 'at': index}. The operations of one message apply in
+order, each to the result of the one before. Positions count Unicode code
+points.
+
+transform() rewrites a list of operations so that it applies after another
+list made concurrently against the same text; both sides end up with the
+same result.
+"""
+
+# Content field holding the editable text of each block type
+TEXT_FIELDS = {
+    'text': 'text',
+    'heading': 'text',
+    'code': 'code',
+    'latex': 'formula',
+}
+
+INSERT = 'insert'
+DELETE = 'delete'
+
+
+def parse_ops(raw):
+    """Validate wire operations and return them as (kind, at, value) tuples."""
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("ops must be a non-empty list")
+    
+    ops = []
+    for op in raw:
+        if not isinstance(op, dict) or not isinstance(op.get('at'), int) or op['at'] < 0:
+            raise ValueError(f"Invalid operation: {op!r}")
+        if isinstance(op.get(INSERT), str) and DELETE not in op:
+            if op[INSERT]:
+                ops.append((INSERT, op['at'], op[INSERT]))
+        elif isinstance(op.get(DELETE), int) and op[DELETE] >= 0 and INSERT not in op:
+            if op[DELETE]:
+                ops.append((DELETE, op['at'], op[DELETE]))
+        else:
+            raise ValueError(f"Invalid operation: {op!r}")
+    return ops
+
+
+def to_wire(ops):
+    return [{kind: value, 'at': at} for kind, at, value in ops]
+
+
+def apply_ops(text, ops):
+    for kind, at, value in ops:
+        if kind == INSERT:
+            if at > len(text):
+                raise ValueError(f"Insert at {at} is past the end of the text ({len(text)})")
+            text = text[:at] + value + text[at:]
+        else:
+            if at + value > len(text):
+                raise ValueError(f"Delete of {at}:{at + value} is past the end of the text ({len(text)})")
+            text = text[:at] + text[at + value:]
+    return text
+
+
+def _transform_op(op, other, wins):
+    """Transform one op over a concurrent one. On equal insert positions the
+    op goes first if `wins`. Returns a list of zero, one or two ops."""
+    kind, at, value = op
+    other_kind, other_at, other_value = other
+    
+    if kind == INSERT:
+        if other_kind == INSERT:
+            if other_at < at or other_at == at and not wins:
+                at += len(other_value)
+        elif at > other_at:
+            # Inside or after the other side's deletion
+            at = max(at - other_value, other_at)
+        return [(kind, at, value)]
+    
+    if other_kind == INSERT:
+        if other_at <= at:
+            return [(kind, at + len(other_value), value)]
+        if other_at >= at + value:
+            return [op]
+        # Text was inserted inside our deletion; keep it, delete around it
+        before = other_at - at
+        return [(kind, at, before), (kind, at + len(other_value), value - before)]
+    
+    # Both delete: drop what the other side already removed
+    other_end = other_at + other_value
+    removed_before = max(0, min(other_end, at) - other_at)
+    overlap = max(0, min(at + value, other_end) - max(at, other_at))
+    if value == overlap:
+        return []
+    return [(kind, at - removed_before, value - overlap)]
+
+
+def transform(ops, against):
+    """
+    Transform `ops` over `against`, both made on the same text, where
+    `against` has already been applied and wins ties. Returns
+    (ops', against') such that against + ops' and ops + against' give the
+    same text.
+    """
+    if not ops or not against:
+        return ops, against
+    
+    if len(ops) > 1:
+        first, against = transform(ops[:1], against)
+        rest, against = transform(ops[1:], against)
+        return first + rest, against
+    
+    if len(against) > 1:
+        ops, first = transform(ops, against[:1])
+        ops, rest = transform(ops, against[1:])
+        return ops, first + rest
+    
+    op, other = ops[0], against[0]
+    return _transform_op(op, other, wins=False), _transform_op(other, op, wins=True)
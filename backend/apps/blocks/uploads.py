@@ -0,0 +1,199 @@
+"""
+Chunked, resumable image uploads, stored by content hash.
+
+    POST  /api/uploads/images/                {filename, content_type, size}
+    PATCH /api/uploads/images/{id}/           raw bytes, Upload-Offset header
+    GET   /api/uploads/images/{id}/           offset to resume from
+    POST  /api/uploads/images/{id}/complete/  {url, deduplicated}
+
+Chunks are appended to a staging file on local disk and hashed as they
+arrive, so a request holds no more than one read buffer in memory. A
+finished image is stored once as images/<sha256>.<ext>; uploading the same
+bytes again resolves to the stored file instead of writing a copy.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from .images import schedule_variants
+from .models import ImageAsset, ImageUpload
+
+DEFAULTS = {
+    'MAX_SIZE': 10 * 1024 * 1024,
+    # Largest chunk accepted by one request
+    'CHUNK_SIZE': 1024 * 1024,
+    # Local directory for partial uploads, shared by the web processes
+    'STAGING_DIR': os.path.join(settings.MEDIA_ROOT, 'uploads'),
+    # Seconds an untouched upload is kept (see clear_stale_uploads)
+    'EXPIRY': 24 * 60 * 60,
+}
+
+UPLOAD_SETTINGS = {**DEFAULTS, **getattr(settings, 'IMAGE_UPLOADS', {})}
+
+CONTENT_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
+
+READ_SIZE = 64 * 1024
+
+# Hash state of uploads whose earlier chunks came through this process,
+# keyed by upload id, as (offset, hasher)
+_hashers = OrderedDict()
+MAX_HASHERS = 256
+
+
+class UploadError(Exception):
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+def sniff_extension(header):
+    """File extension for the image format in the first bytes, or None."""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def staging_path(upload):
+    return os.path.join(UPLOAD_SETTINGS['STAGING_DIR'], f'{upload.pk}.part')
+
+
+def _hasher(upload):
+    entry = _hashers.pop(str(upload.pk), None)
+    if entry is not None and entry[0] == upload.offset:
+        hasher = entry[1]
+    else:
+        # Earlier chunks went to another process; hash what is on disk
+        hasher = hashlib.sha256()
+        with open(staging_path(upload), 'rb') as staged:
+            remaining = upload.offset
+            while remaining:
+                data = staged.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def _remember(upload, hasher):
+    _hashers[str(upload.pk)] = (upload.offset, hasher)
+    while len(_hashers) > MAX_HASHERS:
+        _hashers.popitem(last=False)
+
+
+def start_upload(user, filename, content_type, size):
+    os.makedirs(UPLOAD_SETTINGS['STAGING_DIR'], exist_ok=True)
+    upload = ImageUpload.objects.create(user=user, filename=filename, content_type=content_type, size=size)
+    open(staging_path(upload), 'wb').close()
+    return upload
+
+
+def append_chunk(upload, offset, stream, length):
+    """
+    Append `length` bytes read from `stream` at `offset`, which must be the
+    upload's current offset. `upload` must be locked (select_for_update).
+    """
+    if offset != upload.offset:
+        raise UploadError("Chunk does not start at the upload's offset", upload.offset)
+    if length > UPLOAD_SETTINGS['CHUNK_SIZE']:
+        raise UploadError(f"Chunks are limited to {UPLOAD_SETTINGS['CHUNK_SIZE']} bytes", upload.offset)
+    if upload.offset + length > upload.size:
+        raise UploadError("Chunk goes past the declared size", upload.offset)
+    
+    hasher = _hasher(upload)
+    with open(staging_path(upload), 'r+b') as staged:
+        # Drop whatever an interrupted earlier attempt left past the offset
+        staged.seek(upload.offset)
+        staged.truncate()
+        remaining = length
+        while remaining and stream is not None:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            staged.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+    if remaining:
+        raise UploadError("Chunk ended early", upload.offset)
+    
+    upload.offset += length
+    upload.save(update_fields=['offset', 'updated_at'])
+    _remember(upload, hasher)
+    return upload
+
+
+def complete_upload(upload):
+    """
+    Store a fully received upload and delete it. `upload` must be locked.
+    Returns (asset, created) as store_image() does.
+    """
+    if upload.offset != upload.size:
+        raise UploadError("Upload is incomplete", upload.offset)
+    
+    path = staging_path(upload)
+    with open(path, 'rb') as staged:
+        extension = sniff_extension(staged.read(16))
+        if extension is None:
+            raise UploadError("Only JPEG, PNG, GIF, and WebP images are allowed.")
+        digest = _hasher(upload).hexdigest()
+        staged.seek(0)
+        result = store_image(staged, digest, extension, upload.content_type, upload.size)
+    
+    _hashers.pop(str(upload.pk), None)
+    upload.delete()
+    transaction.on_commit(lambda: os.remove(path))
+    return result
+
+
+def hash_file(file):
+    """SHA-256 of an uploaded file, read chunk by chunk; rewinds the file."""
+    hasher = hashlib.sha256()
+    for chunk in file.chunks(READ_SIZE):
+        hasher.update(chunk)
+    file.seek(0)
+    return hasher.hexdigest()
+
+
+def store_image(file, digest, extension, content_type, size):
+    """
+    Return (asset, created) for the image with hash `digest`, storing
+    `file` only if no image with that hash exists yet.
+    """
+    asset = ImageAsset.objects.filter(sha256=digest).first()
+    if asset is not None:
+        return asset, False
+    
+    # Storage backends copy from the file in chunks
+    name = default_storage.save(f'images/{digest}.{extension}', File(file))
+    try:
+        with transaction.atomic():
+            asset = ImageAsset.objects.create(sha256=digest, path=name, content_type=content_type, size=size)
+        schedule_variants(asset.pk)
+        return asset, True
+    except IntegrityError:
+        # The same image was stored concurrently
+        default_storage.delete(name)
+        return ImageAsset.objects.get(sha256=digest), False
+
+
+def clear_stale_uploads(older_than):
+    """Delete uploads untouched since `older_than` and their staged data."""
+    stale = ImageUpload.objects.filter(updated_at__lt=older_than)
+    count = 0
+    for upload in stale.iterator():
+        path = staging_path(upload)
+        if os.path.exists(path):
+            os.remove(path)
+        _hashers.pop(str(upload.pk), None)
+        count += 1
+    stale.delete()
+    return count
@@ -1,9 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import BlockViewSet, upload_image
+from .views import BlockViewSet, ImageUploadViewSet, upload_image
 
 router = DefaultRouter()
 router.register(r'blocks', BlockViewSet, basename='blocks')
+router.register(r'uploads/images', ImageUploadViewSet, basename='image-uploads')
 
 urlpatterns = [
     path('api/', include(router.urls)),
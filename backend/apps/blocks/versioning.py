@@ -0,0 +1,179 @@
+"""
+Block version history stored as deltas.
+
+Every KEYFRAME_INTERVAL-th version is a full snapshot; the versions between
+store a delta against their predecessor. A version whose content hash
+matches the latest version is not stored at all. One that matches an older
+version is stored as a reference to it, with no payload.
+"""
+import copy
+from functools import reduce
+from operator import or_
+from django.conf import settings
+from django.db.models import Max, OuterRef, Q, Subquery
+from . import deltas
+from .models import BlockVersion
+
+KEYFRAME_INTERVAL = getattr(settings, 'BLOCK_VERSION_KEYFRAME_INTERVAL', 20)
+
+
+# prepare_version() looks up the identical version itself unless given one
+_LOOKUP = object()
+
+
+def latest_version(block_id):
+    return BlockVersion.objects.filter(block_id=block_id).order_by('-version_number').first()
+
+
+def latest_versions(block_ids):
+    """{block id: latest version} for many blocks, in one query."""
+    newest = BlockVersion.objects.filter(
+        block_id=OuterRef('block_id')
+    ).order_by('-version_number').values('version_number')[:1]
+    return {
+        version.block_id: version
+        for version in BlockVersion.objects.filter(block_id__in=block_ids, version_number=Subquery(newest))
+    }
+
+
+def prepare_version(block_id, content, created_by, latest=None, previous_content=None, identical=_LOOKUP):
+    """
+    Build (but do not save) the next BlockVersion for `content`, or return
+    None if it is identical to `latest`. `previous_content`, when it matches
+    the latest version, saves reconstructing that version to diff against.
+    """
+    digest = deltas.content_hash(content)
+    fields = {
+        'block_id': block_id,
+        'content_hash': digest,
+        'created_by': created_by,
+    }
+    
+    if latest is None:
+        return BlockVersion(kind=BlockVersion.KIND_SNAPSHOT, content=content, version_number=1, **fields)
+    if latest.content_hash == digest:
+        return None
+    
+    fields['version_number'] = latest.version_number + 1
+    
+    if identical is _LOOKUP:
+        identical = BlockVersion.objects.filter(
+            block_id=block_id, content_hash=digest
+        ).exclude(kind=BlockVersion.KIND_REFERENCE).order_by('-version_number').first()
+    if identical is not None:
+        return BlockVersion(kind=BlockVersion.KIND_REFERENCE, reference=identical, **fields)
+    
+    if (fields['version_number'] - 1) % KEYFRAME_INTERVAL == 0:
+        return BlockVersion(kind=BlockVersion.KIND_SNAPSHOT, content=content, **fields)
+    
+    if previous_content is None or deltas.content_hash(previous_content) != latest.content_hash:
+        previous_content = reconstruct(latest)
+    delta = deltas.diff(previous_content, content)
+    
+    if len(deltas.canonical_json(delta)) >= len(deltas.canonical_json(content)):
+        # The change rewrote most of the block; a snapshot is smaller
+        return BlockVersion(kind=BlockVersion.KIND_SNAPSHOT, content=content, **fields)
+    return BlockVersion(kind=BlockVersion.KIND_DELTA, delta=delta, **fields)
+
+
+def record_version(block, content, created_by, previous_content=None):
+    """Store the next version of `block`; returns None when nothing changed."""
+    version = prepare_version(
+        block.pk,
+        content,
+        created_by,
+        latest=latest_version(block.pk),
+        previous_content=previous_content
+    )
+    if version is not None:
+        version.save()
+    return version
+
+
+def prepare_versions(items, created_by):
+    """
+    prepare_version() for many (block id, content, previous content) items,
+    with the lookups it needs done in two queries for all of them. Returns
+    the versions to save.
+    """
+    items = list(items)
+    latest = latest_versions([block_id for block_id, _, _ in items])
+    digests = {block_id: deltas.content_hash(content) for block_id, content, _ in items}
+    
+    identical = {}
+    candidates = BlockVersion.objects.filter(
+        block_id__in=list(latest),
+        content_hash__in=set(digests.values())
+    ).exclude(kind=BlockVersion.KIND_REFERENCE).order_by('version_number')
+    for version in candidates:
+        if digests[version.block_id] == version.content_hash:
+            identical[version.block_id] = version
+    
+    versions = []
+    for block_id, content, previous_content in items:
+        version = prepare_version(
+            block_id,
+            content,
+            created_by,
+            latest=latest.get(block_id),
+            previous_content=previous_content,
+            identical=identical.get(block_id)
+        )
+        if version is not None:
+            versions.append(version)
+    return versions
+
+
+def _walk(ranges):
+    """
+    Content of every version in {block id: (low, high)}, keyed by id. Two
+    queries however many blocks: the nearest snapshots, then the chains.
+    """
+    starts = dict(BlockVersion.objects.filter(
+        reduce(or_, (Q(block_id=block_id, version_number__lte=low) for block_id, (low, _) in ranges.items())),
+        kind=BlockVersion.KIND_SNAPSHOT
+    ).order_by().values('block_id').annotate(start=Max('version_number')).values_list('block_id', 'start'))
+    
+    rows = BlockVersion.objects.filter(reduce(or_, (
+        Q(block_id=block_id, version_number__gte=starts.get(block_id, 1), version_number__lte=high)
+        for block_id, (_, high) in ranges.items()
+    ))).order_by('block_id', 'version_number')
+    
+    contents = {}
+    block_id = content = None
+    for row in rows:
+        if row.block_id != block_id:
+            block_id, content = row.block_id, None
+        if row.kind == BlockVersion.KIND_SNAPSHOT:
+            content = row.content
+        elif row.kind == BlockVersion.KIND_REFERENCE:
+            if row.reference_id in contents:
+                content = contents[row.reference_id]
+            else:
+                content = reconstruct(row.reference)
+        else:
+            content = deltas.apply(content, row.delta)
+        contents[row.id] = content
+    return contents
+
+
+def materialize(versions):
+    """
+    Return {version id: content} for any number of versions, reading each
+    block's chain once from the nearest snapshot. Values may share nested
+    objects with each other and must be treated as read-only.
+    """
+    ranges = {}
+    for version in versions:
+        low, high = ranges.get(version.block_id, (version.version_number, version.version_number))
+        ranges[version.block_id] = (min(low, version.version_number), max(high, version.version_number))
+    
+    contents = _walk(ranges) if ranges else {}
+    return {version.id: contents.get(version.id) for version in versions}
+
+
+def reconstruct(version):
+    """Return a private copy of the full content of one version."""
+    if version.kind == BlockVersion.KIND_SNAPSHOT:
+        return copy.deepcopy(version.content)
+    return copy.deepcopy(materialize([version])[version.id])
@@ -1,23 +1,57 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
-from django.db import transaction, models
+from asgiref.sync import sync_to_async
+from django.db import transaction
 from django.db.models import Q
+from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-import uuid
-import os
-from .models import Block, BlockVersion
-from apps.notes.models import Note
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+import json
+from .batch import BatchRejected, apply_batch
+from .models import Block, BlockVersion, ImageUpload
+from .fractional import validate_key
+from .images import image_content
+from .ordering import apply_order, position_after, position_at_index, position_between
+from .uploads import (
+    CONTENT_TYPES,
+    UPLOAD_SETTINGS,
+    UploadError,
+    append_chunk,
+    complete_upload,
+    hash_file,
+    sniff_extension,
+    start_upload,
+    store_image
+)
+from .versioning import reconstruct, record_version
+from apps.notes.access import has_access
+from apps.notes.outbox import announce, sent_seq
+from apps.notes.revisions import make_etag, not_modified, note_revision, set_etag
+from apps.notes.sparse import field_wanted
+from apps.notes.trash import restore_blocks, trash_blocks
 from .serializers import (
     BlockSerializer, 
     BlockListSerializer, 
     BlockReorderSerializer,
-    BlockVersionSerializer
+    BlockBatchSerializer,
+    BlockVersionSerializer,
+    ImageUploadSerializer,
+    recent_versions_prefetch
 )
 
 
+# Blocks per /api/blocks/window/ request
+WINDOW_SIZE = 100
+MAX_WINDOW_SIZE = 500
+
+# Blocks read per query by /api/blocks/stream/
+STREAM_CHUNK_SIZE = 500
+
+
 class BlockViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     
@@ -27,34 +61,70 @@ class BlockViewSet(viewsets.ModelViewSet):
         return BlockSerializer
     
     def get_queryset(self):
+        queryset = self._blocks()
+        if self.action in ('list', 'retrieve') and field_wanted(self.request, 'versions', expandable=True):
+            queryset = queryset.prefetch_related(recent_versions_prefetch())
+        return queryset
+    
+    def _blocks(self):
         user = self.request.user
         note_id = self.request.query_params.get('note_id')
         
         if note_id:
             # For list operations with note_id parameter
-            try:
-                note = Note.objects.get(id=note_id)
-                if note.owner == user or note.collaborators.filter(id=user.id).exists():
-                    return Block.objects.filter(
-                        note_id=note_id
-                    ).order_by('order', 'created_at')
-            except Note.DoesNotExist:
-                pass
+            if has_access(user, note_id):
+                return Block.objects.filter(
+                    note_id=note_id
+                ).order_by('position', 'created_at')
             return Block.objects.none()
         
         # For individual block operations (retrieve, update, delete)
         # Return all blocks that the user has permission to access
-        user_notes = Note.objects.filter(
-            Q(owner=user) | Q(collaborators=user)
-        ).values_list('id', flat=True)
-        
-        return Block.objects.filter(
-            note_id__in=user_notes
-        )
+        return Block.objects.filter(note__access__user=user, note__deleted_at__isnull=True)
+    
+    def list(self, request, *args, **kwargs):
+        note_id = request.query_params.get('note_id')
+        revision = note_revision(request.user, note_id) if note_id else None
+        if revision is None:
+            return super().list(request, *args, **kwargs)
+        etag = make_etag(request, revision)
+        return not_modified(request, etag) or set_etag(super().list(request, *args, **kwargs), etag)
+    
+    def perform_create(self, serializer):
+        # Collaborators hear of every write once it commits; see outbox.py
+        with transaction.atomic():
+            block = serializer.save()
+            announce(block.note_id, 'block_created', self.request.user, block=serializer.data)
+    
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            block = serializer.save()
+            # Open editing sessions drop what they hold for the block
+            announce(
+                block.note_id, 'block_updated', self.request.user, 
+                discard=[block.pk], block_id=block.pk, content=block.content
+            )
     
     def perform_destroy(self, instance):
-        # Hard delete
-        instance.delete()
+        # Into the trash; the row is purged once the restore window ends
+        with transaction.atomic():
+            trash_blocks(instance.note_id, [instance.pk])
+            announce(instance.note_id, 'block_deleted', self.request.user, discard=[instance.pk], block_id=instance.pk)
+    
+    @action(detail=True, methods=['post'])
+    def restore(self, request, pk=None):
+        block = Block.all_objects.filter(pk=pk, deleted_at__isnull=False).first()
+        if block is None or not has_access(request.user, block.note_id):
+            return Response({'error': 'Block not found in the trash'}, status=status.HTTP_404_NOT_FOUND)
+        
+        with transaction.atomic():
+            restored = restore_blocks(block.note_id, [block.pk])
+            if restored:
+                data = BlockSerializer(restored[0], context={'request': request}).data
+                announce(block.note_id, 'block_created', request.user, block=data)
+        if not restored:
+            return Response({'error': 'Block is past the restore window'}, status=status.HTTP_410_GONE)
+        return Response(data)
     
     @action(detail=False, methods=['post'])
     def reorder(self, request):
@@ -74,20 +144,205 @@ class BlockViewSet(viewsets.ModelViewSet):
             block_ids = serializer.validated_data['block_ids']
             
             with transaction.atomic():
-                # Update the order of each block
-                for index, block_id in enumerate(block_ids):
-                    Block.objects.filter(id=block_id).update(order=index)
+                # Only blocks that are out of place get new keys
+                moved = apply_order(note_id, block_ids)
+                if moved:
+                    announce(note_id, 'blocks_reordered', request.user, block_ids=block_ids)
             
-            return Response({'success': True}, status=status.HTTP_200_OK)
+            return Response({'success': True, 'moved': moved}, status=status.HTTP_200_OK)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Create, update, delete and move many blocks of one note at once.
+        Either every operation applies or none does; collaborators get a
+        single blocks_batch event.
+        """
+        serializer = BlockBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        note_id = serializer.validated_data['note_id']
+        if not has_access(request.user, note_id):
+            return Response(
+                {'error': 'Note not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        try:
+            with transaction.atomic():
+                created, updated, deleted = apply_batch(note_id, serializer.validated_data['operations'], request.user)
+                changes = {
+                    'created': BlockSerializer(created, many=True).data,
+                    'updated': BlockSerializer(updated, many=True).data,
+                    'deleted': sorted(deleted)
+                }
+                # Open editing sessions drop what they hold for these blocks
+                message = announce(
+                    note_id, 'blocks_batch', request.user, 
+                    discard=[block.pk for block in updated] + sorted(deleted), **changes
+                )
+        except BatchRejected as error:
+            return Response(
+                {'error': str(error), 'operation': error.index}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response({**changes, 'seq': sent_seq(message)}, status=status.HTTP_200_OK)
+    
+    def _readable_note_id(self, request):
+        note_id = request.query_params.get('note_id')
+        if not note_id:
+            return None, Response(
+                {'error': 'note_id is required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            allowed = has_access(request.user, note_id)
+        except ValidationError:
+            allowed = False
+        if not allowed:
+            return None, Response(
+                {'error': 'Note not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return note_id, None
+    
+    @action(detail=False, methods=['get'])
+    def stream(self, request):
+        """Every block of a note, in order, as newline-delimited JSON."""
+        note_id, error = self._readable_note_id(request)
+        if error:
+            return error
+        
+        serializer = BlockSerializer(context={'request': request})
+        encoder = JSONEncoder()
+        
+        def chunk(last):
+            # Keyset pages, so each query reads only STREAM_CHUNK_SIZE rows
+            blocks = Block.objects.filter(note_id=note_id)
+            if last is not None:
+                position, created_at, pk = last
+                blocks = blocks.filter(
+                    Q(position__gt=position) |
+                    Q(position=position, created_at__gt=created_at) |
+                    Q(position=position, created_at=created_at, pk__gt=pk)
+                )
+            rows = list(blocks.order_by('position', 'created_at', 'pk')[:STREAM_CHUNK_SIZE])
+            text = ''.join(encoder.encode(serializer.to_representation(block)) + '\n' for block in rows)
+            last = (rows[-1].position, rows[-1].created_at, rows[-1].pk) if rows else None
+            return text, last, len(rows) == STREAM_CHUNK_SIZE
+        
+        def lines():
+            # WSGI sends each chunk as it is produced
+            last, more = None, True
+            while more:
+                text, last, more = chunk(last)
+                if text:
+                    yield text
+        
+        async def async_lines():
+            # ASGI reads a sync iterator to the end before sending anything;
+            # an async one goes out a chunk at a time
+            last, more = None, True
+            while more:
+                text, last, more = await sync_to_async(chunk)(last)
+                if text:
+                    yield text
+        
+        if isinstance(request._request, ASGIRequest):
+            return StreamingHttpResponse(async_lines(), content_type='application/x-ndjson')
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+    
+    @action(detail=False, methods=['get'])
+    def window(self, request):
+        """
+        Blocks of a note between two position keys (both exclusive), for
+        editors that only load what is on screen. With only `before`, the
+        blocks closest to it are returned.
+        """
+        note_id, error = self._readable_note_id(request)
+        if error:
+            return error
+        
+        after = request.query_params.get('after')
+        before = request.query_params.get('before')
+        try:
+            for key in (after, before):
+                if key:
+                    validate_key(key)
+            limit = max(1, min(int(request.query_params.get('limit', WINDOW_SIZE)), MAX_WINDOW_SIZE))
+        except ValueError:
+            return Response(
+                {'error': 'Invalid window'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        blocks = Block.objects.filter(note_id=note_id)
+        if after:
+            blocks = blocks.filter(position__gt=after)
+        if before:
+            blocks = blocks.filter(position__lt=before)
+        
+        if before and not after:
+            # Walk backwards from `before`, then restore document order
+            rows = list(blocks.order_by('-position', '-created_at')[:limit + 1])
+            has_more = len(rows) > limit
+            rows = rows[:limit][::-1]
+        else:
+            rows = list(blocks.order_by('position', 'created_at')[:limit + 1])
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        
+        serializer = BlockSerializer(rows, many=True, context={'request': request})
+        return Response({
+            'results': serializer.data,
+            'has_more': has_more,
+            'first_position': rows[0].position if rows else None,
+            'last_position': rows[-1].position if rows else None
+        })
+    
+    @action(detail=True, methods=['post'])
+    def move(self, request, pk=None):
+        block = self.get_object()
+        after_id = request.data.get('after_id')
+        before_id = request.data.get('before_id')
+        index = request.data.get('index')
+        
+        try:
+            if index is not None and not after_id and not before_id:
+                position = position_at_index(block.note_id, int(index), exclude=block.pk)
+            else:
+                position = position_between(block.note_id, after_id, before_id, exclude=block.pk)
+        except Block.DoesNotExist:
+            return Response(
+                {'error': 'Sibling block not found in this note'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except (TypeError, ValueError, ValidationError):
+            return Response(
+                {'error': 'Invalid target position'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Only this block's row is written
+        block.position = position
+        with transaction.atomic():
+            block.save(update_fields=['position', 'updated_at'])
+            announce(block.note_id, 'block_moved', request.user, block_id=block.pk, position=position)
+        
+        serializer = BlockSerializer(block, context={'request': request})
+        return Response(serializer.data)
+    
     @action(detail=True, methods=['get'])
     def versions(self, request, pk=None):
         block = self.get_object()
-        versions = BlockVersion.objects.filter(block=block).order_by('-created_at')
-        serializer = BlockVersionSerializer(versions, many=True)
-        return Response(serializer.data)
+        versions = BlockVersion.objects.filter(block=block).order_by('-version_number')
+        page = self.paginate_queryset(versions)
+        serializer = BlockVersionSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
     
     @action(detail=True, methods=['post'])
     def restore_version(self, request, pk=None):
@@ -104,19 +359,18 @@ class BlockViewSet(viewsets.ModelViewSet):
             version = BlockVersion.objects.get(id=version_id, block=block)
             
             # Update block content to the version content
-            block.content = version.content
-            block.save()
-            
-            # Create a new version entry for this restoration
-            latest_version = BlockVersion.objects.filter(block=block).order_by('-version_number').first()
-            next_version = (latest_version.version_number + 1) if latest_version else 1
-            
-            BlockVersion.objects.create(
-                block=block,
-                content=block.content,
-                created_by=request.user,
-                version_number=next_version
-            )
+            old_content = block.content
+            block.content = reconstruct(version)
+            with transaction.atomic():
+                block.save()
+                
+                # Record the restoration; an unchanged block stores nothing and
+                # an earlier state is stored as a reference to it
+                record_version(block, block.content, request.user, previous_content=old_content)
+                announce(
+                    block.note_id, 'block_updated', request.user, 
+                    discard=[block.pk], block_id=block.pk, content=block.content
+                )
             
             serializer = BlockSerializer(block, context={'request': request})
             return Response(serializer.data)
@@ -131,36 +385,92 @@ class BlockViewSet(viewsets.ModelViewSet):
     def duplicate(self, request, pk=None):
         original_block = self.get_object()
         
-        # Create a copy of the block
-        new_block = Block.objects.create(
-            note=original_block.note,
-            block_type=original_block.block_type,
-            content=original_block.content.copy(),
-            order=original_block.order + 1
-        )
+        with transaction.atomic():
+            # Create a copy of the block right after the original; no other
+            # block needs to move
+            new_block = Block.objects.create(
+                note=original_block.note,
+                block_type=original_block.block_type,
+                content=original_block.content.copy(),
+                position=position_after(original_block)
+            )
+            
+            # Create initial version for the new block
+            record_version(new_block, new_block.content, request.user)
+            
+            serializer = BlockSerializer(new_block, context={'request': request})
+            announce(new_block.note_id, 'block_created', request.user, block=serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ImageUploadViewSet(viewsets.GenericViewSet):
+    """Chunked, resumable image uploads; see uploads.py for the protocol."""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = ImageUploadSerializer
+    
+    def get_queryset(self):
+        return ImageUpload.objects.filter(user=self.request.user)
+    
+    def create(self, request):
+        serializer = ImageUploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
-        # Update orders of subsequent blocks
-        Block.objects.filter(
-            note=original_block.note,
-            order__gt=original_block.order
-        ).exclude(id=new_block.id).update(order=models.F('order') + 1)
-        
-        # Create initial version for the new block
-        BlockVersion.objects.create(
-            block=new_block,
-            content=new_block.content,
-            created_by=request.user,
-            version_number=1
-        )
+        upload = start_upload(request.user, **serializer.validated_data)
+        return Response(ImageUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+    
+    def retrieve(self, request, pk=None):
+        return Response(ImageUploadSerializer(self.get_object()).data)
+    
+    def partial_update(self, request, pk=None):
+        """Append the raw request body at the offset in the Upload-Offset header."""
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers.get('Content-Length') or 0)
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Upload-Offset and Content-Length headers are required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        serializer = BlockSerializer(new_block, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        with transaction.atomic():
+            upload = get_object_or_404(self.get_queryset().select_for_update(), pk=self.kwargs['pk'])
+            try:
+                # Read in small pieces straight from the request body
+                append_chunk(upload, offset, request.stream, length)
+            except UploadError as error:
+                return Response(
+                    {'error': str(error), 'offset': error.offset}, 
+                    status=status.HTTP_409_CONFLICT
+                )
+        
+        return Response(ImageUploadSerializer(upload).data)
+    
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        with transaction.atomic():
+            upload = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+            try:
+                asset, created = complete_upload(upload)
+            except UploadError as error:
+                return Response(
+                    {'error': str(error), 'offset': error.offset}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        
+        url = request.build_absolute_uri(default_storage.url(asset.path))
+        return Response({
+            'url': url,
+            'deduplicated': not created,
+            # Known already if the image was uploaded before
+            **image_content(asset, url)
+        }, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def upload_image(request):
-    """Upload an image file and return the URL"""
+    """Upload an image file in one request and return the URL"""
     if 'image' not in request.FILES:
         return Response(
             {'error': 'No image file provided'}, 
@@ -170,32 +480,36 @@ def upload_image(request):
     image_file = request.FILES['image']
     
     # Validate file type
-    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
-    if image_file.content_type not in allowed_types:
+    extension = sniff_extension(image_file.read(16))
+    image_file.seek(0)
+    if image_file.content_type not in CONTENT_TYPES or extension is None:
         return Response(
             {'error': 'Invalid file type. Only JPEG, PNG, GIF, and WebP images are allowed.'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
     
     # Validate file size (max 10MB)
-    if image_file.size > 10 * 1024 * 1024:
+    if image_file.size > UPLOAD_SETTINGS['MAX_SIZE']:
         return Response(
             {'error': 'File too large. Maximum size is 10MB.'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
     
     try:
-        # Generate unique filename
-        file_extension = os.path.splitext(image_file.name)[1]
-        unique_filename = f"images/{uuid.uuid4()}{file_extension}"
-        
-        # Save file
-        file_path = default_storage.save(unique_filename, ContentFile(image_file.read()))
+        # Larger files are spooled to disk by Django; both the hash and the
+        # copy to storage read them in chunks
+        asset, created = store_image(
+            image_file, hash_file(image_file), extension, image_file.content_type, image_file.size
+        )
         
         # Generate full URL
-        file_url = request.build_absolute_uri(default_storage.url(file_path))
+        file_url = request.build_absolute_uri(default_storage.url(asset.path))
         
-        return Response({'url': file_url}, status=status.HTTP_200_OK)
+        return Response({
+            'url': file_url,
+            'deduplicated': not created,
+            **image_content(asset, file_url)
+        }, status=status.HTTP_200_OK)
         
     except Exception as e:
         return Response(
@@ -0,0 +1,30 @@
+from channels.consumer import SyncConsumer
+from apps.notes.duplication import run_duplication
+from .images import process_asset
+from .ordering import rebalance_note
+
+
+class BlockMaintenanceConsumer(SyncConsumer):
+    """
+    Background worker for block housekeeping. Run it with:
+    
+        python manage.py runworker block-maintenance
+    """
+    
+    def rebalance_note(self, message):
+        rebalance_note(message['note_id'])
+    
+    def duplicate_note(self, message):
+        run_duplication(message['job_id'], share_history=message['share_history'])
+
+
+class ImageVariantConsumer(SyncConsumer):
+    """
+    Generates resized WebP variants of uploaded images. Start as many as
+    needed; each message goes to one of them:
+    
+        python manage.py runworker image-variants
+    """
+    
+    def image_variants(self, message):
+        process_asset(message['asset_id'])
@@ -0,0 +1,94 @@
+"""
+Cached lookups against the NoteAccess index.
+
+A permission check is a single indexed probe on (user, note), or a cache hit.
+Negative results are cached too and are invalidated whenever access changes.
+"""
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from .models import Note, NoteAccess
+
+CACHE_TIMEOUT = getattr(settings, 'NOTE_ACCESS_CACHE_TIMEOUT', 300)
+
+# Stored in the cache for "no access" so misses can be told from negatives
+NO_ACCESS = ''
+
+
+def _cache_key(user_id, note_id):
+    return f'note-access:{user_id}:{note_id}'
+
+
+def _normalize_note_id(note_id):
+    try:
+        return uuid.UUID(str(note_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_role(user, note_id):
+    """Return the user's role on the note, or None if they have no access."""
+    if not user or not user.is_authenticated:
+        return None
+    
+    note_id = _normalize_note_id(note_id)
+    if note_id is None:
+        return None
+    
+    key = _cache_key(user.pk, note_id)
+    role = cache.get(key)
+    if role is None:
+        # From the primary: a replica's answer would be cached past its lag
+        role = NoteAccess.objects.using(DEFAULT_DB_ALIAS).filter(
+            user_id=user.pk, note_id=note_id, note__deleted_at__isnull=True
+        ).values_list('role', flat=True).first() or NO_ACCESS
+        cache.set(key, role, CACHE_TIMEOUT)
+    
+    return role or None
+
+
+def has_access(user, note_id):
+    return get_role(user, note_id) is not None
+
+
+def is_owner(user, note_id):
+    return get_role(user, note_id) == NoteAccess.ROLE_OWNER
+
+
+def accessible_notes(user):
+    """Notes the user owns or collaborates on; a plain join, no DISTINCT."""
+    return Note.objects.filter(access__user=user)
+
+
+def _forget(keys):
+    cache.delete_many(keys)
+    # Again after commit, or a request in between could cache the old role
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate(user_id, note_id):
+    _forget([_cache_key(user_id, note_id)])
+
+
+def invalidate_note(note_id):
+    """Drop the cached roles of everyone with access, e.g. when the note is trashed."""
+    _forget([_cache_key(user_id, note_id) for user_id in NoteAccess.objects.filter(note_id=note_id).values_list('user_id', flat=True)])
+
+
+def grant(user_id, note_id, role):
+    grant_many([(user_id, note_id)], role)
+
+
+def grant_many(pairs, role):
+    NoteAccess.objects.bulk_create(
+        [NoteAccess(user_id=user_id, note_id=note_id, role=role) for user_id, note_id in pairs],
+        ignore_conflicts=True,
+    )
+    _forget([_cache_key(user_id, note_id) for user_id, note_id in pairs])
+
+
+def revoke_many(pairs, role):
+    for user_id, note_id in pairs:
+        NoteAccess.objects.filter(user_id=user_id, note_id=note_id, role=role).delete()
+    _forget([_cache_key(user_id, note_id) for user_id, note_id in pairs])
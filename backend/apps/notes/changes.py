@@ -0,0 +1,182 @@
+"""
+Change feed for REST clients.
+
+    GET /api/sync/changes/                 cursor for "now", no changes
+    GET /api/sync/changes/?since=<cursor>  what changed after the cursor
+
+Writes to notes, blocks and collaborators append rows to Change in their
+own transaction (record_changes()), so a change is logged exactly when
+it commits. The feed reads the user's rows
+after the cursor through the (note_id, id) and (user_id, id) indexes,
+collapses them to the current state of each object, and lists what was
+deleted or is no longer shared with the user as tombstones. Its cost
+follows the number of changes, not the size of the workspace.
+
+A client takes a cursor, then loads what it needs as usual, then asks for
+changes since the cursor and keeps the cursor each response returns,
+asking again at once while has_more is set. A response with retry_after
+holds changes that are still settling; they can be fetched that many
+seconds later. Notes it does not know yet
+(shared with it, restored, duplicated) are loaded with bootstrap.
+
+A transaction may take a lower id than one that commits before it. Rows
+newer than SETTLE seconds are held back so the feed does not move past
+such a gap while the transaction is still open. Writers record their
+changes at the end of short transactions, and SETTLE must stay above the
+time from recording to commit. Rows older than RETENTION_DAYS are pruned
+and the highest pruned id is kept in ChangeHorizon; cursors below it get
+410 and the client reloads. Ids skipped by rolled-back inserts do not
+expire anyone.
+"""
+import base64
+import binascii
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from .models import Change, ChangeHorizon, Note, NoteAccess
+
+DEFAULTS = {
+    'PAGE_SIZE': 500,
+    'SETTLE': 1.0,
+    'RETENTION_DAYS': 90,
+}
+
+SYNC_SETTINGS = {**DEFAULTS, **getattr(settings, 'SYNC_CHANGES', {})}
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def record_changes(notes=(), blocks=(), members=()):
+    """
+    Log changed notes (ids), blocks ((note id, block id) pairs) and
+    memberships ((note id, user id) pairs) in the current transaction.
+    """
+    # Stamped at the INSERT, for the settle window
+    now = timezone.now()
+    rows = [Change(kind=Change.KIND_NOTE, note_id=note_id, created_at=now) for note_id in set(notes)]
+    rows += [
+        Change(kind=Change.KIND_BLOCK, note_id=note_id, block_id=block_id, created_at=now)
+        for note_id, block_id in set(blocks)
+    ]
+    rows += [
+        Change(kind=Change.KIND_MEMBER, note_id=note_id, user_id=user_id, created_at=now)
+        for note_id, user_id in set(members)
+    ]
+    if rows:
+        Change.objects.bulk_create(rows)
+
+
+def encode_cursor(change_id):
+    return base64.urlsafe_b64encode(f'c{change_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """The change id in a cursor; raises ValueError for anything else."""
+    try:
+        text = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(cursor)
+    if not text.startswith('c') or not text[1:].isdigit():
+        raise ValueError(cursor)
+    return int(text[1:])
+
+
+def _settled():
+    return timezone.now() - timedelta(seconds=SYNC_SETTINGS['SETTLE'])
+
+
+def head():
+    """The id of the newest settled change."""
+    return Change.objects.filter(created_at__lte=_settled()).order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def pruned_through():
+    """The highest change id pruned so far, or 0."""
+    return ChangeHorizon.objects.filter(pk=1).values_list('pruned_through', flat=True).first() or 0
+
+
+def prune_changes():
+    """Delete changes past the retention period, always keeping the newest one."""
+    cutoff = timezone.now() - timedelta(days=SYNC_SETTINGS['RETENTION_DAYS'])
+    newest = Change.objects.order_by('-id').values_list('id', flat=True).first()
+    if newest is None:
+        return 0
+    last = Change.objects.filter(created_at__lt=cutoff, id__lt=newest).aggregate(last=Max('id'))['last']
+    if last is None:
+        return 0
+    with transaction.atomic():
+        # Raised before the rows go, so no reader misses the expiry
+        horizon, _ = ChangeHorizon.objects.select_for_update().get_or_create(pk=1)
+        horizon.pruned_through = max(horizon.pruned_through, last)
+        horizon.save()
+        count, _ = Change.objects.filter(id__lte=last).delete()
+    return count
+
+
+def changes_since(user, since, limit=None):
+    """
+    Up to `limit` changes visible to `user` after change id `since`, as
+    (rows, last id read, whether more can be read now, seconds until held
+    back rows settle or None).
+    """
+    limit = limit or SYNC_SETTINGS['PAGE_SIZE']
+    if since < pruned_through():
+        # Changes after the cursor have been pruned
+        raise CursorExpired()
+    
+    rows = list(Change.objects.filter(
+        Q(note_id__in=NoteAccess.objects.filter(user_id=user.pk).values('note_id')) | Q(user_id=user.pk),
+        id__gt=since
+    ).order_by('id')[:limit + 1])
+    
+    more = len(rows) > limit
+    rows = rows[:limit]
+    retry_after = None
+    settled = _settled()
+    for index, row in enumerate(rows):
+        if row.created_at > settled:
+            # Later rows wait until everything before them has committed
+            retry_after = (row.created_at - settled).total_seconds()
+            rows, more = rows[:index], False
+            break
+    return rows, (rows[-1].id if rows else since), more, retry_after
+
+
+def collapse(user, rows):
+    """
+    The current state behind a page of changes: (notes, blocks, memberships,
+    deleted), where deleted lists the note ids, block ids and (note id,
+    user id) memberships that are gone or no longer visible to `user`.
+    """
+    from apps.blocks.models import Block
+    
+    note_ids = {row.note_id for row in rows if row.kind != Change.KIND_BLOCK}
+    block_ids = {row.block_id for row in rows if row.kind == Change.KIND_BLOCK}
+    pairs = {(row.note_id, row.user_id) for row in rows if row.kind == Change.KIND_MEMBER}
+    
+    visible = set(Note.objects.filter(
+        access__user_id=user.pk, pk__in={row.note_id for row in rows}
+    ).values_list('pk', flat=True))
+    
+    notes = list(Note.objects.filter(pk__in=note_ids & visible).select_related('owner__profile').with_counts())
+    blocks = list(Block.objects.filter(pk__in=block_ids, note_id__in=visible))
+    memberships = list(NoteAccess.objects.filter(
+        note_id__in={note_id for note_id, _ in pairs} & visible,
+        user_id__in={user_id for _, user_id in pairs}
+    ).select_related('user'))
+    
+    present = {(access.note_id, access.user_id) for access in memberships}
+    deleted = {
+        'notes': sorted(str(note_id) for note_id in note_ids - visible),
+        'blocks': sorted(str(block_id) for block_id in block_ids - {block.pk for block in blocks}),
+        'memberships': [
+            {'note_id': str(note_id), 'user_id': user_id}
+            for note_id, user_id in sorted(pairs - present, key=str)
+        ],
+    }
+    memberships = [access for access in memberships if (access.note_id, access.user_id) in pairs]
+    return notes, blocks, memberships, deleted
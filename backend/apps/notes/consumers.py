@@ -3,14 +3,32 @@ import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from .models import Note
-from apps.blocks.models import Block, BlockVersion
+from .access import has_access
+from .outbox import announce, sent_seq
+from .sessions import SESSION_ELSEWHERE_CODE, PatchRejected, SessionElsewhere, open_session
+from .trash import trash_blocks
+from apps.blocks.models import Block
+from apps.blocks.ordering import apply_order, position_at_index, position_between
+from apps.blocks.versioning import record_version
+from apps.users.authentication import TOKEN_SUBPROTOCOL
+from config.replicas import mark_written, scope_credential
+
+
+# Broadcasts that change the note; these are numbered and logged so that
+# reconnecting clients can catch up on them. Operations written to the
+# database right away are sent through the outbox instead.
+LOGGED_OPERATIONS = {
+    'block_updated',
+    'block_patched',
+}
 
 
 class NoteConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.note_id = self.scope['url_route']['kwargs']['note_id']
-        self.note_group_name = f'note_{self.note_id}'
         self.user = self.scope["user"]
         
         # Check if user has permission to access this note
@@ -18,50 +36,46 @@ class NoteConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
-        # Join note group
-        await self.channel_layer.group_add(
-            self.note_group_name,
-            self.channel_name
-        )
+        # Browsers drop a connection whose offered subprotocol is not chosen
+        await self.accept(subprotocol=TOKEN_SUBPROTOCOL if self.scope.get('auth_token') else None)
         
-        await self.accept()
+        # Edits and broadcasts go through the note's shared session
+        try:
+            self.session = await open_session(self.note_id, self)
+        except SessionElsewhere:
+            # Another process edits this note; the proxy should route the
+            # client there when it reconnects (see sessions.py)
+            await self.close(code=SESSION_ELSEWHERE_CODE)
+            return
         
         # Send initial connection confirmation
         await self.send(text_data=json.dumps({
             'type': 'connection_established',
             'note_id': self.note_id,
             'user_id': str(self.user.id),
-            'username': self.user.username
+            'username': self.user.username,
+            # Latest operation number; send it back in a resume message
+            # after reconnecting
+            'seq': await self.session.current_seq(),
+            # Patch sequence numbers of blocks edited in this session so far;
+            # other blocks start at 0
+            'block_seqs': self.session.patch_seqs()
         }))
         
         # Notify other users that this user joined
-        await self.channel_layer.group_send(
-            self.note_group_name,
-            {
-                'type': 'user_joined',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'sender_channel': self.channel_name
-            }
-        )
+        await self.broadcast('user_joined')
     
     async def disconnect(self, close_code):
+        if getattr(self, 'session', None) is None:
+            # Rejected in connect()
+            return
+        
         # Notify other users that this user left
-        await self.channel_layer.group_send(
-            self.note_group_name,
-            {
-                'type': 'user_left',
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'sender_channel': self.channel_name
-            }
-        )
+        await self.broadcast('user_left')
         
-        # Leave note group
-        await self.channel_layer.group_discard(
-            self.note_group_name,
-            self.channel_name
-        )
+        # Flushes pending edits once the last local editor has left
+        await self.session.release(self)
+        self.session = None
     
     async def receive(self, text_data):
         data = json.loads(text_data)
@@ -69,16 +83,22 @@ class NoteConsumer(AsyncWebsocketConsumer):
         
         if message_type == 'block_update':
             await self.handle_block_update(data)
+        elif message_type == 'block_patch':
+            await self.handle_block_patch(data)
         elif message_type == 'block_create':
             await self.handle_block_create(data)
         elif message_type == 'block_delete':
             await self.handle_block_delete(data)
         elif message_type == 'block_reorder':
             await self.handle_block_reorder(data)
+        elif message_type == 'block_move':
+            await self.handle_block_move(data)
         elif message_type == 'cursor_position':
             await self.handle_cursor_position(data)
         elif message_type == 'user_selection':
             await self.handle_user_selection(data)
+        elif message_type == 'resume':
+            await self.handle_resume(data)
     
     async def handle_block_update(self, data):
         block_id = data.get('block_id')
@@ -87,43 +107,64 @@ class NoteConsumer(AsyncWebsocketConsumer):
         if not block_id or content is None:
             return
         
-        # Update block in database
-        success = await self.update_block_content(block_id, content)
+        # Apply in memory; the session writes it to the database shortly
+        seq = await self.session.update_block(block_id, content, self.user)
         
-        if success:
+        if seq is not None:
             # Broadcast update to all connected users
-            await self.channel_layer.group_send(
-                self.note_group_name,
-                {
-                    'type': 'block_updated',
-                    'block_id': block_id,
-                    'content': content,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'sender_channel': self.channel_name
-                }
+            await self.broadcast(
+                'block_updated',
+                block_id=block_id,
+                content=content,
+                seq=seq
             )
     
+    async def handle_block_patch(self, data):
+        block_id = data.get('block_id')
+        
+        if not block_id:
+            return
+        
+        try:
+            seq, ops = await self.session.patch_block(block_id, data.get('base_seq'), data.get('ops'), self.user)
+        except PatchRejected as error:
+            # Send the current state so the client can start over from it
+            await self.send(text_data=json.dumps({
+                'type': 'block_patch_rejected',
+                'block_id': block_id,
+                'error': str(error),
+                'seq': error.seq,
+                'content': error.content
+            }))
+            return
+        
+        await self.send(text_data=json.dumps({
+            'type': 'block_patch_ack',
+            'block_id': block_id,
+            'seq': seq
+        }))
+        
+        # Only the operations go out, transformed to apply at `seq`
+        await self.broadcast(
+            'block_patched',
+            block_id=block_id,
+            seq=seq,
+            ops=ops
+        )
+    
     async def handle_block_create(self, data):
         block_type = data.get('block_type', 'text')
         content = data.get('content', {})
-        order = data.get('order', 0)
-        
-        # Create block in database
-        block_data = await self.create_block(block_type, content, order)
-        
-        if block_data:
-            # Broadcast creation to all connected users
-            await self.channel_layer.group_send(
-                self.note_group_name,
-                {
-                    'type': 'block_created',
-                    'block': block_data,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'sender_channel': self.channel_name
-                }
-            )
+        order = data.get('order')
+        
+        if order is not None and (type(order) is not int or order < 0):
+            return
+        
+        # Create block in database; the others hear of it once it commits
+        message = await self.create_block(block_type, content, order)
+        
+        if message:
+            await self.acknowledge('block_created', message)
     
     async def handle_block_delete(self, data):
         block_id = data.get('block_id')
@@ -132,20 +173,11 @@ class NoteConsumer(AsyncWebsocketConsumer):
             return
         
         # Delete block in database
-        success = await self.delete_block(block_id)
-        
-        if success:
-            # Broadcast deletion to all connected users
-            await self.channel_layer.group_send(
-                self.note_group_name,
-                {
-                    'type': 'block_deleted',
-                    'block_id': block_id,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'sender_channel': self.channel_name
-                }
-            )
+        self.session.discard(block_id)
+        message = await self.delete_block(block_id)
+        
+        if message:
+            await self.acknowledge('block_deleted', message)
     
     async def handle_block_reorder(self, data):
         block_ids = data.get('block_ids', [])
@@ -154,220 +186,207 @@ class NoteConsumer(AsyncWebsocketConsumer):
             return
         
         # Reorder blocks in database
-        success = await self.reorder_blocks(block_ids)
-        
-        if success:
-            # Broadcast reorder to all connected users
-            await self.channel_layer.group_send(
-                self.note_group_name,
-                {
-                    'type': 'blocks_reordered',
-                    'block_ids': block_ids,
-                    'user_id': str(self.user.id),
-                    'username': self.user.username,
-                    'sender_channel': self.channel_name
-                }
-            )
+        try:
+            message = await self.reorder_blocks(block_ids)
+        except (ValueError, ValidationError) as error:
+            await self.send_error('blocks_reorder_rejected', error)
+            return
+        
+        if message:
+            await self.acknowledge('blocks_reordered', message)
+    
+    async def handle_block_move(self, data):
+        block_id = data.get('block_id')
+        
+        if not block_id:
+            return
+        
+        # Move a single block between two siblings; one row is written
+        try:
+            message = await self.move_block(block_id, data.get('after_id'), data.get('before_id'))
+        except (ValueError, ValidationError, Block.DoesNotExist) as error:
+            await self.send_error('block_move_rejected', error, block_id=block_id)
+            return
+        
+        if message:
+            await self.acknowledge('block_moved', message)
     
     async def handle_cursor_position(self, data):
         block_id = data.get('block_id')
         position = data.get('position', 0)
         
-        # Broadcast cursor position to other users
-        await self.channel_layer.group_send(
-            self.note_group_name,
-            {
-                'type': 'cursor_moved',
-                'block_id': block_id,
-                'position': position,
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'sender_channel': self.channel_name
-            }
-        )
+        # Sent to other users with the next presence tick
+        self.session.update_presence(self, cursor={
+            'block_id': block_id,
+            'position': position
+        })
     
     async def handle_user_selection(self, data):
         block_id = data.get('block_id')
         selection_start = data.get('selection_start', 0)
         selection_end = data.get('selection_end', 0)
         
-        # Broadcast user selection to other users
-        await self.channel_layer.group_send(
-            self.note_group_name,
-            {
-                'type': 'user_selection_changed',
-                'block_id': block_id,
-                'selection_start': selection_start,
-                'selection_end': selection_end,
-                'user_id': str(self.user.id),
-                'username': self.user.username,
-                'sender_channel': self.channel_name
-            }
-        )
-    
-    # Event handlers for group messages
-    async def user_joined(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'user_joined',
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
-    
-    async def user_left(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'user_left',
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+        # Sent to other users with the next presence tick
+        self.session.update_presence(self, selection={
+            'block_id': block_id,
+            'selection_start': selection_start,
+            'selection_end': selection_end
+        })
     
-    async def block_updated(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'block_updated',
-                'block_id': event['block_id'],
-                'content': event['content'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
-    
-    async def block_created(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'block_created',
-                'block': event['block'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+    async def handle_resume(self, data):
+        last_seq = data.get('last_seq')
+        
+        frames = None
+        if isinstance(last_seq, int) and last_seq >= 0:
+            seq, frames = await self.session.operations_since(last_seq)
+        
+        if frames is None:
+            # Too far behind (or unknown); start over from the current state
+            await self.send(text_data=json.dumps(await self.note_snapshot()))
+            return
+        
+        for frame in frames:
+            await self.send(text_data=frame)
+        await self.send(text_data=json.dumps({
+            'type': 'resume_complete',
+            'seq': seq
+        }))
     
-    async def block_deleted(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'block_deleted',
-                'block_id': event['block_id'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+    async def note_snapshot(self):
+        seq = await self.session.current_seq()
+        blocks = await self.load_blocks()
+        
+        # Unsaved edits live in the session
+        for block in blocks:
+            content = self.session.current_content(block['id'])
+            if content is not None:
+                block['content'] = content
+        
+        return {
+            'type': 'resync',
+            'seq': seq,
+            'blocks': blocks,
+            'block_seqs': self.session.patch_seqs()
+        }
     
-    async def blocks_reordered(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'blocks_reordered',
-                'block_ids': event['block_ids'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+    async def broadcast(self, message_type, **fields):
+        # Encoded once here; every recipient gets the same frame as-is
+        frame = json.dumps({
+            'type': message_type,
+            **fields,
+            'user_id': str(self.user.id),
+            'username': self.user.username
+        })
+        
+        if message_type not in LOGGED_OPERATIONS:
+            await self.session.publish(frame, sender=self)
+            return
+        
+        seq = await self.session.publish_operation(frame, sender=self)
+        # The sender does not get its own frame back; tell it the number
+        await self.send(text_data=json.dumps({
+            'type': 'op_ack',
+            'op': message_type,
+            'seq': seq
+        }))
     
-    async def cursor_moved(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_moved',
-                'block_id': event['block_id'],
-                'position': event['position'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+    async def acknowledge(self, message_type, message):
+        # Written to the database; the outbox has sent the frame to everyone
+        # else (or the relay will), so the sender only gets its number
+        await self.send(text_data=json.dumps({
+            'type': 'op_ack',
+            'op': message_type,
+            'seq': await self.written(message)
+        }))
     
-    async def user_selection_changed(self, event):
-        if event['sender_channel'] != self.channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'user_selection_changed',
-                'block_id': event['block_id'],
-                'selection_start': event['selection_start'],
-                'selection_end': event['selection_end'],
-                'user_id': event['user_id'],
-                'username': event['username']
-            }))
+    async def send_error(self, message_type, error, **fields):
+        # Nothing was written; only the sender hears of it
+        await self.send(text_data=json.dumps({
+            'type': message_type,
+            'error': str(error),
+            **fields
+        }))
     
     # Database operations
     @database_sync_to_async
-    def has_note_permission(self):
-        try:
-            note = Note.objects.get(id=self.note_id)
-            return (note.owner == self.user or 
-                   note.collaborators.filter(id=self.user.id).exists())
-        except Note.DoesNotExist:
-            return False
+    def written(self, message):
+        # The user's REST reads stay on the primary for a while
+        mark_written(scope_credential(self.scope))
+        return sent_seq(message)
     
     @database_sync_to_async
-    def update_block_content(self, block_id, content):
-        try:
-            block = Block.objects.get(id=block_id, note_id=self.note_id)
-            
-            # Store old content for version history
-            old_content = block.content
-            
-            # Update block
-            block.content = content
-            block.save()
-            
-            # Create version if content changed significantly
-            if old_content != content:
-                latest_version = BlockVersion.objects.filter(block=block).order_by('-version_number').first()
-                next_version = (latest_version.version_number + 1) if latest_version else 1
-                
-                BlockVersion.objects.create(
-                    block=block,
-                    content=content,
-                    created_by=self.user,
-                    version_number=next_version
-                )
-            
-            return True
-        except Block.DoesNotExist:
-            return False
+    def has_note_permission(self):
+        return has_access(self.user, self.note_id)
     
     @database_sync_to_async
-    def create_block(self, block_type, content, order):
-        try:
-            note = Note.objects.get(id=self.note_id)
-            
-            # Create block
-            block = Block.objects.create(
-                note=note,
-                block_type=block_type,
-                content=content,
-                order=order
-            )
-            
-            # Create initial version
-            BlockVersion.objects.create(
-                block=block,
-                content=content,
-                created_by=self.user,
-                version_number=1
-            )
-            
-            return {
+    def load_blocks(self):
+        return [
+            {
                 'id': str(block.id),
                 'block_type': block.block_type,
                 'content': block.content,
-                'order': block.order,
+                'position': block.position,
                 'created_at': block.created_at.isoformat(),
                 'updated_at': block.updated_at.isoformat()
             }
+            for block in Block.objects.filter(note_id=self.note_id)
+        ]
+    
+    @database_sync_to_async
+    def create_block(self, block_type, content, order):
+        try:
+            with transaction.atomic():
+                note = Note.objects.get(id=self.note_id)
+                
+                # Create block at the requested index, or at the end
+                block = Block.objects.create(
+                    note=note,
+                    block_type=block_type,
+                    content=content,
+                    position=position_at_index(note.pk, order) if order is not None else ''
+                )
+                
+                # Create initial version
+                record_version(block, content, self.user)
+                
+                return announce(self.note_id, 'block_created', self.user, sender=self.channel_name, block={
+                    'id': str(block.id),
+                    'block_type': block.block_type,
+                    'content': block.content,
+                    'position': block.position,
+                    'created_at': block.created_at.isoformat(),
+                    'updated_at': block.updated_at.isoformat()
+                })
         except Note.DoesNotExist:
             return None
     
     @database_sync_to_async
     def delete_block(self, block_id):
         try:
-            block = Block.objects.get(id=block_id, note_id=self.note_id)
-            block.is_deleted = True
-            block.save()
-            return True
-        except Block.DoesNotExist:
-            return False
+            with transaction.atomic():
+                if not trash_blocks(self.note_id, [block_id]):
+                    return None
+                return announce(
+                    self.note_id, 'block_deleted', self.user, 
+                    discard=[block_id], sender=self.channel_name, block_id=block_id
+                )
+        except ValidationError:
+            # Not a block id
+            return None
     
     @database_sync_to_async
     def reorder_blocks(self, block_ids):
-        try:
-            for index, block_id in enumerate(block_ids):
-                Block.objects.filter(
-                    id=block_id, 
-                    note_id=self.note_id
-                ).update(order=index)
-            return True
-        except Exception:
-            return False
\ No newline at end of file
+        with transaction.atomic():
+            apply_order(self.note_id, block_ids)
+            return announce(self.note_id, 'blocks_reordered', self.user, sender=self.channel_name, block_ids=block_ids)
+    
+    @database_sync_to_async
+    def move_block(self, block_id, after_id, before_id):
+        with transaction.atomic():
+            block = Block.objects.get(id=block_id, note_id=self.note_id)
+            block.position = position_between(self.note_id, after_id, before_id, exclude=block.pk)
+            block.save(update_fields=['position', 'updated_at'])
+            return announce(
+                self.note_id, 'block_moved', self.user, 
+                sender=self.channel_name, block_id=block_id, position=block.position
+            )
\ No newline at end of file
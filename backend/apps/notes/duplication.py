@@ -0,0 +1,181 @@
+"""
+Note duplication.
+
+The source's blocks are read in chunks from one cursor and each chunk is
+written with one INSERT for the blocks and one for their first versions,
+all in one transaction. Notes with more than SYNC_LIMIT blocks are copied
+by the block-maintenance worker instead; the job's progress is kept in the
+cache for the client to poll.
+
+With share_history, each copied block gets a reference to every version
+of its source block, with the same numbers, authors and dates, so the
+copy's history lists and restores the source's versions without writing
+their payloads again. A block changed since its latest version gets a
+snapshot on top. Editing the copy adds versions as usual; deleting the
+source turns the references into snapshots (see
+apps.blocks.models.keep_referencing_versions).
+"""
+import logging
+import uuid
+from collections import defaultdict
+from itertools import islice
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from apps.blocks.deltas import content_hash
+from apps.blocks.models import Block, BlockVersion
+from apps.blocks.ordering import MAINTENANCE_CHANNEL
+from apps.search.backends import get_backend
+from .models import Note
+
+logger = logging.getLogger(__name__)
+
+SYNC_LIMIT = getattr(settings, 'NOTE_DUPLICATE_SYNC_LIMIT', 1000)
+
+CHUNK_SIZE = 1000
+
+JOB_TIMEOUT = 24 * 60 * 60
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def _source_history(source_ids):
+    """{source block id: [version rows, oldest first]}, without payloads."""
+    history = defaultdict(list)
+    rows = BlockVersion.objects.filter(block_id__in=source_ids).order_by('block_id', 'version_number').values_list(
+        'block_id', 'pk', 'reference_id', 'content_hash', 'created_by_id', 'created_at', 'version_number'
+    )
+    for block_id, *row in rows:
+        history[block_id].append(row)
+    return history
+
+
+def _first_versions(rows, blocks, created_by, share_history):
+    history = _source_history([row[0] for row in rows]) if share_history else {}
+    versions = []
+    for (source_id, _, content, _), block in zip(rows, blocks):
+        shared = history.get(source_id, [])
+        for pk, reference_id, digest, author_id, created_at, number in shared:
+            versions.append(BlockVersion(
+                block=block,
+                kind=BlockVersion.KIND_REFERENCE,
+                # Never a reference to a reference
+                reference_id=reference_id or pk,
+                content_hash=digest,
+                created_by_id=author_id,
+                created_at=created_at,
+                version_number=number
+            ))
+        
+        digest = content_hash(content)
+        if not shared or shared[-1][2] != digest:
+            versions.append(BlockVersion(
+                block=block,
+                kind=BlockVersion.KIND_SNAPSHOT,
+                content=content,
+                content_hash=digest,
+                created_by=created_by,
+                version_number=shared[-1][-1] + 1 if shared else 1
+            ))
+    return versions
+
+
+def duplicate_note(source, owner, share_history=False, progress=None):
+    """
+    Copy `source` and its blocks into a new note owned by `owner`.
+    `progress`, if given, is called with the number of blocks copied so far.
+    """
+    with transaction.atomic():
+        copy = Note.objects.create(title=f"{source.title} (Copy)", owner=owner)
+        rows = Block.objects.filter(note_id=source.pk).order_by('position', 'created_at').values_list(
+            'pk', 'block_type', 'content', 'position'
+        ).iterator(chunk_size=CHUNK_SIZE)
+        
+        copied = 0
+        for chunk in _chunks(rows, CHUNK_SIZE):
+            now = timezone.now()
+            # Not logged as changes; clients load a new note whole
+            blocks = Block.objects.bulk_create([
+                Block(note=copy, block_type=block_type, content=content, position=position, created_at=now, updated_at=now)
+                for _, block_type, content, position in chunk
+            ])
+            BlockVersion.objects.bulk_create(_first_versions(chunk, blocks, owner, share_history))
+            get_backend().index_blocks(blocks)
+            copied += len(blocks)
+            if progress is not None:
+                progress(copied)
+    return copy
+
+
+def _job_key(job_id):
+    return f'note-duplication:{job_id}'
+
+
+def get_job(job_id):
+    return cache.get(_job_key(job_id))
+
+
+def _save_job(job):
+    cache.set(_job_key(job['id']), job, timeout=JOB_TIMEOUT)
+
+
+def start_duplication(source, owner, total, share_history=False):
+    """Queue a copy of `source` on the block-maintenance worker; returns the job."""
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'user_id': owner.pk,
+        'source_id': str(source.pk),
+        'note_id': None,
+        'copied': 0,
+        'total': total,
+    }
+    _save_job(job)
+    
+    def send():
+        try:
+            async_to_sync(get_channel_layer().send)(MAINTENANCE_CHANNEL, {
+                'type': 'duplicate.note',
+                'job_id': job['id'],
+                'share_history': share_history,
+            })
+        except Exception:
+            logger.exception("Could not queue duplication of note %s", source.pk)
+            _save_job({**job, 'status': 'failed'})
+    
+    transaction.on_commit(send)
+    return job
+
+
+def run_duplication(job_id, share_history=False):
+    """Worker entry point for a job queued by start_duplication()."""
+    job = get_job(job_id)
+    if job is None or job['status'] != 'queued':
+        return
+    
+    job['status'] = 'running'
+    _save_job(job)
+    
+    def progress(copied):
+        job['copied'] = copied
+        _save_job(job)
+    
+    try:
+        source = Note.objects.get(pk=job['source_id'])
+        owner = User.objects.get(pk=job['user_id'])
+        copy = duplicate_note(source, owner, share_history=share_history, progress=progress)
+    except Exception:
+        logger.exception("Could not duplicate note %s", job['source_id'])
+        job['status'] = 'failed'
+    else:
+        job['status'] = 'done'
+        job['note_id'] = str(copy.pk)
+    _save_job(job)
@@ -0,0 +1,69 @@
+import json
+import time
+import uuid
+from django.core.management.base import BaseCommand
+
+
+def _event(content_length):
+    return {
+        'type': 'block_updated',
+        'block_id': str(uuid.uuid4()),
+        'content': {'text': 'x' * content_length},
+        'user_id': '1',
+        'username': 'editor',
+        'sender_channel': 'specific.sender',
+    }
+
+
+def encode_per_recipient(event, recipients):
+    # What each consumer used to do in its group event handler
+    frames = []
+    for index in range(recipients):
+        channel = 'specific.sender' if index == 0 else f'specific.{index}'
+        if event['sender_channel'] != channel:
+            frames.append(json.dumps({
+                'type': event['type'],
+                'block_id': event['block_id'],
+                'content': event['content'],
+                'user_id': event['user_id'],
+                'username': event['username']
+            }))
+    return frames
+
+
+def encode_once(event, recipients):
+    frame = json.dumps({
+        'type': event['type'],
+        'block_id': event['block_id'],
+        'content': event['content'],
+        'user_id': event['user_id'],
+        'username': event['username']
+    })
+    return [frame] * (recipients - 1)
+
+
+class Command(BaseCommand):
+    help = 'Compare the JSON encode cost of one note broadcast, per recipient vs once'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=50)
+        parser.add_argument('--content-length', type=int, default=2000)
+        parser.add_argument('--iterations', type=int, default=2000)
+    
+    def handle(self, *args, **options):
+        event = _event(options['content_length'])
+        recipients = options['recipients']
+        iterations = options['iterations']
+        
+        results = {}
+        for name, encode in (('per recipient', encode_per_recipient), ('once', encode_once)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                encode(event, recipients)
+            results[name] = (time.perf_counter() - start) / iterations * 1e6
+            self.stdout.write(f'{name:>14}: {results[name]:9.1f} us per broadcast')
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'{recipients} recipients, {options["content_length"]} characters: '
+            f'{results["per recipient"] / results["once"]:.1f}x less encoding'
+        ))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from apps.notes.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'Delete change feed entries older than the retention period'
+    
+    def handle(self, *args, **options):
+        count = prune_changes()
+        self.stdout.write(f'{count} changes pruned')
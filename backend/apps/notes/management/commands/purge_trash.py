@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from apps.notes.trash import TRASH_SETTINGS, purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Delete notes and blocks that have been in the trash longer than the restore window'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=TRASH_SETTINGS['PURGE_BATCH'], help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=TRASH_SETTINGS['PURGE_PAUSE'], help='Seconds to sleep between batches')
+    
+    def handle(self, *args, **options):
+        TRASH_SETTINGS['PURGE_BATCH'] = options['batch_size']
+        TRASH_SETTINGS['PURGE_PAUSE'] = options['pause']
+        notes, blocks = purge_expired()
+        self.stdout.write(f'{notes} notes and {blocks} blocks purged')
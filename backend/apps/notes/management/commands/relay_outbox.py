@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from apps.notes.outbox import OUTBOX_SETTINGS, relay, relay_batch
+
+
+class Command(BaseCommand):
+    help = 'Send pending note operations from the outbox to the channel layer'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_SETTINGS['BATCH'], help='Messages sent per transaction')
+        parser.add_argument('--poll', type=float, default=OUTBOX_SETTINGS['POLL'], help='Seconds to wait when nothing is pending')
+        parser.add_argument('--once', action='store_true', help='Drain what is pending now and exit')
+    
+    def handle(self, *args, **options):
+        OUTBOX_SETTINGS['BATCH'] = options['batch_size']
+        OUTBOX_SETTINGS['POLL'] = options['poll']
+        if options['once']:
+            count = 0
+            while sent := relay_batch():
+                count += sent
+            self.stdout.write(f'{count} operations sent')
+            return
+        relay()
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:20
+
+from django.db import migrations
+
+
+def backfill_note_access(apps, schema_editor):
+    Note = apps.get_model('notes', 'Note')
+    NoteAccess = apps.get_model('notes', 'NoteAccess')
+    Membership = Note.collaborators.through
+    
+    owners = (
+        NoteAccess(user_id=owner_id, note_id=note_id, role='owner')
+        for note_id, owner_id in Note.objects.values_list('id', 'owner_id').iterator()
+    )
+    NoteAccess.objects.bulk_create(owners, batch_size=1000, ignore_conflicts=True)
+    
+    collaborators = (
+        NoteAccess(user_id=user_id, note_id=note_id, role='collaborator')
+        for note_id, user_id in Membership.objects.values_list('note_id', 'user_id').iterator()
+    )
+    NoteAccess.objects.bulk_create(collaborators, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0003_noteaccess'),
+    ]
+    
+    operations = [
+        migrations.RunPython(backfill_note_access, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0004_backfill_note_access'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='revision',
+            field=models.PositiveBigIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-18 03:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0006_trash'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('note', 'Note'), ('block', 'Block'), ('member', 'Member')], max_length=10)),
+                ('note_id', models.UUIDField()),
+                ('block_id', models.UUIDField(blank=True, null=True)),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['note_id', 'id'], name='notes_chang_note_id_ce3b65_idx'), models.Index(condition=models.Q(('user_id__isnull', False)), fields=['user_id', 'id'], name='notes_change_member_idx'), models.Index(fields=['created_at'], name='notes_chang_created_1d78e3_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-18 03:07
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0007_change_log'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('note_id', models.UUIDField()),
+                ('body', models.TextField()),
+                ('discard', models.JSONField(blank=True, default=list)),
+                ('sender', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True)),
+                ('seq', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('dispatched_at__isnull', True)), fields=['note_id', 'id'], name='notes_outbox_pending_idx'), models.Index(fields=['dispatched_at'], name='notes_outbo_dispatc_0e8e3c_idx')],
+            },
+        ),
+    ]
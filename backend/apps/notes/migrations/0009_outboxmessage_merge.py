@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0008_outbox'),
+    ]
+    
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='merge',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
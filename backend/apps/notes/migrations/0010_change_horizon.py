@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-18 03:55
+
+from django.db import migrations, models
+
+
+def seed_horizon(apps, schema_editor):
+    # Until now the oldest surviving change marked the pruned range
+    Change = apps.get_model('notes', 'Change')
+    ChangeHorizon = apps.get_model('notes', 'ChangeHorizon')
+    oldest = Change.objects.order_by('id').values_list('id', flat=True).first()
+    ChangeHorizon.objects.create(pk=1, pruned_through=oldest - 1 if oldest else 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0009_outboxmessage_merge'),
+    ]
+    
+    operations = [
+        migrations.CreateModel(
+            name='ChangeHorizon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pruned_through', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(seed_horizon, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,38 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 
+class NoteQuerySet(models.QuerySet):
+    def with_counts(self):
+        """Annotate blocks_count and collaborators_count in the same SELECT."""
+        Block = self.model._meta.get_field('blocks').related_model
+        Membership = self.model.collaborators.through
+        
+        blocks = Block.objects.filter(
+            note=OuterRef('pk')
+        ).order_by().values('note').annotate(count=Count('pk')).values('count')
+        collaborators = Membership.objects.filter(
+            note=OuterRef('pk')
+        ).order_by().values('note').annotate(count=Count('pk')).values('count')
+        
+        return self.annotate(
+            blocks_count=Coalesce(Subquery(blocks), 0),
+            collaborators_count=Coalesce(Subquery(collaborators), 0),
+        )
+
+
+class NoteManager(models.Manager.from_queryset(NoteQuerySet)):
+    def get_queryset(self):
+        # Notes in the trash are left out everywhere; see trash.py
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Note(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255, default="Untitled Note")
@@ -11,18 +40,229 @@ class Note(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='owned_notes')
     collaborators = models.ManyToManyField(User, blank=True, related_name='shared_notes')
+    # Advanced on every change to the note, its blocks or collaborators;
+    # see revisions.py
+    revision = models.PositiveBigIntegerField(default=1)
+    # Set while the note is in the trash
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = NoteManager()
+    # Includes notes in the trash
+    all_objects = NoteQuerySet.as_manager()
     
     class Meta:
         ordering = ['-updated_at']
         indexes = [
             models.Index(fields=['owner', '-updated_at']),
+            models.Index(
+                fields=['deleted_at'], 
+                condition=models.Q(deleted_at__isnull=False), 
+                name='notes_trashed_idx'
+            ),
         ]
     
     def __str__(self):
         return f"{self.title} by {self.owner.username}"
     
+    def save(self, *args, **kwargs):
+        # revision only moves through bump(); a full save of an instance
+        # loaded earlier would write its old value back
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields 
+                if not field.primary_key and field.name != 'revision'
+            ]
+        # post_save receivers log the change; they commit with the row
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+    
     def get_collaborators_count(self):
+        if hasattr(self, 'collaborators_count'):
+            return self.collaborators_count
         return self.collaborators.count()
     
     def get_blocks_count(self):
+        if hasattr(self, 'blocks_count'):
+            return self.blocks_count
         return self.blocks.count()
+
+
+
+class NoteAccess(models.Model):
+    """
+    Denormalized access index: one row per (user, note) with the user's role.
+    Kept in sync with Note.owner and Note.collaborators by the receivers
+    below; read through apps.notes.access.
+    """
+    ROLE_OWNER = 'owner'
+    ROLE_COLLABORATOR = 'collaborator'
+    ROLES = [
+        (ROLE_OWNER, 'Owner'),
+        (ROLE_COLLABORATOR, 'Collaborator'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='note_access')
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='access')
+    role = models.CharField(max_length=20, choices=ROLES)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        unique_together = ['user', 'note']
+        indexes = [
+            models.Index(fields=['note', 'role']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user} is {self.role} of {self.note_id}"
+
+
+class Change(models.Model):
+    """
+    Append-only log of writes: one row per changed note, block or membership,
+    numbered by id, for the change feed (see changes.py). Rows keep plain ids
+    so they outlive what they describe and deletions can be synced.
+    """
+    KIND_NOTE = 'note'
+    KIND_BLOCK = 'block'
+    KIND_MEMBER = 'member'
+    KINDS = [
+        (KIND_NOTE, 'Note'),
+        (KIND_BLOCK, 'Block'),
+        (KIND_MEMBER, 'Member'),
+    ]
+    
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=10, choices=KINDS)
+    note_id = models.UUIDField()
+    # Set for block changes
+    block_id = models.UUIDField(null=True, blank=True)
+    # Set for member changes: whose access to the note changed
+    user_id = models.IntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['note_id', 'id']),
+            models.Index(
+                fields=['user_id', 'id'], 
+                condition=models.Q(user_id__isnull=False), 
+                name='notes_change_member_idx'
+            ),
+            models.Index(fields=['created_at']),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.kind} {self.block_id or self.user_id or self.note_id}"
+
+
+class ChangeHorizon(models.Model):
+    """
+    A single row holding the highest Change id pruned so far. Cursors below
+    it have expired; gaps in the ids above it are rolled-back inserts.
+    """
+    pruned_through = models.BigIntegerField(default=0)
+
+
+class OutboxMessage(models.Model):
+    """
+    An operation frame for a note's collaborators, written in the same
+    transaction as the change it describes and sent once that commits
+    (see outbox.py).
+    """
+    id = models.BigAutoField(primary_key=True)
+    note_id = models.UUIDField()
+    # Encoded frame, without its seq
+    body = models.TextField()
+    # Blocks open sessions should reload from the database
+    discard = models.JSONField(default=list, blank=True)
+    # block id -> content fields open sessions should add to what they hold
+    merge = models.JSONField(default=dict, blank=True)
+    # Channel of the consumer that made the change; it is not sent the frame
+    sender = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # Operation number given on dispatch
+    seq = models.BigIntegerField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['note_id', 'id'], 
+                condition=models.Q(dispatched_at__isnull=True), 
+                name='notes_outbox_pending_idx'
+            ),
+            models.Index(fields=['dispatched_at']),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.note_id}"
+
+
+@receiver(post_save, sender=Note)
+def create_owner_access(sender, instance, created, **kwargs):
+    if created:
+        from .access import grant
+        grant(instance.owner_id, instance.pk, NoteAccess.ROLE_OWNER)
+
+
+@receiver(post_save, sender=Note)
+def bump_note_revision(sender, instance, created, **kwargs):
+    from .revisions import bump, invalidate_listings
+    if created:
+        invalidate_listings([instance.owner_id])
+    else:
+        bump([instance.pk])
+
+
+@receiver(post_save, sender=Note)
+def log_note_change(sender, instance, **kwargs):
+    from .changes import record_changes
+    record_changes(notes=[instance.pk])
+
+
+@receiver(pre_delete, sender=Note)
+def invalidate_note_listings(sender, instance, **kwargs):
+    from .changes import record_changes
+    from .revisions import invalidate_listings
+    user_ids = list(instance.access.values_list('user_id', flat=True))
+    invalidate_listings(user_ids)
+    # Logged per member too: once the access rows are gone, these are
+    # the only changes that still reach them
+    record_changes(notes=[instance.pk], members=[(instance.pk, user_id) for user_id in user_ids])
+
+
+@receiver(m2m_changed, sender=Note.collaborators.through)
+def sync_collaborator_access(sender, instance, action, reverse, pk_set, **kwargs):
+    from .access import grant_many, revoke_many
+    from .changes import record_changes
+    from .revisions import bump, invalidate_listings
+    
+    if action == 'pre_clear':
+        # pk_set is not provided for clear(), so remember the members now
+        if reverse:
+            note_ids = instance.shared_notes.values_list('pk', flat=True)
+            instance._cleared_access = [(instance.pk, note_id) for note_id in note_ids]
+        else:
+            user_ids = instance.collaborators.values_list('pk', flat=True)
+            instance._cleared_access = [(user_id, instance.pk) for user_id in user_ids]
+        return
+    
+    if action == 'post_clear':
+        pairs = getattr(instance, '_cleared_access', [])
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            pairs = [(instance.pk, note_id) for note_id in pk_set]
+        else:
+            pairs = [(user_id, instance.pk) for user_id in pk_set]
+    else:
+        return
+    
+    if action == 'post_add':
+        grant_many(pairs, NoteAccess.ROLE_COLLABORATOR)
+    else:
+        revoke_many(pairs, NoteAccess.ROLE_COLLABORATOR)
+    
+    bump({note_id for _, note_id in pairs})
+    # Removed users no longer show up in the note's access rows
+    invalidate_listings(user_id for user_id, _ in pairs)
+    record_changes(members=[(note_id, user_id) for user_id, note_id in pairs])
@@ -0,0 +1,134 @@
+"""
+Per-note operation log.
+
+Every operation broadcast on a note takes the next number of the note's
+sequence, which is written into the frame as its first key, and the frame
+is kept in a bounded log. A reconnecting client sends the last number it
+saw and gets only the frames it missed; if the log no longer reaches back
+that far it is sent a snapshot instead (see NoteConsumer.handle_resume).
+
+RedisOpLog keeps each note's log in a Redis stream that every process
+shares. MemoryOpLog is a single-process stand-in for development and tests.
+"""
+from collections import defaultdict, deque
+from django.conf import settings
+
+DEFAULTS = {
+    'BACKEND': 'memory',
+    # Frames kept per note
+    'MAX_LENGTH': 1000,
+    # Seconds an idle note's log is kept (Redis only)
+    'TTL': 24 * 60 * 60,
+    'URL': 'redis://127.0.0.1:6379/1',
+}
+
+OPLOG_SETTINGS = {**DEFAULTS, **getattr(settings, 'NOTE_OPLOG', {})}
+
+
+def _stamp(seq, body):
+    # `body` is an encoded JSON object; splice the sequence number in front
+    return '{"seq":%d,%s' % (seq, body[1:])
+
+
+class MemoryOpLog:
+    def __init__(self, max_length):
+        self.seqs = defaultdict(int)
+        self.frames = defaultdict(lambda: deque(maxlen=max_length))
+    
+    async def append(self, note_id, body):
+        """Log an encoded frame; returns (seq, frame with seq)."""
+        return self.append_sync(note_id, body)
+    
+    def append_sync(self, note_id, body):
+        seq = self.seqs[note_id] = self.seqs[note_id] + 1
+        frame = _stamp(seq, body)
+        self.frames[note_id].append((seq, frame))
+        return seq, frame
+    
+    async def current(self, note_id):
+        return self.seqs.get(note_id, 0)
+    
+    def current_sync(self, note_id):
+        return self.seqs.get(note_id, 0)
+    
+    async def since(self, note_id, seq):
+        """
+        Return (current seq, frames after `seq`), or (current seq, None) if
+        the log no longer holds all of them.
+        """
+        current = self.seqs.get(note_id, 0)
+        if seq > current:
+            return current, None
+        
+        frames = [(number, frame) for number, frame in self.frames[note_id] if number > seq]
+        if seq < current and (not frames or frames[0][0] != seq + 1):
+            return current, None
+        return current, [frame for _, frame in frames]
+
+
+class RedisOpLog:
+    # Numbering and logging happen in one step so that stream entry ids
+    # (<seq>-0) are always added in order, whichever process comes first
+    APPEND_SCRIPT = """
+        local seq = redis.call('INCR', KEYS[1])
+        local frame = '{"seq":' .. seq .. ',' .. string.sub(ARGV[1], 2)
+        redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'frame', frame)
+        redis.call('EXPIRE', KEYS[1], ARGV[3])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        return {seq, frame}
+    """
+    
+    def __init__(self, url, max_length, ttl):
+        import redis
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url, decode_responses=True)
+        # For synchronous callers such as REST views, which have no event
+        # loop of their own to share the async client with
+        self.sync_client = redis.from_url(url, decode_responses=True)
+        self.max_length = max_length
+        self.ttl = ttl
+        self._append = self.client.register_script(self.APPEND_SCRIPT)
+        self._append_sync = self.sync_client.register_script(self.APPEND_SCRIPT)
+    
+    def _keys(self, note_id):
+        return f'note-oplog:{note_id}:seq', f'note-oplog:{note_id}:frames'
+    
+    async def append(self, note_id, body):
+        seq, frame = await self._append(keys=self._keys(note_id), args=[body, self.max_length, self.ttl])
+        return int(seq), frame
+    
+    def append_sync(self, note_id, body):
+        seq, frame = self._append_sync(keys=self._keys(note_id), args=[body, self.max_length, self.ttl])
+        return int(seq), frame
+    
+    async def current(self, note_id):
+        return int(await self.client.get(self._keys(note_id)[0]) or 0)
+    
+    def current_sync(self, note_id):
+        return int(self.sync_client.get(self._keys(note_id)[0]) or 0)
+    
+    async def since(self, note_id, seq):
+        seq_key, frames_key = self._keys(note_id)
+        current = int(await self.client.get(seq_key) or 0)
+        if seq > current:
+            return current, None
+        if seq == current:
+            return current, []
+        
+        entries = await self.client.xrange(frames_key, min=f'{seq + 1}-0', max='+')
+        if not entries or entries[0][0] != f'{seq + 1}-0':
+            return current, None
+        return current, [fields['frame'] for _, fields in entries]
+
+
+_oplog = None
+
+
+def get_oplog():
+    global _oplog
+    if _oplog is None:
+        if OPLOG_SETTINGS['BACKEND'] == 'redis':
+            _oplog = RedisOpLog(OPLOG_SETTINGS['URL'], OPLOG_SETTINGS['MAX_LENGTH'], OPLOG_SETTINGS['TTL'])
+        else:
+            _oplog = MemoryOpLog(OPLOG_SETTINGS['MAX_LENGTH'])
+    return _oplog
@@ -0,0 +1,125 @@
+"""
+Transactional outbox for note operations.
+
+Every write that collaborators should hear about, from a REST view, a
+worker or NoteConsumer, adds its operation frame to OutboxMessage with
+announce(), in the same transaction as the write. A frame therefore
+exists exactly when its change committed. Writers lock the note row
+(bump()) before announcing, so a note's messages are numbered in commit
+order.
+
+Once the transaction commits, the writing process dispatches the note's
+pending messages itself: in id order, each is numbered and logged by the
+oplog, sent to the note group and marked dispatched. Whatever that misses
+(the process died, the channel layer was down) is sent by the relay,
+python manage.py relay_outbox, which drains pending messages in batches of
+BATCH and looks again every POLL seconds once there are none. Delivery is
+at least once: a frame sent just before a crash is sent again. Dispatched
+messages are pruned after RETENTION_HOURS.
+"""
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+from .models import OutboxMessage
+from .sessions import publish_operation_sync
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BATCH': 500,
+    # Seconds the relay waits when nothing is pending
+    'POLL': 1.0,
+    'RETENTION_HOURS': 24,
+}
+
+OUTBOX_SETTINGS = {**DEFAULTS, **getattr(settings, 'OUTBOX', {})}
+
+
+def announce(note_id, message_type, user=None, discard=(), merge=None, sender='', **fields):
+    """
+    Add an operation frame for the note's collaborators to the current
+    transaction; it is sent once that commits. Open sessions reload the
+    `discard` blocks and add the fields in `merge` ({block id: fields}) to
+    the content they hold. `sender` is the channel of a consumer that
+    already knows. Returns the OutboxMessage.
+    """
+    message = OutboxMessage.objects.create(
+        note_id=note_id,
+        body=JSONEncoder().encode({
+            'type': message_type,
+            **fields,
+            'user_id': str(user.id) if user is not None else None,
+            'username': user.username if user is not None else None
+        }),
+        discard=[str(block_id) for block_id in discard],
+        merge={str(block_id): block_fields for block_id, block_fields in (merge or {}).items()},
+        sender=sender or ''
+    )
+    transaction.on_commit(lambda: dispatch_note(note_id))
+    return message
+
+
+def _dispatch(messages):
+    now = timezone.now()
+    for message in messages:
+        message.seq = publish_operation_sync(
+            message.note_id, message.body, 
+            discard=message.discard, merge=message.merge, sender=message.sender
+        )
+        message.dispatched_at = now
+    OutboxMessage.objects.bulk_update(messages, ['seq', 'dispatched_at'])
+    return messages
+
+
+def dispatch_note(note_id):
+    """Send a note's pending messages, oldest first; returns how many were sent."""
+    try:
+        with transaction.atomic():
+            # Locked, not skipped: a concurrent dispatcher is waited for
+            # so frames never overtake each other
+            return len(_dispatch(list(
+                OutboxMessage.objects.select_for_update().filter(
+                    note_id=note_id, dispatched_at__isnull=True
+                ).order_by('id')
+            )))
+    except Exception:
+        # Left pending for the relay
+        logger.exception("Could not dispatch operations for note %s", note_id)
+        return 0
+
+
+def relay_batch():
+    """Send up to BATCH pending messages of any notes, oldest first; returns how many."""
+    with transaction.atomic():
+        return len(_dispatch(list(
+            OutboxMessage.objects.select_for_update().filter(
+                dispatched_at__isnull=True
+            ).order_by('id')[:OUTBOX_SETTINGS['BATCH']]
+        )))
+
+
+def sent_seq(message):
+    """The seq a message was sent with, or None while it is pending."""
+    return OutboxMessage.objects.filter(pk=message.pk).values_list('seq', flat=True).first()
+
+
+def prune_outbox():
+    cutoff = timezone.now() - timedelta(hours=OUTBOX_SETTINGS['RETENTION_HOURS'])
+    count, _ = OutboxMessage.objects.filter(dispatched_at__lt=cutoff).delete()
+    return count
+
+
+def relay(stop=None):
+    """Drain the outbox until `stop()` returns true (never, by default)."""
+    while not (stop and stop()):
+        try:
+            if relay_batch():
+                continue
+            prune_outbox()
+        except Exception:
+            logger.exception("Outbox relay failed; retrying")
+        time.sleep(OUTBOX_SETTINGS['POLL'])
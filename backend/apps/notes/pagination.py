@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+
+class NoteCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (-updated_at, id). Each page is a single indexed
+    range scan with no COUNT(*), so deep pages cost the same as the first.
+    """
+    ordering = ('-updated_at', 'id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
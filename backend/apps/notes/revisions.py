@@ -0,0 +1,109 @@
+"""
+Validators for conditional GETs.
+
+Note.revision goes up with every change to a note, its blocks or its
+collaborators, so a request for one note is answered with 304 after a single
+indexed lookup. Lists are validated with a per-user token kept in the cache
+and dropped whenever a note the user can see changes in a way lists show;
+a missing token is replaced with a new one, so losing the cache only costs
+full responses. With read replicas, a dropped token is marked STALE until
+they have caught up; lists read from a replica meanwhile get a token of
+their own that no later response matches.
+"""
+import hashlib
+import uuid
+from django.db import transaction
+from django.db.models import F
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+from config.replicas import REPLICA_SETTINGS, REPLICAS, reading_from_replica
+from .models import Note, NoteAccess
+
+# Listing token of a user whose lists changed while replicas catch up
+STALE = 'stale'
+
+
+def _listing_key(user_id):
+    return f'note-listing:{user_id}'
+
+
+def bump(note_ids, listing=True):
+    """
+    Advance the revision of the given notes. `listing=False` is for changes
+    that lists do not show, such as edits to block content.
+    """
+    note_ids = list(note_ids)
+    if not note_ids:
+        return
+    Note.objects.filter(pk__in=note_ids).update(revision=F('revision') + 1)
+    if listing:
+        invalidate_listings(
+            NoteAccess.objects.filter(note_id__in=note_ids).values_list('user_id', flat=True)
+        )
+
+
+def invalidate_listings(user_ids):
+    keys = [_listing_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        # After commit, or a concurrent request could store a fresh token
+        # alongside data that is about to change
+        transaction.on_commit(lambda: _expire_listings(keys))
+
+
+def _expire_listings(keys):
+    if REPLICAS:
+        # Marked for as long as replicas may still serve the old lists
+        cache.set_many({key: STALE for key in keys}, REPLICA_SETTINGS['STICKY_SECONDS'])
+    else:
+        cache.delete_many(keys)
+
+
+def listing_token(user):
+    key = _listing_key(user.pk)
+    token = cache.get(key)
+    if token == STALE:
+        if reading_from_replica():
+            # Good for this response only
+            return uuid.uuid4().hex
+        token = uuid.uuid4().hex
+        cache.set(key, token, timeout=None)
+    elif token is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        token = cache.get(key)
+    return token
+
+
+def note_revision(user, note_id):
+    """The note's revision, or None if it does not exist or the user has no access."""
+    try:
+        note_id = uuid.UUID(str(note_id))
+    except (TypeError, ValueError):
+        return None
+    return NoteAccess.objects.filter(
+        user_id=user.pk, note_id=note_id, note__deleted_at__isnull=True
+    ).values_list('note__revision', flat=True).first()
+
+
+def make_etag(request, *parts):
+    # The same resource renders differently per ?page, ?fields, ?expand...
+    parts = [request.user.pk, request.path, request.query_params.urlencode(), *parts]
+    return quote_etag(hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest())
+
+
+def not_modified(request, etag):
+    """A 304 response if the client already holds `etag`, else None."""
+    held = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in held or '*' in held:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        return set_etag(response, etag)
+    return None
+
+
+def set_etag(response, etag):
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        response['ETag'] = etag
+        # Cacheable, but always revalidated
+        response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -2,6 +2,7 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import Note
 from apps.blocks.models import Block
+from .sparse import SparseFieldsetMixin
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -27,13 +28,13 @@ class BlockPreviewSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Block
-        fields = ['id', 'block_type', 'content_preview', 'order', 'updated_at']
+        fields = ['id', 'block_type', 'content_preview', 'position', 'updated_at']
     
     def get_content_preview(self, obj):
         return obj.get_content_preview()
 
 
-class NoteSerializer(serializers.ModelSerializer):
+class NoteSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     owner = UserSerializer(read_only=True)
     collaborators = UserSerializer(many=True, read_only=True)
     collaborators_count = serializers.SerializerMethodField()
@@ -60,18 +61,40 @@ class NoteSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class NoteListSerializer(serializers.ModelSerializer):
+class NoteBootstrapSerializer(serializers.ModelSerializer):
     owner = UserSerializer(read_only=True)
     collaborators_count = serializers.SerializerMethodField()
     blocks_count = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Note
+        fields = [
+            'id', 'title', 'created_at', 'updated_at', 'owner',
+            'collaborators_count', 'blocks_count'
+        ]
+    
+    def get_collaborators_count(self, obj):
+        return obj.get_collaborators_count()
+    
+    def get_blocks_count(self, obj):
+        return obj.get_blocks_count()
+
+
+class NoteListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    owner = UserSerializer(read_only=True)
+    # Only with ?expand=collaborators
+    collaborators = UserSerializer(many=True, read_only=True)
+    collaborators_count = serializers.SerializerMethodField()
+    blocks_count = serializers.SerializerMethodField()
     last_modified = serializers.DateTimeField(source='updated_at', read_only=True)
     
     class Meta:
         model = Note
         fields = [
             'id', 'title', 'created_at', 'last_modified', 'owner',
-            'collaborators_count', 'blocks_count'
+            'collaborators_count', 'blocks_count', 'collaborators'
         ]
+        expandable_fields = ['collaborators']
     
     def get_collaborators_count(self, obj):
         return obj.get_collaborators_count()
@@ -80,6 +103,22 @@ class NoteListSerializer(serializers.ModelSerializer):
         return obj.get_blocks_count()
 
 
+class NoteTrashSerializer(NoteListSerializer):
+    deleted_at = serializers.DateTimeField(read_only=True)
+    
+    class Meta(NoteListSerializer.Meta):
+        fields = NoteListSerializer.Meta.fields + ['deleted_at']
+
+
+class NoteSearchResultSerializer(NoteListSerializer):
+    rank = serializers.FloatField(source='search_hit.rank', read_only=True)
+    snippet = serializers.CharField(source='search_hit.snippet', read_only=True)
+    matched_block = serializers.UUIDField(source='search_hit.block_id', read_only=True, allow_null=True)
+    
+    class Meta(NoteListSerializer.Meta):
+        fields = NoteListSerializer.Meta.fields + ['rank', 'snippet', 'matched_block']
+
+
 class CollaboratorSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
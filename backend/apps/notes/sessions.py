@@ -0,0 +1,692 @@
+"""
+In-memory editing sessions for notes.
+
+A NoteSession is shared by every NoteConsumer of one note in this process.
+Block edits are applied to the session and broadcast right away; the
+session writes dirty blocks back to the database in batches: on a timer,
+once editing goes idle, when a batch fills up and when the last editor
+leaves. Edits to one block by one user are folded into a single
+BlockVersion per editing burst instead of one row per keystroke.
+
+The session is also the note's broadcast point in this process. A frame
+is JSON-encoded once by its sender, handed straight to the other local
+consumers and sent once to the note group, whose only members are the
+sessions of each process. Every process forwards it to its own consumers,
+except the origin, which has already done so. Operations that write to
+the database go out through the outbox (outbox.py) once they commit.
+
+Text blocks can also be edited with block_patch operations (see
+apps.blocks.textops). The session numbers the patches of each block,
+transforms a patch made against an older number over the ones applied
+since, and splices it into the in-memory text. Only the operations are
+broadcast; the full content reaches the database with the next flush.
+
+Cursor and selection events are not forwarded one by one. The session
+keeps the latest of each per user and publishes them together as a single
+presence_update frame once per PRESENCE_TICK, so channel layer traffic
+follows the tick rate rather than the rate of mouse events.
+
+Sessions outlive their last consumer by a short grace period so that
+reconnecting editors pick up the same session.
+
+Patch numbers, patch history and unsaved text exist only in the session,
+so a note is edited through one process at a time. The session holding a
+note takes a lease on it in the shared cache and renews it every
+LEASE / 3 seconds. A process whose connection finds the lease held by
+another process's session raises SessionElsewhere, and the consumer
+closes the connection. The proxy in front of the ASGI processes must
+route /ws/notes/<note id>/ by note id (e.g. nginx `hash $uri consistent`)
+so that a note's editors reach the same process. When a lease is lost to
+another process, the session saves its edits and disconnects its
+editors.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from apps.blocks.deltas import content_hash
+from apps.blocks.models import Block
+from apps.blocks.textops import TEXT_FIELDS, apply_ops, parse_ops, to_wire, transform
+from apps.blocks.versioning import latest_version, prepare_version
+from apps.search.backends import get_backend
+from .changes import record_changes
+from .oplog import get_oplog
+from .revisions import bump
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # Longest time (seconds) an edit stays unsaved while editing continues
+    'FLUSH_INTERVAL': 2.0,
+    # Flush this long (seconds) after the last edit
+    'IDLE_DELAY': 0.5,
+    # Blocks written per transaction; a session with this many dirty
+    # blocks flushes immediately
+    'MAX_BATCH': 200,
+    # Pause (seconds) after which further edits start a new version
+    'BURST_GAP': 30.0,
+    # Patches kept per block to transform late ones against
+    'PATCH_HISTORY': 200,
+    # Seconds a session stays open after its last consumer disconnects
+    'GRACE_PERIOD': 10.0,
+    # Cursor and selection updates are batched into one frame per tick
+    'PRESENCE_TICK': 0.05,
+    # Seconds a process's hold on a note outlives its last renewal
+    'LEASE': 30.0,
+    # Seconds between re-joins of the note group, well inside the channel
+    # layer's group_expiry (a day for channels_redis)
+    'GROUP_REFRESH': 3600.0,
+}
+
+SESSION_SETTINGS = {**DEFAULTS, **getattr(settings, 'NOTE_SESSION', {})}
+
+# First and longest wait (seconds) before receiving again after an error
+RECEIVE_BACKOFF = (0.1, 5.0)
+
+# Close code for connections to a note held by another process's session
+SESSION_ELSEWHERE_CODE = 4409
+
+
+class SessionElsewhere(Exception):
+    """The note is being edited through another process's session."""
+
+
+class PatchRejected(Exception):
+    def __init__(self, message, seq=None, content=None):
+        super().__init__(message)
+        # Current state, for the client to resynchronise from
+        self.seq = seq
+        self.content = content
+
+
+class _PatchLog:
+    __slots__ = ('seq', 'history')
+    
+    def __init__(self, size):
+        self.seq = 0
+        # (seq, ops) of the latest patches
+        self.history = deque(maxlen=size)
+
+
+class _Edit:
+    __slots__ = ('content', 'user', 'edited_at')
+    
+    def __init__(self, content, user, edited_at):
+        self.content = content
+        self.user = user
+        self.edited_at = edited_at
+
+
+class _Burst:
+    """The version row that edits to a block are currently folded into."""
+    __slots__ = ('user_id', 'base', 'base_content', 'version', 'last_edit')
+    
+    def __init__(self, user_id, base, base_content, last_edit):
+        self.user_id = user_id
+        # Version the burst started from, and its content
+        self.base = base
+        self.base_content = base_content
+        # Row written for this burst so far, if any
+        self.version = None
+        self.last_edit = last_edit
+
+
+class NoteSession:
+    def __init__(self, note_id, options=None):
+        self.note_id = str(note_id)
+        self.group_name = f'note_{self.note_id}'
+        self.options = {**SESSION_SETTINGS, **(options or {})}
+        self.consumers = set()
+        
+        # block id -> content as last read from or written to the database
+        self.persisted = {}
+        self.block_types = {}
+        self.dirty = {}
+        # Edits being written by the running flush
+        self.flushing = {}
+        self.bursts = {}
+        self.patch_logs = {}
+        
+        self._flush_lock = asyncio.Lock()
+        self._interval_handle = None
+        self._idle_handle = None
+        self._close_handle = None
+        self._tasks = set()
+        
+        # user id -> latest cursor and selection, sent on the next tick
+        self.presence = {}
+        self._presence_senders = set()
+        self._presence_handle = None
+        
+        self.channel_layer = get_channel_layer()
+        self.channel_name = None
+        self.lease_key = f'note-session:{self.note_id}'
+        self._receiver = None
+        self._renewer = None
+        self._subscribe_lock = asyncio.Lock()
+        # Keeps locally published operations in sequence order
+        self._publish_lock = asyncio.Lock()
+    
+    # Editing
+    async def update_block(self, block_id, content, user):
+        """
+        Replace a block's content in memory. Returns the block's new patch
+        sequence number, or None if the block is not in this note.
+        """
+        block_id = str(block_id)
+        if not await self._ensure_loaded(block_id):
+            return None
+        
+        # Patches made against the old content can no longer be transformed
+        log = self._patch_log(block_id)
+        log.seq += 1
+        log.history.clear()
+        
+        self._mark_dirty(block_id, content, user)
+        return log.seq
+    
+    async def patch_block(self, block_id, base_seq, raw_ops, user):
+        """
+        Apply text operations made against patch `base_seq` of a block.
+        Returns (seq, ops) with the operations as applied, or raises
+        PatchRejected.
+        """
+        block_id = str(block_id)
+        if not await self._ensure_loaded(block_id):
+            raise PatchRejected("Block not found")
+        
+        content = self.current_content(block_id)
+        field = TEXT_FIELDS.get(self.block_types[block_id])
+        if field is None:
+            raise PatchRejected("Block type has no text to patch", content=content)
+        log = self._patch_log(block_id)
+        
+        oldest = log.history[0][0] - 1 if log.history else log.seq
+        if not isinstance(base_seq, int) or not oldest <= base_seq <= log.seq:
+            raise PatchRejected("Unknown base_seq", log.seq, content)
+        
+        try:
+            ops = parse_ops(raw_ops)
+            for seq, applied in log.history:
+                if seq > base_seq:
+                    ops, _ = transform(ops, applied)
+            text = apply_ops(content.get(field) or '', ops)
+        except ValueError as error:
+            raise PatchRejected(str(error), log.seq, content)
+        
+        log.seq += 1
+        log.history.append((log.seq, ops))
+        self._mark_dirty(block_id, {**content, field: text}, user)
+        return log.seq, to_wire(ops)
+    
+    def current_content(self, block_id):
+        edit = self.dirty.get(block_id) or self.flushing.get(block_id)
+        return edit.content if edit is not None else self.persisted.get(block_id)
+    
+    def patch_seqs(self):
+        return {block_id: log.seq for block_id, log in self.patch_logs.items()}
+    
+    def discard(self, block_id):
+        """Forget a block, e.g. once it has been deleted."""
+        block_id = str(block_id)
+        self.dirty.pop(block_id, None)
+        self.persisted.pop(block_id, None)
+        self.block_types.pop(block_id, None)
+        self.bursts.pop(block_id, None)
+        self.patch_logs.pop(block_id, None)
+    
+    def merge(self, block_id, fields):
+        """
+        Add fields written outside the session, e.g. image variants, to a
+        block's content without dropping unsaved edits.
+        """
+        block_id = str(block_id)
+        if block_id in self.persisted:
+            self.persisted[block_id] = {**self.persisted[block_id], **fields}
+        for edits in (self.dirty, self.flushing):
+            edit = edits.get(block_id)
+            if edit is not None:
+                edit.content = {**edit.content, **fields}
+    
+    def _patch_log(self, block_id):
+        log = self.patch_logs.get(block_id)
+        if log is None:
+            log = self.patch_logs[block_id] = _PatchLog(self.options['PATCH_HISTORY'])
+        return log
+    
+    def _mark_dirty(self, block_id, content, user):
+        self.dirty[block_id] = _Edit(content, user, time.monotonic())
+        
+        if len(self.dirty) >= self.options['MAX_BATCH']:
+            self._spawn_flush()
+        else:
+            self._schedule_flushes()
+    
+    async def _ensure_loaded(self, block_id):
+        if block_id in self.persisted:
+            return True
+        
+        row = await database_sync_to_async(self._load_block)(block_id)
+        if row is None:
+            return False
+        if block_id not in self.persisted:
+            self.block_types[block_id], self.persisted[block_id] = row
+        return True
+    
+    def _load_block(self, block_id):
+        try:
+            return Block.objects.filter(
+                id=block_id, note_id=self.note_id
+            ).values_list('block_type', 'content').first()
+        except ValidationError:
+            # Not a valid block id
+            return None
+    
+    # Scheduling
+    def _schedule_flushes(self):
+        loop = asyncio.get_running_loop()
+        
+        # The idle timer restarts on every edit; the interval timer does not,
+        # so continuous typing is still saved every FLUSH_INTERVAL
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        self._idle_handle = loop.call_later(self.options['IDLE_DELAY'], self._spawn_flush)
+        
+        if self._interval_handle is None:
+            self._interval_handle = loop.call_later(self.options['FLUSH_INTERVAL'], self._spawn_flush)
+    
+    def _cancel_timers(self):
+        for handle in (self._idle_handle, self._interval_handle):
+            if handle is not None:
+                handle.cancel()
+        self._idle_handle = None
+        self._interval_handle = None
+    
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def _spawn_flush(self):
+        self._spawn(self.flush())
+    
+    # Flushing
+    async def flush(self):
+        """Write every dirty block to the database."""
+        async with self._flush_lock:
+            self._cancel_timers()
+            while self.dirty:
+                batch = {}
+                for block_id in list(self.dirty)[:self.options['MAX_BATCH']]:
+                    batch[block_id] = self.dirty.pop(block_id)
+                
+                self.flushing = batch
+                try:
+                    await database_sync_to_async(self._write)(batch)
+                except Exception:
+                    logger.exception("Could not save blocks of note %s", self.note_id)
+                    # Keep the edits unless newer ones arrived meanwhile
+                    for block_id, edit in batch.items():
+                        self.dirty.setdefault(block_id, edit)
+                    if self.consumers:
+                        self._schedule_flushes()
+                    return
+                finally:
+                    self.flushing = {}
+    
+    def _write(self, batch):
+        # images -> outbox -> sessions
+        from apps.blocks.images import variant_fields
+        from .outbox import announce
+        
+        now = timezone.now()
+        with transaction.atomic():
+            existing = set(
+                str(pk) for pk in Block.objects.filter(note_id=self.note_id, id__in=batch).values_list('id', flat=True)
+            )
+            blocks = []
+            added = {}
+            for block_id, edit in batch.items():
+                if block_id not in existing:
+                    continue
+                # Image variants made while the block was being edited
+                fields = variant_fields(self.block_types.get(block_id), edit.content)
+                if fields:
+                    edit.content = {**edit.content, **fields}
+                    added[block_id] = fields
+                blocks.append(Block(id=block_id, note_id=self.note_id, content=edit.content, updated_at=now))
+            
+            Block.objects.bulk_update(blocks, ['content', 'updated_at'])
+            if blocks:
+                bump([self.note_id], listing=False)
+                record_changes(blocks=[(self.note_id, block.id) for block in blocks])
+            for block in blocks:
+                self._record_version(str(block.id), batch[str(block.id)])
+            for block_id, fields in added.items():
+                announce(
+                    self.note_id, 'block_updated', 
+                    merge={block_id: fields}, block_id=block_id, content=batch[block_id].content
+                )
+        
+        # bulk_update sends no post_save, so index the blocks here
+        get_backend().index_blocks(Block.objects.filter(id__in=[block.id for block in blocks]))
+        
+        for block_id in batch:
+            if block_id in existing:
+                self.persisted[block_id] = batch[block_id].content
+            else:
+                self.discard(block_id)
+    
+    def _record_version(self, block_id, edit):
+        burst = self.bursts.get(block_id)
+        latest = latest_version(block_id)
+        
+        continues = False
+        if burst is not None:
+            expected = burst.version or burst.base
+            continues = (
+                burst.user_id == edit.user.pk
+                and edit.edited_at - burst.last_edit < self.options['BURST_GAP']
+                # Someone else (e.g. the REST API) may have added a version since
+                and getattr(latest, 'pk', None) == getattr(expected, 'pk', None)
+            )
+        if not continues:
+            burst = _Burst(edit.user.pk, latest, self.persisted.get(block_id), edit.edited_at)
+            self.bursts[block_id] = burst
+        burst.last_edit = edit.edited_at
+        
+        if burst.version is not None and burst.version.content_hash == content_hash(edit.content):
+            return
+        
+        version = prepare_version(
+            block_id,
+            edit.content,
+            edit.user,
+            latest=burst.base,
+            previous_content=burst.base_content
+        )
+        if version is None:
+            # The burst ended where it started
+            if burst.version is not None:
+                burst.version.delete()
+                burst.version = None
+            return
+        
+        if burst.version is not None:
+            # Fold this flush into the burst's row
+            version.pk = burst.version.pk
+            version.save(force_update=True)
+        else:
+            version.save()
+        burst.version = version
+    
+    # Broadcasting
+    async def publish(self, frame, sender=None):
+        """Send an encoded frame to everyone on the note except `sender`."""
+        await self.deliver(frame, exclude=sender)
+        await self.channel_layer.group_send(self.group_name, {
+            'type': 'note.frame',
+            'frame': frame,
+            'origin': self.channel_name,
+        })
+    
+    async def publish_operation(self, body, sender=None):
+        """
+        Number an encoded operation frame, log it for reconnecting clients
+        and publish it. Returns its sequence number.
+        """
+        async with self._publish_lock:
+            seq, frame = await get_oplog().append(self.note_id, body)
+            await self.publish(frame, sender=sender)
+        return seq
+    
+    async def operations_since(self, seq):
+        """(current seq, missed frames), with None for frames past the log."""
+        return await get_oplog().since(self.note_id, seq)
+    
+    async def current_seq(self):
+        return await get_oplog().current(self.note_id)
+    
+    async def deliver(self, frame, exclude=None):
+        for consumer in list(self.consumers):
+            if consumer is not exclude:
+                await consumer.send(text_data=frame)
+    
+    # Presence
+    def update_presence(self, consumer, **fields):
+        """Record a user's latest cursor or selection for the next presence tick."""
+        user_id = str(consumer.user.id)
+        entry = self.presence.setdefault(user_id, {
+            'user_id': user_id,
+            'username': consumer.user.username
+        })
+        entry.update(fields)
+        self._presence_senders.add(consumer)
+        
+        if self._presence_handle is None:
+            self._presence_handle = asyncio.get_running_loop().call_later(
+                self.options['PRESENCE_TICK'], self._presence_tick
+            )
+    
+    def _presence_tick(self):
+        self._presence_handle = None
+        users = list(self.presence.values())
+        senders = self._presence_senders
+        self.presence = {}
+        self._presence_senders = set()
+        
+        if users:
+            frame = json.dumps({'type': 'presence_update', 'users': users})
+            # A lone sender does not need its own movements echoed back
+            sender = next(iter(senders)) if len(senders) == 1 else None
+            self._spawn(self.publish(frame, sender=sender))
+    
+    async def _subscribe(self):
+        async with self._subscribe_lock:
+            if self.channel_name is not None:
+                return
+            channel_name = await self.channel_layer.new_channel()
+            if not await self._claim(channel_name):
+                raise SessionElsewhere(f"Note {self.note_id} is open in another process")
+            self.channel_name = channel_name
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            self._receiver = asyncio.ensure_future(self._receive_frames())
+            self._renewer = asyncio.ensure_future(self._renew_lease())
+    
+    async def _unsubscribe(self):
+        async with self._subscribe_lock:
+            if self.channel_name is None:
+                return
+            self._receiver.cancel()
+            self._renewer.cancel()
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await self._release_lease()
+            self.channel_name = None
+            self._receiver = None
+            self._renewer = None
+    
+    # Lease
+    async def _claim(self, channel_name):
+        for _ in range(2):
+            if await cache.aadd(self.lease_key, channel_name, self.options['LEASE']):
+                return True
+            holder = await cache.aget(self.lease_key)
+            if holder is not None:
+                return holder == channel_name
+            # Expired in between; try again
+        return False
+    
+    async def _renew_lease(self):
+        joined = time.monotonic()
+        while True:
+            await asyncio.sleep(self.options['LEASE'] / 3)
+            try:
+                if time.monotonic() - joined >= self.options['GROUP_REFRESH']:
+                    # The channel layer drops group members after group_expiry
+                    await self.channel_layer.group_add(self.group_name, self.channel_name)
+                    joined = time.monotonic()
+                holder = await cache.aget(self.lease_key)
+                if holder == self.channel_name:
+                    await cache.atouch(self.lease_key, self.options['LEASE'])
+                    continue
+                if holder is None and await self._claim(self.channel_name):
+                    continue
+            except Exception:
+                logger.exception("Could not renew the session lease of note %s", self.note_id)
+                continue
+            
+            logger.warning("Note %s is now edited through another process", self.note_id)
+            await self.flush()
+            for consumer in list(self.consumers):
+                await consumer.close(code=SESSION_ELSEWHERE_CODE)
+            return
+    
+    async def _release_lease(self):
+        try:
+            if await cache.aget(self.lease_key) == self.channel_name:
+                await cache.adelete(self.lease_key)
+        except Exception:
+            # It expires on its own
+            logger.exception("Could not release the session lease of note %s", self.note_id)
+    
+    async def _receive_frames(self):
+        backoff = RECEIVE_BACKOFF[0]
+        while True:
+            try:
+                message = await self.channel_layer.receive(self.channel_name)
+            except Exception:
+                # The channel layer is down; keep the session listening
+                logger.exception("Could not receive frames for note %s; retrying", self.note_id)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, RECEIVE_BACKOFF[1])
+                continue
+            backoff = RECEIVE_BACKOFF[0]
+            if message.get('origin') == self.channel_name:
+                # Already delivered locally by publish()
+                continue
+            for block_id in message.get('discard', ()):
+                # Changed outside the session; reload from the database
+                self.discard(block_id)
+            for block_id, fields in message.get('merge', {}).items():
+                self.merge(block_id, fields)
+            sender = message.get('sender')
+            exclude = next((consumer for consumer in self.consumers if sender and consumer.channel_name == sender), None)
+            try:
+                await self.deliver(message['frame'], exclude=exclude)
+            except Exception:
+                logger.exception("Could not deliver a frame for note %s", self.note_id)
+    
+    # Lifecycle
+    async def acquire(self, consumer):
+        self.consumers.add(consumer)
+        if self._close_handle is not None:
+            self._close_handle.cancel()
+            self._close_handle = None
+        await self._subscribe()
+    
+    async def release(self, consumer):
+        self.consumers.discard(consumer)
+        if self.consumers:
+            return
+        
+        await self.flush()
+        if not self.consumers and self._close_handle is None:
+            self._close_handle = asyncio.get_running_loop().call_later(
+                self.options['GRACE_PERIOD'], self._close
+            )
+    
+    def _close(self):
+        self._close_handle = None
+        if self.consumers:
+            return
+        if self.dirty:
+            # An earlier flush failed; try again before letting go
+            self._spawn_flush()
+            self._close_handle = asyncio.get_running_loop().call_later(
+                self.options['GRACE_PERIOD'], self._close
+            )
+        else:
+            if _sessions.get(self.note_id) is self:
+                del _sessions[self.note_id]
+            self._spawn(self._unsubscribe())
+
+
+_sessions = {}
+
+
+async def open_session(note_id, consumer):
+    """
+    Attach a consumer to this process's session for the note, creating it
+    if needed. Raises SessionElsewhere if another process holds the note.
+    """
+    session = _sessions.get(str(note_id))
+    if session is None:
+        session = _sessions[str(note_id)] = NoteSession(note_id)
+    try:
+        await session.acquire(consumer)
+    except SessionElsewhere:
+        session.consumers.discard(consumer)
+        if not session.consumers and _sessions.get(session.note_id) is session:
+            del _sessions[session.note_id]
+        raise
+    return session
+
+
+async def close_all():
+    """Flush every open session and give up its lease, before the process shuts down."""
+    for session in list(_sessions.values()):
+        await session.flush()
+        await session._release_lease()
+
+
+def close_all_sync():
+    """
+    Write every session's unsaved edits and give up its lease from outside
+    the event loop, once it has stopped; for servers that exit without a
+    lifespan shutdown.
+    """
+    for session in list(_sessions.values()):
+        # Includes a flush the stopped loop never finished
+        edits = {**session.flushing, **session.dirty}
+        session.dirty, session.flushing = {}, {}
+        block_ids = list(edits)
+        for start in range(0, len(block_ids), session.options['MAX_BATCH']):
+            batch = {block_id: edits[block_id] for block_id in block_ids[start:start + session.options['MAX_BATCH']]}
+            try:
+                session._write(batch)
+            except Exception:
+                logger.exception("Could not save blocks of note %s", session.note_id)
+        try:
+            if session.channel_name is not None and cache.get(session.lease_key) == session.channel_name:
+                cache.delete(session.lease_key)
+        except Exception:
+            logger.exception("Could not release the session lease of note %s", session.note_id)
+
+
+def publish_operation_sync(note_id, body, discard=(), merge=None, sender=''):
+    """
+    Number, log and publish an operation frame from outside any session,
+    e.g. the outbox. Sessions forget the `discard` blocks and merge the
+    fields in `merge` into their blocks before passing the frame on, and
+    skip the consumer on channel `sender`. Returns the frame's sequence
+    number.
+    """
+    seq, frame = get_oplog().append_sync(str(note_id), body)
+    async_to_sync(get_channel_layer().group_send)(f'note_{note_id}', {
+        'type': 'note.frame',
+        'frame': frame,
+        'origin': None,
+        'discard': [str(block_id) for block_id in discard],
+        'merge': {str(block_id): fields for block_id, fields in (merge or {}).items()},
+        'sender': sender,
+    })
+    return seq
@@ -0,0 +1,48 @@
+"""
+Sparse fieldsets for API responses.
+
+    ?fields=id,title     only these fields
+    ?expand=versions     also these optional fields (Meta.expandable_fields)
+
+Both apply to the top-level serializer of a response only, and only to what
+is rendered; writable fields are still validated and saved as usual.
+"""
+from rest_framework.serializers import ListSerializer
+
+
+def requested(request, param):
+    """Names listed in a comma-separated query parameter, or None if absent."""
+    if request is None:
+        return None
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def field_wanted(request, name, expandable=False):
+    """Whether the response will include `name`; lets views skip prefetches."""
+    fields = requested(request, 'fields')
+    expand = requested(request, 'expand') or set()
+    if expandable and name not in expand and not (fields and name in fields):
+        return False
+    return fields is None or name in fields or name in expand
+
+
+class SparseFieldsetMixin:
+    def _is_top_level(self):
+        parent = self.parent
+        return parent is None or isinstance(parent, ListSerializer) and parent.parent is None
+    
+    @property
+    def _readable_fields(self):
+        names = getattr(self, '_sparse_names', None)
+        if names is None:
+            request = self.context.get('request') if self._is_top_level() else None
+            expandable = getattr(self.Meta, 'expandable_fields', ())
+            names = self._sparse_names = [
+                field_name for field_name, field in self.fields.items()
+                if not field.write_only and field_wanted(request, field_name, field_name in expandable)
+            ]
+        for field_name in names:
+            yield self.fields[field_name]
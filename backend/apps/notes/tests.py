@@ -1,3 +1,672 @@
-from django.test import TestCase
+import asyncio
+import json
+import uuid
+from datetime import timedelta
+from unittest import mock
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
+from apps.blocks.models import Block, BlockVersion
+from apps.blocks.versioning import reconstruct, record_version
+from config import instrumentation, replicas
+from config.replicas import ReplicaRouter
+from . import oplog, outbox, sessions, trash
+from .access import get_role, has_access
+from .changes import encode_cursor, prune_changes
+from .models import Change, ChangeHorizon, Note, NoteAccess, OutboxMessage
+from .routing import websocket_urlpatterns
 
-# Create your tests here.
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReplicaRoutingTests(APITransactionTestCase):
+    """
+    Which alias the router picks for reads. Under the test runner a replica
+    is a TEST MIRROR of the primary, so the queries themselves always run
+    on the primary; the router's choice is recorded instead. Transaction
+    tests, since reads inside a transaction never go to a replica.
+    """
+    
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.note = Note.objects.create(title='Shared', owner=self.user)
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        
+        self.routed = []
+        choose = ReplicaRouter.db_for_read
+        
+        def db_for_read(router, model, **hints):
+            self.routed.append(choose(router, model, **hints))
+            return DEFAULT_DB_ALIAS
+        
+        for patcher in (
+            mock.patch.object(replicas, 'REPLICAS', ['replica1']),
+            mock.patch.object(ReplicaRouter, 'db_for_read', db_for_read),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    def get(self, url):
+        self.routed.clear()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.routed)
+        return set(self.routed)
+    
+    def test_safe_request_reads_from_replica(self):
+        self.assertEqual(self.get('/api/notes/'), {'replica1'})
+    
+    def test_write_sticks_client_to_primary(self):
+        response = self.client.post('/api/notes/', {'title': 'New'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get('/api/notes/'), {DEFAULT_DB_ALIAS})
+    
+    def test_sticky_until_expiry(self):
+        with mock.patch.dict(replicas.REPLICA_SETTINGS, STICKY_SECONDS=0):
+            self.client.post('/api/notes/', {'title': 'New'}, format='json')
+        self.assertEqual(self.get('/api/notes/'), {'replica1'})
+    
+    def test_bootstrap_reads_from_primary(self):
+        self.assertEqual(self.get(f'/api/notes/{self.note.pk}/bootstrap/'), {DEFAULT_DB_ALIAS})
+    
+    def test_sync_reads_from_primary(self):
+        self.assertEqual(self.get('/api/sync/changes/'), {DEFAULT_DB_ALIAS})
+
+
+class DuplicationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(title='Source', owner=self.user)
+        self.block = Block.objects.create(note=self.note, block_type='text', content={'text': 'one'})
+        self.contents = [{'text': 'one'}, {'text': 'two'}, {'text': 'three'}]
+        for content in self.contents:
+            record_version(self.block, content, self.user)
+        self.block.content = self.contents[-1]
+        self.block.save()
+    
+    def duplicate(self, **data):
+        response = self.client.post(f'/api/notes/{self.note.pk}/duplicate/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        return Block.objects.get(note_id=response.data['id'])
+    
+    def history(self, block):
+        response = self.client.get(f'/api/blocks/{block.pk}/versions/')
+        return [(version['version_number'], version['content']) for version in response.data['results']]
+    
+    def test_shared_history_lists_every_source_version(self):
+        copy = self.duplicate(share_history=True)
+        
+        self.assertEqual(self.history(copy), self.history(self.block))
+        self.assertEqual(len(self.history(copy)), 3)
+        self.assertEqual(
+            set(BlockVersion.objects.filter(block=copy).values_list('kind', flat=True)), 
+            {BlockVersion.KIND_REFERENCE}
+        )
+    
+    def test_copy_restores_an_earlier_source_version(self):
+        copy = self.duplicate(share_history=True)
+        first = BlockVersion.objects.get(block=copy, version_number=1)
+        
+        response = self.client.post(f'/api/blocks/{copy.pk}/restore_version/', {'version_id': str(first.pk)}, format='json')
+        
+        self.assertEqual(response.data['content'], {'text': 'one'})
+        self.block.refresh_from_db()
+        self.assertEqual(self.block.content, {'text': 'three'})
+    
+    def test_deleting_the_source_keeps_the_copy_history(self):
+        copy = self.duplicate(share_history=True)
+        Block.all_objects.filter(pk=self.block.pk).delete()
+        
+        versions = BlockVersion.objects.filter(block=copy).order_by('version_number')
+        self.assertEqual([version.kind for version in versions], [BlockVersion.KIND_SNAPSHOT] * 3)
+        self.assertEqual([reconstruct(version) for version in versions], self.contents)
+    
+    def test_unsaved_source_content_goes_on_top(self):
+        Block.objects.filter(pk=self.block.pk).update(content={'text': 'four'})
+        copy = self.duplicate(share_history=True)
+        self.assertEqual(self.history(copy)[0], (4, {'text': 'four'}))
+    
+    def test_plain_copy_starts_a_new_history(self):
+        copy = self.duplicate()
+        self.assertEqual(self.history(copy), [(1, {'text': 'three'})])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AccessCacheTests(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user('alice', email='alice@example.com')
+        self.other = User.objects.create_user('bob', email='bob@example.com')
+        self.note = Note.objects.create(owner=self.owner)
+        self.client.force_authenticate(self.owner)
+    
+    def test_owner_and_strangers(self):
+        self.assertEqual(get_role(self.owner, self.note.pk), NoteAccess.ROLE_OWNER)
+        self.assertFalse(has_access(self.other, self.note.pk))
+        self.assertFalse(has_access(self.other, 'not a uuid'))
+    
+    def test_grant_replaces_cached_denial(self):
+        self.assertFalse(has_access(self.other, self.note.pk))
+        self.note.collaborators.add(self.other)
+        self.assertEqual(get_role(self.other, self.note.pk), NoteAccess.ROLE_COLLABORATOR)
+    
+    def test_revoke_replaces_cached_role(self):
+        self.note.collaborators.add(self.other)
+        self.assertTrue(has_access(self.other, self.note.pk))
+        response = self.client.delete(f'/api/notes/{self.note.pk}/remove_collaborator/', {'user_id': self.other.pk}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(has_access(self.other, self.note.pk))
+    
+    def test_role_cached_before_commit_is_dropped_after(self):
+        self.note.collaborators.add(self.other)
+        with transaction.atomic():
+            self.note.collaborators.remove(self.other)
+            # Another request, not seeing the delete yet, caches the old role
+            cache.set(f'note-access:{self.other.pk}:{self.note.pk}', NoteAccess.ROLE_COLLABORATOR)
+        self.assertFalse(has_access(self.other, self.note.pk))
+    
+    def test_trashed_note_loses_access(self):
+        self.note.collaborators.add(self.other)
+        self.assertTrue(has_access(self.other, self.note.pk))
+        self.assertEqual(self.client.delete(f'/api/notes/{self.note.pk}/').status_code, 204)
+        self.assertFalse(has_access(self.other, self.note.pk))
+        self.assertFalse(has_access(self.owner, self.note.pk))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ChangeFeedTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(title='First', owner=self.user)
+        self.settle()
+    
+    def settle(self):
+        # Past the settle window
+        Change.objects.update(created_at=timezone.now() - timedelta(seconds=5))
+    
+    def changes(self, cursor):
+        return self.client.get('/api/sync/changes/', {'since': cursor})
+    
+    def test_cursor_then_changes(self):
+        cursor = self.client.get('/api/sync/changes/').data['cursor']
+        note = Note.objects.create(title='Second', owner=self.user)
+        self.settle()
+        
+        response = self.changes(cursor)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['notes']], [str(note.pk)])
+        self.assertFalse(response.data['has_more'])
+        self.assertEqual(self.changes(response.data['cursor']).data['notes'], [])
+    
+    def test_unsettled_changes_are_held_back(self):
+        cursor = self.client.get('/api/sync/changes/').data['cursor']
+        Note.objects.create(title='Second', owner=self.user)
+        
+        response = self.changes(cursor)
+        self.assertEqual(response.data['notes'], [])
+        self.assertFalse(response.data['has_more'])
+        self.assertIsNotNone(response.data['retry_after'])
+    
+    def test_pruned_cursor_expires(self):
+        first = Change.objects.order_by('id').first().pk
+        Note.objects.create(title='Second', owner=self.user)
+        Change.objects.update(created_at=timezone.now() - timedelta(days=365))
+        self.assertGreater(prune_changes(), 0)
+        
+        self.assertEqual(self.changes(encode_cursor(first - 1)).status_code, 410)
+        self.assertEqual(self.changes(encode_cursor(ChangeHorizon.objects.get().pruned_through)).status_code, 200)
+    
+    def test_gap_in_ids_does_not_expire_cursor(self):
+        first = Change.objects.order_by('id').first().pk
+        Note.objects.create(title='Second', owner=self.user)
+        self.settle()
+        # As if the first insert had been rolled back
+        Change.objects.filter(pk=first).delete()
+        
+        response = self.changes(encode_cursor(first - 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['notes']), 1)
+
+
+class ServerTimingTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        Note.objects.create(title='First', owner=self.user)
+    
+    def test_header_counts_queries_and_render_time(self):
+        with mock.patch.dict(instrumentation.INSTRUMENTATION_SETTINGS, ENABLED=True):
+            response = self.client.get('/api/notes/')
+        
+        self.assertEqual(response.status_code, 200)
+        db, render, app = response['Server-Timing'].split(', ')
+        self.assertRegex(db, r'^db;dur=[\d.]+;desc="[1-9]\d* queries"$')
+        self.assertRegex(render, r'^serialize;dur=[\d.]+$')
+        self.assertRegex(app, r'^app;dur=[\d.]+$')
+    
+    def test_renderer_adds_to_current_timings(self):
+        timings = instrumentation.Timings()
+        token = instrumentation._current.set(timings)
+        try:
+            content = instrumentation.TimedJSONRenderer().render({'a': list(range(1000))})
+        finally:
+            instrumentation._current.reset(token)
+        self.assertTrue(content.startswith(b'{"a":'))
+        self.assertGreater(timings.serialize, 0)
+    
+    def test_disabled_adds_no_header(self):
+        response = self.client.get('/api/notes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+)
+class ConsumerTestCase(APITransactionTestCase):
+    """
+    Editors connected through NoteConsumer, with the in-memory oplog and
+    channel layer. Each test runs in one event loop, which the sessions
+    are bound to.
+    """
+    
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.note = Note.objects.create(title='Shared', owner=self.user)
+        self.block = Block.objects.create(note=self.note, block_type='text', content={'text': 'start'})
+        for patcher in (
+            mock.patch.object(oplog, '_oplog', oplog.MemoryOpLog(5)),
+            mock.patch.dict(sessions._sessions, clear=True),
+            mock.patch.dict(sessions.SESSION_SETTINGS, GRACE_PERIOD=0, PRESENCE_TICK=0.01),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+    
+    async def connect(self, user=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/notes/{self.note.pk}/')
+        communicator.scope['user'] = user or self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.welcome = await communicator.receive_json_from()
+        self.assertEqual(self.welcome['type'], 'connection_established')
+        return communicator
+    
+    async def leave(self, *communicators):
+        for communicator in communicators:
+            await communicator.disconnect()
+        # Let the closed sessions give up their leases
+        await asyncio.sleep(0.05)
+    
+    async def frames(self, communicator, until):
+        """Frames received up to and including the first of type `until`."""
+        frames = []
+        while not frames or frames[-1]['type'] != until:
+            frames.append(await communicator.receive_json_from())
+        return frames
+    
+    def content(self):
+        self.block.refresh_from_db()
+        return self.block.content
+
+
+class SessionTests(ConsumerTestCase):
+    async def test_edits_flushed_when_last_editor_leaves(self):
+        alice = await self.connect()
+        await alice.send_json_to({'type': 'block_update', 'block_id': str(self.block.pk), 'content': {'text': 'one'}})
+        await alice.send_json_to({'type': 'block_update', 'block_id': str(self.block.pk), 'content': {'text': 'two'}})
+        await asyncio.sleep(0.05)
+        
+        # Held in the session until it flushes
+        self.assertEqual(await database_sync_to_async(self.content)(), {'text': 'start'})
+        await self.leave(alice)
+        
+        self.assertEqual(await database_sync_to_async(self.content)(), {'text': 'two'})
+        # Both edits are one burst, so one version
+        self.assertEqual(await BlockVersion.objects.filter(block=self.block).acount(), 1)
+        self.assertNotIn(str(self.note.pk), sessions._sessions)
+    
+    async def test_editors_share_one_session(self):
+        bob = await database_sync_to_async(User.objects.create_user)('bob')
+        await database_sync_to_async(self.note.collaborators.add)(bob)
+        alice = await self.connect()
+        other = await self.connect(bob)
+        self.assertEqual(len(sessions._sessions[str(self.note.pk)].consumers), 2)
+        await self.frames(alice, 'user_joined')
+        
+        await alice.send_json_to({'type': 'block_update', 'block_id': str(self.block.pk), 'content': {'text': 'one'}})
+        frame = (await self.frames(other, 'block_updated'))[-1]
+        self.assertEqual(frame['content'], {'text': 'one'})
+        # The sender only gets the number
+        self.assertEqual(await alice.receive_json_from(), {'type': 'op_ack', 'op': 'block_updated', 'seq': frame['seq']})
+        
+        await self.leave(alice)
+        self.assertEqual(await database_sync_to_async(self.content)(), {'text': 'start'})
+        await self.leave(other)
+        self.assertEqual(await database_sync_to_async(self.content)(), {'text': 'one'})
+    
+    async def test_note_held_by_another_process(self):
+        await cache.aset(f'note-session:{self.note.pk}', 'elsewhere', 30)
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/notes/{self.note.pk}/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': sessions.SESSION_ELSEWHERE_CODE})
+
+
+class BlockOrderConsumerTests(ConsumerTestCase):
+    async def test_move_between_siblings(self):
+        first = await Block.objects.acreate(note=self.note, block_type='text', content={'text': 'first'}, position='a')
+        await Block.objects.filter(pk=self.block.pk).aupdate(position='b')
+        alice = await self.connect()
+        
+        await alice.send_json_to({'type': 'block_move', 'block_id': str(self.block.pk), 'before_id': str(first.pk)})
+        self.assertEqual((await self.frames(alice, 'op_ack'))[-1]['op'], 'block_moved')
+        self.assertLess(*[
+            block.position for block in [await Block.objects.aget(pk=self.block.pk), await Block.objects.aget(pk=first.pk)]
+        ])
+        await self.leave(alice)
+    
+    async def test_rejected_move_and_reorder_get_an_error_frame(self):
+        alice = await self.connect()
+        
+        await alice.send_json_to({'type': 'block_move', 'block_id': str(self.block.pk), 'after_id': str(uuid.uuid4())})
+        frame = await alice.receive_json_from()
+        self.assertEqual(frame['type'], 'block_move_rejected')
+        self.assertEqual(frame['block_id'], str(self.block.pk))
+        
+        await alice.send_json_to({'type': 'block_move', 'block_id': 'not a uuid'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'block_move_rejected')
+        
+        await alice.send_json_to({'type': 'block_reorder', 'block_ids': ['not a uuid']})
+        self.assertEqual((await alice.receive_json_from())['type'], 'blocks_reorder_rejected')
+        
+        self.assertFalse(await OutboxMessage.objects.aexists())
+        await self.leave(alice)
+
+
+class FanOutTests(ConsumerTestCase):
+    async def test_frame_encoded_once_and_not_echoed(self):
+        bob = await database_sync_to_async(User.objects.create_user)('bob')
+        carol = await database_sync_to_async(User.objects.create_user)('carol')
+        for user in (bob, carol):
+            await database_sync_to_async(self.note.collaborators.add)(user)
+        alice = await self.connect()
+        others = [await self.connect(bob), await self.connect(carol)]
+        await self.frames(alice, 'user_joined')
+        await self.frames(alice, 'user_joined')
+        await self.frames(others[0], 'user_joined')
+        
+        with mock.patch('apps.notes.consumers.json.dumps', wraps=json.dumps) as dumps:
+            await alice.send_json_to({'type': 'block_update', 'block_id': str(self.block.pk), 'content': {'text': 'one'}})
+            for other in others:
+                self.assertEqual((await other.receive_json_from())['type'], 'block_updated')
+                # Not again through the note group
+                self.assertTrue(await other.receive_nothing(0.05))
+            self.assertEqual((await alice.receive_json_from())['type'], 'op_ack')
+        
+        encoded = [call.args[0]['type'] for call in dumps.call_args_list]
+        self.assertEqual(encoded.count('block_updated'), 1)
+        await self.leave(alice, *others)
+    
+    async def test_frames_from_other_processes_reach_everyone(self):
+        alice = await self.connect()
+        await get_channel_layer().group_send(f'note_{self.note.pk}', {
+            'type': 'note.frame',
+            'frame': '{"type": "note_updated"}',
+            'origin': 'another-process',
+        })
+        self.assertEqual(await alice.receive_json_from(), {'type': 'note_updated'})
+        await self.leave(alice)
+
+
+class PresenceTests(ConsumerTestCase):
+    async def test_cursor_moves_sent_once_per_tick(self):
+        bob = await database_sync_to_async(User.objects.create_user)('bob')
+        await database_sync_to_async(self.note.collaborators.add)(bob)
+        alice = await self.connect()
+        other = await self.connect(bob)
+        await self.frames(alice, 'user_joined')
+        
+        for position in range(3):
+            await alice.send_json_to({'type': 'cursor_position', 'block_id': str(self.block.pk), 'position': position})
+        
+        frame = await other.receive_json_from()
+        self.assertEqual(frame['type'], 'presence_update')
+        self.assertEqual(frame['users'], [{
+            'user_id': str(self.user.pk),
+            'username': 'alice',
+            'cursor': {'block_id': str(self.block.pk), 'position': 2},
+        }])
+        self.assertTrue(await other.receive_nothing(0.05))
+        # A lone sender does not get its own moves back
+        self.assertTrue(await alice.receive_nothing(0.05))
+        await self.leave(alice, other)
+
+
+class ResumeTests(ConsumerTestCase):
+    async def update(self, communicator, *texts):
+        for text in texts:
+            await communicator.send_json_to({'type': 'block_update', 'block_id': str(self.block.pk), 'content': {'text': text}})
+            await self.frames(communicator, 'op_ack')
+    
+    async def resume(self, last_seq):
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'resume', 'last_seq': last_seq})
+        return communicator
+    
+    async def test_missed_operations_replayed(self):
+        alice = await self.connect()
+        await self.update(alice, 'one', 'two', 'three')
+        
+        again = await self.resume(1)
+        frames = await self.frames(again, 'resume_complete')
+        self.assertEqual([(frame['seq'], frame['content']) for frame in frames[:-1]], [(2, {'text': 'two'}), (3, {'text': 'three'})])
+        self.assertEqual(frames[-1], {'type': 'resume_complete', 'seq': 3})
+        await self.leave(alice, again)
+    
+    async def test_up_to_date_client_gets_nothing_to_replay(self):
+        alice = await self.connect()
+        await self.update(alice, 'one')
+        
+        again = await self.resume(1)
+        self.assertEqual(await again.receive_json_from(), {'type': 'resume_complete', 'seq': 1})
+        await self.leave(alice, again)
+    
+    async def test_overflowed_log_sends_a_snapshot(self):
+        alice = await self.connect()
+        # The log keeps 5 frames
+        await self.update(alice, *[str(number) for number in range(7)])
+        
+        again = await self.resume(1)
+        frame = await again.receive_json_from()
+        self.assertEqual(frame['type'], 'resync')
+        self.assertEqual(frame['seq'], 7)
+        # Unsaved edits included
+        self.assertEqual([block['content'] for block in frame['blocks']], [{'text': '6'}])
+        await self.leave(alice, again)
+    
+    async def test_unknown_seq_sends_a_snapshot(self):
+        alice = await self.resume(10)
+        self.assertEqual((await alice.receive_json_from())['type'], 'resync')
+        await self.leave(alice)
+
+
+class OutboxTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+    
+    @database_sync_to_async
+    def patch_block(self, text):
+        response = self.client.patch(f'/api/blocks/{self.block.pk}/', {'content': {'text': text}}, format='json')
+        self.assertEqual(response.status_code, 200)
+    
+    async def test_rest_write_reaches_editors_once_committed(self):
+        alice = await self.connect()
+        await self.patch_block('rest')
+        
+        frame = await alice.receive_json_from()
+        self.assertEqual((frame['type'], frame['seq'], frame['content']), ('block_updated', 1, {'text': 'rest'}))
+        message = await OutboxMessage.objects.aget()
+        self.assertEqual(message.seq, 1)
+        self.assertIsNotNone(message.dispatched_at)
+        await self.leave(alice)
+    
+    def test_written_in_the_writers_transaction(self):
+        dispatched = []
+        with mock.patch.object(outbox, 'dispatch_note', dispatched.append):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                outbox.announce(self.note.pk, 'note_updated', self.user)
+                self.assertEqual(OutboxMessage.objects.count(), 1)
+                self.assertEqual(dispatched, [])
+                raise RuntimeError()
+            self.assertFalse(OutboxMessage.objects.exists())
+            
+            with transaction.atomic():
+                outbox.announce(self.note.pk, 'note_updated', self.user)
+            self.assertEqual(dispatched, [self.note.pk])
+    
+    async def test_relay_sends_what_dispatch_missed(self):
+        alice = await self.connect()
+        # As if the process died before its on-commit dispatch
+        with mock.patch.object(outbox, 'dispatch_note'):
+            await self.patch_block('rest')
+        self.assertTrue(await alice.receive_nothing(0.05))
+        self.assertTrue(await OutboxMessage.objects.filter(dispatched_at__isnull=True).aexists())
+        
+        self.assertEqual(await database_sync_to_async(outbox.relay_batch)(), 1)
+        frame = await alice.receive_json_from()
+        self.assertEqual((frame['type'], frame['seq']), ('block_updated', 1))
+        self.assertEqual(await database_sync_to_async(outbox.relay_batch)(), 0)
+        await self.leave(alice)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConditionalGetTests(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(title='First', owner=self.user)
+        self.block = Block.objects.create(note=self.note, block_type='text', content={'text': 'one'})
+        patcher = mock.patch.object(replicas, 'REPLICAS', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def assertRevalidates(self, url, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+    
+    def rename(self):
+        response = self.client.patch(f'/api/notes/{self.note.pk}/', {'title': 'Renamed'}, format='json')
+        self.assertEqual(response.status_code, 200)
+    
+    def edit_block(self):
+        response = self.client.patch(f'/api/blocks/{self.block.pk}/', {'content': {'text': 'two'}}, format='json')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_list(self):
+        self.assertRevalidates('/api/notes/', self.rename)
+    
+    def test_list_sees_new_notes(self):
+        self.assertRevalidates('/api/notes/', lambda: self.client.post('/api/notes/', {'title': 'New'}, format='json'))
+    
+    def test_retrieve(self):
+        self.assertRevalidates(f'/api/notes/{self.note.pk}/', self.edit_block)
+    
+    def test_recent(self):
+        self.assertRevalidates('/api/notes/recent/', self.rename)
+    
+    def test_other_query_gets_another_etag(self):
+        first = self.client.get('/api/notes/')['ETag']
+        self.assertNotEqual(self.client.get('/api/notes/', {'fields': 'id,title'})['ETag'], first)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TrashTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice')
+        self.client.force_authenticate(self.user)
+        self.note = Note.objects.create(title='Old', owner=self.user)
+        self.blocks = [
+            Block.objects.create(note=self.note, block_type='text', content={'text': str(index)})
+            for index in range(5)
+        ]
+        for block in self.blocks:
+            for text in ('one', 'two', 'three'):
+                record_version(block, {'text': text}, self.user)
+        patcher = mock.patch.dict(trash.TRASH_SETTINGS, PURGE_BATCH=2, PURGE_PAUSE=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def expire(self, queryset):
+        queryset.update(deleted_at=timezone.now() - timedelta(days=trash.TRASH_SETTINGS['RETENTION_DAYS'] + 1))
+    
+    def test_note_trashed_and_restored(self):
+        self.assertEqual(self.client.delete(f'/api/notes/{self.note.pk}/').status_code, 204)
+        self.assertEqual(self.client.get(f'/api/notes/{self.note.pk}/').status_code, 404)
+        self.assertEqual(self.client.get('/api/notes/').data['results'], [])
+        self.assertEqual([item['id'] for item in self.client.get('/api/notes/trash/').data['results']], [str(self.note.pk)])
+        
+        response = self.client.post(f'/api/notes/{self.note.pk}/restore/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(f'/api/notes/{self.note.pk}/').status_code, 200)
+        self.assertEqual(Block.objects.filter(note=self.note).count(), 5)
+    
+    def test_block_trashed_and_restored(self):
+        block = self.blocks[0]
+        self.assertEqual(self.client.delete(f'/api/blocks/{block.pk}/').status_code, 204)
+        self.assertFalse(Block.objects.filter(pk=block.pk).exists())
+        
+        self.assertEqual(self.client.post(f'/api/blocks/{block.pk}/restore/').status_code, 200)
+        self.assertTrue(Block.objects.filter(pk=block.pk).exists())
+        self.assertEqual(BlockVersion.objects.filter(block=block).count(), 3)
+    
+    def test_nothing_restored_past_the_window(self):
+        self.client.delete(f'/api/notes/{self.note.pk}/')
+        self.expire(Note.all_objects.filter(pk=self.note.pk))
+        self.assertEqual(self.client.post(f'/api/notes/{self.note.pk}/restore/').status_code, 404)
+    
+    def test_purge_expired_in_batches(self):
+        kept = Note.objects.create(title='Recent', owner=self.user)
+        Block.objects.create(note=kept, block_type='text', content={'text': 'kept'})
+        trash.trash_note(kept)
+        trash.trash_note(self.note)
+        self.expire(Note.all_objects.filter(pk=self.note.pk))
+        
+        live = Note.objects.create(title='Live', owner=self.user)
+        blocks = [Block.objects.create(note=live, block_type='text', content={'text': 'x'}) for _ in range(3)]
+        record_version(blocks[0], {'text': 'y'}, self.user)
+        trash.trash_blocks(live.pk, [block.pk for block in blocks[:2]])
+        self.expire(Block.all_objects.filter(pk__in=[block.pk for block in blocks[:2]]))
+        
+        self.assertEqual(trash.purge_expired(), (1, 2))
+        
+        self.assertFalse(Note.all_objects.filter(pk=self.note.pk).exists())
+        self.assertFalse(Block.all_objects.filter(note_id=self.note.pk).exists())
+        self.assertFalse(BlockVersion.objects.filter(block_id__in=[block.pk for block in self.blocks]).exists())
+        self.assertTrue(Note.all_objects.filter(pk=kept.pk).exists())
+        self.assertEqual(list(Block.all_objects.filter(note=live)), [blocks[2]])
@@ -0,0 +1,117 @@
+"""
+Deletion in two steps.
+
+Deleting a note or block only sets its deleted_at, in constant time. The
+default managers leave such rows out, so they vanish from every queryset
+at once; Note.all_objects and Block.all_objects still see them. For
+RETENTION_DAYS they can be restored. After that, purge_expired() (the
+purge_trash command, run periodically) deletes them in batches of
+PURGE_BATCH rows, each in its own short transaction, and sleeps
+PURGE_PAUSE seconds between batches so a large note never holds locks for
+long or crowds out other writers.
+"""
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from apps.blocks.models import Block, BlockVersion
+from apps.search.backends import get_backend
+from .access import invalidate_note
+from .changes import record_changes
+from .models import Note
+from .revisions import bump
+
+DEFAULTS = {
+    'RETENTION_DAYS': 30,
+    'PURGE_BATCH': 1000,
+    # Seconds between purge batches
+    'PURGE_PAUSE': 0.05,
+}
+
+TRASH_SETTINGS = {**DEFAULTS, **getattr(settings, 'TRASH', {})}
+
+
+def restorable_since():
+    """Items trashed before this are past the restore window."""
+    return timezone.now() - timedelta(days=TRASH_SETTINGS['RETENTION_DAYS'])
+
+
+def trash_note(note):
+    note.deleted_at = timezone.now()
+    # post_save advances the revision and drops cached lists
+    note.save(update_fields=['deleted_at'])
+    invalidate_note(note.pk)
+
+
+def restore_note(note):
+    note.deleted_at = None
+    note.save(update_fields=['deleted_at'])
+    invalidate_note(note.pk)
+
+
+def trash_blocks(note_id, block_ids):
+    """Move blocks of a note to the trash; returns how many there were."""
+    block_ids = list(block_ids)
+    count = Block.objects.filter(note_id=note_id, pk__in=block_ids).update(deleted_at=timezone.now())
+    if count:
+        get_backend().remove_blocks(block_ids)
+        bump([note_id])
+        record_changes(blocks=[(note_id, block_id) for block_id in block_ids])
+    return count
+
+
+def restore_blocks(note_id, block_ids):
+    """Bring blocks of a note back from the trash; returns them."""
+    blocks = list(Block.all_objects.filter(
+        note_id=note_id, pk__in=list(block_ids), deleted_at__gte=restorable_since()
+    ))
+    if blocks:
+        Block.all_objects.filter(pk__in=[block.pk for block in blocks]).update(deleted_at=None)
+        for block in blocks:
+            block.deleted_at = None
+        get_backend().index_blocks(blocks)
+        bump([note_id])
+        record_changes(blocks=[(note_id, block.pk) for block in blocks])
+    return blocks
+
+
+def _delete_batch(queryset):
+    """Delete the first PURGE_BATCH rows of `queryset`; returns how many there were."""
+    ids = list(queryset.values_list('pk', flat=True)[:TRASH_SETTINGS['PURGE_BATCH']])
+    if ids:
+        with transaction.atomic():
+            queryset.model._base_manager.filter(pk__in=ids).delete()
+        time.sleep(TRASH_SETTINGS['PURGE_PAUSE'])
+    return len(ids)
+
+
+def purge_blocks(blocks):
+    """Delete the blocks in a queryset and their history, batch by batch."""
+    count = 0
+    while True:
+        block_ids = list(blocks.values_list('pk', flat=True)[:TRASH_SETTINGS['PURGE_BATCH']])
+        if not block_ids:
+            return count
+        # Newest first: a version is only referenced by later ones, so
+        # references go before what they point at and are not rewritten
+        versions = BlockVersion.objects.filter(block_id__in=block_ids).order_by('-version_number')
+        while _delete_batch(versions):
+            pass
+        count += _delete_batch(Block.all_objects.filter(pk__in=block_ids))
+
+
+def purge_note(note_id):
+    """Delete a note from the trash along with everything under it."""
+    purge_blocks(Block.all_objects.filter(note_id=note_id))
+    Note.all_objects.filter(pk=note_id, deleted_at__isnull=False).delete()
+
+
+def purge_expired():
+    """Delete what has been in the trash past the restore window; returns (notes, blocks)."""
+    cutoff = restorable_since()
+    note_ids = list(Note.all_objects.filter(deleted_at__lt=cutoff).values_list('pk', flat=True))
+    for note_id in note_ids:
+        purge_note(note_id)
+    blocks = purge_blocks(Block.all_objects.filter(deleted_at__lt=cutoff))
+    return len(note_ids), blocks
@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import NoteViewSet
+from .views import NoteViewSet, sync_changes
 
 router = DefaultRouter()
 router.register(r'notes', NoteViewSet, basename='notes')
 
 urlpatterns = [
     path('api/', include(router.urls)),
+    path('api/sync/changes/', sync_changes, name='sync-changes'),
 ]
\ No newline at end of file
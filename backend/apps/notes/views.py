@@ -1,13 +1,30 @@
 from rest_framework import viewsets, status, permissions
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from .models import Note
+from .access import accessible_notes
+from .changes import CursorExpired, changes_since, collapse, decode_cursor, encode_cursor, head
+from .duplication import SYNC_LIMIT as DUPLICATE_SYNC_LIMIT, duplicate_note, get_job as get_duplication, start_duplication
+from .oplog import get_oplog
+from .outbox import announce
+from .pagination import NoteCursorPagination
+from .revisions import listing_token, make_etag, not_modified, note_revision, set_etag
+from .sparse import field_wanted
+from .trash import restorable_since, restore_note, trash_note
+from apps.blocks.models import Block
+from apps.blocks.serializers import BlockSerializer
+from apps.search.backends import get_backend as get_search_backend
+from config.replicas import use_primary
 from .serializers import (
     NoteSerializer, 
     NoteListSerializer, 
+    NoteTrashSerializer,
+    NoteBootstrapSerializer,
+    NoteSearchResultSerializer,
     CollaboratorSerializer, 
     UserSerializer
 )
@@ -21,18 +38,110 @@ class NoteViewSet(viewsets.ModelViewSet):
             return NoteListSerializer
         return NoteSerializer
     
+    @property
+    def paginator(self):
+        # ?pagination=cursor (or a cursor from a previous page) switches the
+        # list to keyset pagination, which never runs a COUNT(*)
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            cursor_mode = 'cursor' in params or params.get('pagination') == 'cursor'
+            if self.action == 'list' and cursor_mode:
+                self._paginator = NoteCursorPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
+    
     def get_queryset(self):
-        user = self.request.user
-        return Note.objects.filter(
-            Q(owner=user) | Q(collaborators=user)
-        ).distinct().prefetch_related('collaborators', 'blocks')
+        queryset = accessible_notes(self.request.user).select_related('owner__profile')
+        
+        if self.action in ('trash', 'restore'):
+            return Note.all_objects.filter(
+                access__user=self.request.user, deleted_at__gte=restorable_since()
+            ).select_related('owner__profile').with_counts()
+        
+        if self.action in ('bootstrap', 'duplicate'):
+            # These load the related rows themselves
+            return queryset
+        
+        if self.action in ('list', 'recent', 'search'):
+            # Counts are computed in the same statement instead of per row
+            queryset = queryset.with_counts()
+            if field_wanted(self.request, 'collaborators', expandable=True):
+                queryset = queryset.prefetch_related('collaborators')
+            return queryset
+        
+        # Skip relations left out with ?fields=
+        related = [name for name in ('collaborators', 'blocks') if field_wanted(self.request, name)]
+        return queryset.prefetch_related(*related)
+    
+    def list(self, request, *args, **kwargs):
+        # The token is read before the notes, so a change in between only
+        # costs the client one more full response
+        etag = make_etag(request, listing_token(request.user))
+        return not_modified(request, etag) or set_etag(super().list(request, *args, **kwargs), etag)
+    
+    def retrieve(self, request, *args, **kwargs):
+        revision = note_revision(request.user, kwargs['pk'])
+        if revision is None:
+            return super().retrieve(request, *args, **kwargs)
+        etag = make_etag(request, revision)
+        return not_modified(request, etag) or set_etag(super().retrieve(request, *args, **kwargs), etag)
     
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
     
+    def perform_update(self, serializer):
+        # Collaborators hear of every write once it commits; see outbox.py
+        with transaction.atomic():
+            note = serializer.save()
+            announce(note.pk, 'note_updated', self.request.user, title=note.title, last_modified=note.updated_at)
+    
     def perform_destroy(self, instance):
-        # Hard delete
-        instance.delete()
+        # Into the trash; the rows are purged once the restore window ends
+        with transaction.atomic():
+            trash_note(instance)
+            announce(instance.pk, 'note_deleted', self.request.user)
+    
+    @action(detail=False, methods=['get'])
+    def trash(self, request):
+        notes = self.paginate_queryset(self.get_queryset().order_by('-deleted_at', 'id'))
+        serializer = NoteTrashSerializer(notes, many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
+    
+    @action(detail=True, methods=['post'])
+    def restore(self, request, pk=None):
+        note = self.get_object()
+        with transaction.atomic():
+            restore_note(note)
+            announce(note.pk, 'note_restored', request.user, title=note.title)
+        serializer = NoteListSerializer(note, context={'request': request})
+        return Response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def bootstrap(self, request, pk=None):
+        """
+        Everything the editor needs to open a note, in one response and three
+        queries: the note (joined with its access check), blocks, collaborators.
+        """
+        # A replica may not have caught up with the seq read below
+        use_primary()
+        note = self.get_object()
+        
+        # Read before the blocks; a client that resumes its WebSocket from
+        # this seq is replayed every operation the blocks may have missed
+        seq = get_oplog().current_sync(str(note.pk))
+        
+        blocks = list(Block.objects.filter(note=note).order_by('position', 'created_at'))
+        collaborators = list(note.collaborators.select_related('profile'))
+        note.blocks_count = len(blocks)
+        note.collaborators_count = len(collaborators)
+        
+        return Response({
+            'note': NoteBootstrapSerializer(note).data,
+            'blocks': BlockSerializer(blocks, many=True).data,
+            'collaborators': UserSerializer(collaborators, many=True).data,
+            'seq': seq
+        })
     
     @action(detail=True, methods=['post'])
     def add_collaborator(self, request, pk=None):
@@ -120,44 +229,100 @@ class NoteViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def duplicate(self, request, pk=None):
         original_note = self.get_object()
+        share_history = str(request.data.get('share_history', '')).lower() in ('1', 'true')
+        run_async = str(request.data.get('async', '')).lower() in ('1', 'true')
         
-        # Create a copy of the note
-        new_note = Note.objects.create(
-            title=f"{original_note.title} (Copy)",
-            owner=request.user
-        )
-        
-        # Copy all blocks
-        for block in original_note.blocks.all():
-            new_block = block
-            new_block.pk = None
-            new_block.note = new_note
-            new_block.save()
+        # Large notes are copied by the worker; the client polls the job
+        total = original_note.blocks.count()
+        if run_async or total > DUPLICATE_SYNC_LIMIT:
+            job = start_duplication(original_note, request.user, total, share_history=share_history)
+            return Response(self._duplication_data(job), status=status.HTTP_202_ACCEPTED)
         
+        new_note = duplicate_note(original_note, request.user, share_history=share_history)
         serializer = NoteSerializer(new_note, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
     
+    @action(detail=False, methods=['get'], url_path=r'duplications/(?P<job_id>[0-9a-f]{32})')
+    def duplication(self, request, job_id=None):
+        job = get_duplication(job_id)
+        if job is None or job['user_id'] != request.user.pk:
+            return Response({'error': 'Duplication not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(self._duplication_data(job))
+    
+    def _duplication_data(self, job):
+        data = {key: value for key, value in job.items() if key != 'user_id'}
+        data['url'] = reverse('notes-duplication', kwargs={'job_id': job['id']}, request=self.request)
+        return data
+    
     @action(detail=False, methods=['get'])
     def search(self, request):
         query = request.query_params.get('q', '')
         if not query:
             return Response({'error': 'Query parameter q is required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        user = request.user
-        notes = Note.objects.filter(
-            Q(owner=user) | Q(collaborators=user),
-            Q(title__icontains=query) | Q(blocks__content__icontains=query)
-        ).distinct()
+        backend = get_search_backend()
+        hits = self.paginate_queryset(backend.search(request.user, query))
+        backend.highlight(hits, query)
         
-        serializer = NoteListSerializer(notes, many=True, context={'request': request})
-        return Response(serializer.data)
+        notes = self.get_queryset().in_bulk([hit.note_id for hit in hits])
+        results = []
+        for hit in hits:
+            note = notes.get(hit.note_id)
+            if note is not None:
+                note.search_hit = hit
+                results.append(note)
+        
+        serializer = NoteSearchResultSerializer(results, many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
     
     @action(detail=False, methods=['get'])
     def recent(self, request):
-        user = request.user
-        recent_notes = Note.objects.filter(
-            Q(owner=user) | Q(collaborators=user)
-        ).distinct().order_by('-updated_at')[:10]
+        etag = make_etag(request, listing_token(request.user))
+        response = not_modified(request, etag)
+        if response:
+            return response
+        
+        recent_notes = self.get_queryset().order_by('-updated_at', 'id')[:10]
         
         serializer = NoteListSerializer(recent_notes, many=True, context={'request': request})
-        return Response(serializer.data)
+        return set_etag(Response(serializer.data), etag)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def sync_changes(request):
+    """Notes, blocks and memberships changed since ?since=<cursor>; see changes.py."""
+    # Lagging rows would be skipped for good
+    use_primary()
+    since = request.query_params.get('since')
+    if not since:
+        return Response({
+            'notes': [], 'blocks': [], 'memberships': [],
+            'deleted': {'notes': [], 'blocks': [], 'memberships': []},
+            'cursor': encode_cursor(head()),
+            'has_more': False,
+            'retry_after': None
+        })
+    
+    try:
+        since = decode_cursor(since)
+    except ValueError:
+        return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        rows, last, more, retry_after = changes_since(request.user, since)
+    except CursorExpired:
+        return Response({'error': 'Cursor expired; reload and start over'}, status=status.HTTP_410_GONE)
+    
+    notes, blocks, memberships, deleted = collapse(request.user, rows)
+    return Response({
+        'notes': NoteListSerializer(notes, many=True, context={'request': request}).data,
+        'blocks': BlockSerializer(blocks, many=True).data,
+        'memberships': [
+            {'note_id': str(access.note_id), 'user': UserSerializer(access.user).data, 'role': access.role}
+            for access in memberships
+        ],
+        'deleted': deleted,
+        'cursor': encode_cursor(last),
+        'has_more': more,
+        'retry_after': retry_after
+    })
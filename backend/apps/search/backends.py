@@ -0,0 +1,263 @@
+import math
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import BooleanField, Count, FloatField
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.html import escape
+from .extract import extract_block_text
+from .models import SearchDocument, SearchTerm
+
+# Upper bound on ranked documents per query; pages are cut from this list
+MAX_RESULTS = getattr(settings, 'SEARCH_MAX_RESULTS', 1000)
+
+# Seconds the simple backend reuses its document count; IDF only needs a
+# rough figure
+DOCUMENT_COUNT_TTL = 60
+
+SNIPPET_RADIUS = 80
+TITLE_BOOST = 2.0
+
+HIGHLIGHT_START = '<mark>'
+HIGHLIGHT_STOP = '</mark>'
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+@dataclass
+class SearchHit:
+    note_id: object
+    document_id: int
+    block_id: object
+    rank: float
+    snippet: str = ''
+
+
+def tokenize(text):
+    return [token[:64] for token in TOKEN_RE.findall(text.lower())]
+
+
+def _group_by_note(rows):
+    """Keep the best-ranked document per note, preserving rank order."""
+    hits = {}
+    for row in rows:
+        if row.note_id not in hits:
+            hits[row.note_id] = row
+    return list(hits.values())
+
+
+class BaseSearchBackend:
+    def index_block(self, block):
+        self.index_blocks([block])
+    
+    def index_blocks(self, blocks):
+        blocks = {block.pk: block for block in blocks}
+        if not blocks:
+            return
+        
+        # One lookup and a few bulk statements however many blocks there are
+        documents = SearchDocument.objects.in_bulk(list(blocks), field_name='block_id')
+        created, changed = [], []
+        now = timezone.now()
+        for block in blocks.values():
+            text = extract_block_text(block.block_type, block.content)
+            document = documents.get(block.pk)
+            if document is None:
+                document = SearchDocument(note_id=block.note_id, block_id=block.pk)
+                created.append(document)
+            elif document.text == text:
+                continue
+            else:
+                changed.append(document)
+            document.text = text
+            document.length = len(tokenize(text))
+            document.updated_at = now
+        
+        with transaction.atomic():
+            SearchDocument.objects.bulk_create(created)
+            SearchDocument.objects.bulk_update(changed, ['text', 'length', 'updated_at'])
+            self._store_terms(created + changed)
+    
+    def remove_blocks(self, block_ids):
+        """Drop the documents of blocks that left the note, e.g. to the trash."""
+        SearchDocument.objects.filter(block_id__in=list(block_ids)).delete()
+    
+    def index_note(self, note):
+        self._store(note.pk, None, note.title or '')
+    
+    def _store(self, note_id, block_id, text):
+        lookup = {'block_id': block_id} if block_id else {'note_id': note_id, 'block__isnull': True}
+        document = SearchDocument.objects.filter(**lookup).first()
+        if document is not None and document.text == text:
+            return
+        
+        with transaction.atomic():
+            if document is None:
+                document = SearchDocument(note_id=note_id, block_id=block_id)
+            document.text = text
+            document.length = len(tokenize(text))
+            document.save()
+            self._store_terms([document])
+    
+    def _store_terms(self, documents):
+        pass
+    
+    def search(self, user, query):
+        """Return SearchHits for the user's notes, best first, one per note."""
+        raise NotImplementedError
+    
+    def highlight(self, hits, query):
+        """Fill in the snippet of each hit; called only for the current page."""
+        raise NotImplementedError
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Ranks with ts_rank_cd over to_tsvector('english', text), which is served
+    by the GIN expression index created in the search migrations. The
+    expression here must stay identical to the indexed one.
+    """
+    VECTOR = "to_tsvector('english', {table}.text)"
+    QUERY = "websearch_to_tsquery('english', %s)"
+    # Control characters mark the matches so the rest can be HTML-escaped
+    HEADLINE_OPTIONS = 'StartSel=\x02, StopSel=\x03, MaxWords=35, MinWords=15, MaxFragments=2'
+    
+    def search(self, user, query):
+        vector = self.VECTOR.format(table=SearchDocument._meta.db_table)
+        matches = RawSQL(f"{vector} @@ {self.QUERY}", [query], output_field=BooleanField())
+        rank = RawSQL(f"ts_rank_cd({vector}, {self.QUERY})", [query], output_field=FloatField())
+        
+        rows = SearchDocument.objects.filter(
+            matches, note__access__user=user, note__deleted_at__isnull=True
+        ).annotate(rank=rank).order_by('-rank').values_list(
+            'note_id', 'id', 'block_id', 'rank'
+        )[:MAX_RESULTS]
+        
+        hits = [
+            SearchHit(note_id, document_id, block_id, rank * (TITLE_BOOST if block_id is None else 1))
+            for note_id, document_id, block_id, rank in rows
+        ]
+        hits.sort(key=lambda hit: hit.rank, reverse=True)
+        return _group_by_note(hits)
+    
+    def highlight(self, hits, query):
+        headline = RawSQL(
+            f"ts_headline('english', text, {self.QUERY}, %s)",
+            [query, self.HEADLINE_OPTIONS]
+        )
+        snippets = dict(SearchDocument.objects.filter(
+            id__in=[hit.document_id for hit in hits]
+        ).annotate(snippet=headline).values_list('id', 'snippet'))
+        
+        for hit in hits:
+            snippet = escape(snippets.get(hit.document_id, ''))
+            hit.snippet = snippet.replace('\x02', HIGHLIGHT_START).replace('\x03', HIGHLIGHT_STOP)
+        return hits
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    Pure-Python fallback for SQLite and other databases. Every document keeps
+    term postings in SearchTerm, so a query is an indexed lookup on the query
+    terms followed by TF-IDF scoring in Python.
+    """
+    
+    def _store_terms(self, documents):
+        terms = []
+        for document in documents:
+            counts = defaultdict(int)
+            for token in tokenize(document.text):
+                counts[token] += 1
+            terms.extend(
+                SearchTerm(document=document, term=term, frequency=frequency)
+                for term, frequency in counts.items()
+            )
+        
+        SearchTerm.objects.filter(document__in=documents).delete()
+        SearchTerm.objects.bulk_create(terms, batch_size=1000)
+    
+    def search(self, user, query):
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        
+        total = cache.get_or_set('search-document-count', SearchDocument.objects.count, DOCUMENT_COUNT_TTL) or 1
+        document_frequency = dict(SearchTerm.objects.filter(
+            term__in=terms
+        ).values('term').annotate(count=Count('id')).values_list('term', 'count'))
+        if len(document_frequency) < len(terms):
+            # Every term must match somewhere
+            return []
+        
+        postings = SearchTerm.objects.filter(
+            term__in=terms, document__note__access__user=user, document__note__deleted_at__isnull=True
+        ).values_list(
+            'document_id', 'document__note_id', 'document__block_id',
+            'document__length', 'term', 'frequency'
+        )
+        
+        documents = {}
+        for document_id, note_id, block_id, length, term, frequency in postings:
+            entry = documents.setdefault(document_id, [note_id, block_id, length, {}])
+            entry[3][term] = frequency
+        
+        hits = []
+        for document_id, (note_id, block_id, length, matched) in documents.items():
+            if len(matched) < len(terms):
+                continue
+            score = 0.0
+            for term, frequency in matched.items():
+                idf = math.log(1 + total / document_frequency[term])
+                # Saturate term frequency and dampen long documents (BM25-like)
+                score += idf * frequency / (frequency + 1.2 * (0.25 + 0.75 * length / 100))
+            if block_id is None:
+                score *= TITLE_BOOST
+            hits.append(SearchHit(note_id, document_id, block_id, score))
+        
+        hits.sort(key=lambda hit: hit.rank, reverse=True)
+        return _group_by_note(hits[:MAX_RESULTS])
+    
+    def highlight(self, hits, query):
+        terms = set(tokenize(query))
+        texts = dict(SearchDocument.objects.filter(
+            id__in=[hit.document_id for hit in hits]
+        ).values_list('id', 'text'))
+        
+        for hit in hits:
+            hit.snippet = self._snippet(texts.get(hit.document_id, ''), terms)
+        return hits
+    
+    def _snippet(self, text, terms):
+        matches = [match for match in TOKEN_RE.finditer(text) if match.group().lower() in terms]
+        if not matches:
+            return escape(text[:SNIPPET_RADIUS * 2])
+        
+        start = max(matches[0].start() - SNIPPET_RADIUS, 0)
+        end = min(matches[0].end() + SNIPPET_RADIUS, len(text))
+        
+        parts = ['...' if start > 0 else '']
+        cursor = start
+        for match in matches:
+            if match.end() > end:
+                break
+            parts.append(escape(text[cursor:match.start()]))
+            parts.append(f'{HIGHLIGHT_START}{escape(match.group())}{HIGHLIGHT_STOP}')
+            cursor = match.end()
+        parts.append(escape(text[cursor:end]))
+        parts.append('...' if end < len(text) else '')
+        return ''.join(parts)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'SEARCH_BACKEND', None) or connection.vendor
+        _backend = PostgresSearchBackend() if name == 'postgresql' else SimpleSearchBackend()
+    return _backend
@@ -0,0 +1,41 @@
+from django.utils.html import strip_tags
+
+
+def _flatten(value):
+    """Yield the strings inside nested lists/dicts (list items, table rows)."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key in ('text', 'content', 'children', 'items'):
+            if key in value:
+                yield from _flatten(value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _flatten(item)
+
+
+def extract_block_text(block_type, content):
+    """
+    Return the human-readable text of a block, without JSON keys or markup,
+    so that searching for "text" or "formula" only matches real content.
+    """
+    if not isinstance(content, dict):
+        return ''
+    
+    if block_type in ('text', 'heading'):
+        parts = _flatten(content.get('text'))
+    elif block_type == 'code':
+        # Code is indexed verbatim; angle brackets are meaningful there
+        return content.get('code') or ''
+    elif block_type == 'latex':
+        return content.get('formula') or ''
+    elif block_type == 'table':
+        parts = [*_flatten(content.get('headers')), *_flatten(content.get('rows'))]
+    elif block_type == 'list':
+        parts = _flatten(content.get('items'))
+    elif block_type == 'image':
+        parts = [content.get('alt') or '', content.get('caption') or '']
+    else:
+        return ''
+    
+    return '\n'.join(strip_tags(part) for part in parts if part)
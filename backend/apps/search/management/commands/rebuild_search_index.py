@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from apps.notes.models import Note
+from apps.blocks.models import Block
+from apps.search.backends import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Index every note title and block for /api/notes/search/'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+    
+    def handle(self, *args, **options):
+        backend = get_backend()
+        batch_size = options['batch_size']
+        
+        for note in Note.objects.iterator(chunk_size=batch_size):
+            backend.index_note(note)
+        
+        batch = []
+        count = 0
+        for block in Block.objects.iterator(chunk_size=batch_size):
+            batch.append(block)
+            if len(batch) >= batch_size:
+                backend.index_blocks(batch)
+                count += len(batch)
+                batch = []
+        backend.index_blocks(batch)
+        count += len(batch)
+        
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} blocks'))
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-18 02:23
+
+from django.db import migrations
+
+# Must match PostgresSearchBackend.VECTOR exactly for the planner to use it
+CREATE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS search_document_text_gin "
+    "ON search_searchdocument USING GIN (to_tsvector('english', text))"
+)
+DROP_INDEX = "DROP INDEX IF EXISTS search_document_text_gin"
+
+
+def create_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_INDEX)
+
+
+def drop_gin_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0001_initial'),
+    ]
+    
+    operations = [
+        migrations.RunPython(create_gin_index, drop_gin_index),
+    ]
@@ -0,0 +1,63 @@
+from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from apps.notes.models import Note
+from apps.blocks.models import Block
+
+
+class SearchDocument(models.Model):
+    """
+    Searchable text of one block, or of a note title when block is null.
+    On PostgreSQL the text is covered by a GIN index on its tsvector; other
+    databases use the SearchTerm postings below.
+    """
+    note = models.ForeignKey(Note, on_delete=models.CASCADE, related_name='search_documents')
+    block = models.OneToOneField(
+        Block, 
+        on_delete=models.CASCADE, 
+        null=True, 
+        blank=True, 
+        related_name='search_document'
+    )
+    text = models.TextField(blank=True)
+    length = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['note'], 
+                condition=models.Q(block__isnull=True), 
+                name='search_unique_title_document'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"Search document for {self.block_id or self.note_id}"
+
+
+class SearchTerm(models.Model):
+    """Inverted index postings used by the pure-Python backend."""
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='terms')
+    term = models.CharField(max_length=64)
+    frequency = models.PositiveIntegerField(default=1)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'document']),
+        ]
+
+
+@receiver(post_save, sender=Block)
+def index_saved_block(sender, instance, update_fields=None, **kwargs):
+    if update_fields and 'content' not in update_fields and 'block_type' not in update_fields:
+        return
+    
+    from .backends import get_backend
+    get_backend().index_block(instance)
+
+
+@receiver(post_save, sender=Note)
+def index_saved_note(sender, instance, **kwargs):
+    from .backends import get_backend
+    get_backend().index_note(instance)
@@ -0,0 +1,222 @@
+"""
+Cached authentication.
+
+Resolving who sent a request normally costs a query for the token (or the
+session) and another for the user. Here tokens and users are looked up
+through two cache tiers: a small LRU in each process, whose entries live
+LOCAL_TIMEOUT seconds, then the shared cache. Sessions use the cached_db
+engine, so their rows are read from the shared cache as well.
+
+The user comes back as a User with only PRINCIPAL_FIELDS loaded; the other
+fields (password, last_login...) are deferred and read from the database
+on first access, and save() writes only the loaded fields.
+
+Entries are dropped when a token is deleted (logout, rotation) and when a
+user is saved or deleted (deactivation, password change). Another
+process's local tier may keep serving the old entry until it expires.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from asgiref.sync import sync_to_async
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+DEFAULTS = {
+    # Seconds an entry stays in the shared cache
+    'TIMEOUT': 300,
+    # Seconds an entry stays in a process's own LRU
+    'LOCAL_TIMEOUT': 5,
+    'LOCAL_SIZE': 1024,
+}
+
+AUTH_CACHE = {**DEFAULTS, **getattr(settings, 'AUTH_CACHE', {})}
+
+PRINCIPAL_FIELDS = {'id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser'}
+
+# In User's column order, as from_db() expects
+_LOADED = [field.attname for field in User._meta.concrete_fields if field.attname in PRINCIPAL_FIELDS]
+
+# Browsers cannot set headers on a WebSocket, and URLs end up in logs, so
+# the API token is offered as the subprotocols `token, <key>`
+TOKEN_SUBPROTOCOL = 'token'
+
+
+class _LocalCache:
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_local = _LocalCache(AUTH_CACHE['LOCAL_SIZE'])
+
+
+def _user_key(user_id):
+    return f'auth-user:{user_id}'
+
+
+def _token_key(key):
+    # Keep raw tokens out of the shared cache
+    return f'auth-token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def _cached(key, load):
+    value = _local.get(key)
+    if value is None:
+        value = cache.get(key)
+        if value is None:
+            value = load()
+            if value is None:
+                return None
+            cache.set(key, value, AUTH_CACHE['TIMEOUT'])
+        _local.set(key, value, AUTH_CACHE['LOCAL_TIMEOUT'])
+    return value
+
+
+def _load_user(user_id):
+    # Never from a replica: new users and password changes count at once
+    user = User.objects.using(DEFAULT_DB_ALIAS).filter(pk=user_id).first()
+    if user is None:
+        return None
+    return {
+        'values': [getattr(user, name) for name in _LOADED],
+        'session_hash': user.get_session_auth_hash(),
+    }
+
+
+def _principal(user_id):
+    """(user, session auth hash) for a user id, or None."""
+    entry = _cached(_user_key(user_id), lambda: _load_user(user_id))
+    if entry is None:
+        return None
+    return User.from_db(DEFAULT_DB_ALIAS, _LOADED, entry['values']), entry['session_hash']
+
+
+def invalidate_user(user_id):
+    key = _user_key(user_id)
+    _local.delete(key)
+    # Again after commit, or a request in between could cache the old row
+    cache.delete(key)
+    transaction.on_commit(lambda: (_local.delete(key), cache.delete(key)))
+
+
+def invalidate_token(token_key):
+    key = _token_key(token_key)
+    _local.delete(key)
+    cache.delete(key)
+
+
+def user_for_token(key):
+    """The active or inactive user owning a token, or None."""
+    user_id = _cached(_token_key(key), lambda: Token.objects.using(DEFAULT_DB_ALIAS).filter(key=key).values_list('user_id', flat=True).first())
+    if user_id is None:
+        return None
+    principal = _principal(user_id)
+    return principal[0] if principal is not None else None
+
+
+def user_for_session(session):
+    """The user logged in to a session, as django.contrib.auth.get_user() finds it."""
+    try:
+        user_id = User._meta.pk.to_python(session[SESSION_KEY])
+        backend = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+    
+    principal = _principal(user_id)
+    if principal is None or not principal[0].is_active:
+        return AnonymousUser()
+    user, session_hash = principal
+    if not constant_time_compare(session.get(HASH_SESSION_KEY, ''), session_hash):
+        # The password changed since this session logged in
+        session.flush()
+        return AnonymousUser()
+    return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        user = user_for_token(key)
+        if user is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (user, key)
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """AuthenticationMiddleware resolving request.user through the auth cache."""
+    
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: user_for_session(request.session))
+        request.auser = partial(sync_to_async(user_for_session), request.session)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    Channels AuthMiddleware resolving the session user through the auth
+    cache. A token offered with the `token` subprotocol authenticates the
+    connection instead, and is kept as scope['auth_token'].
+    """
+    
+    async def resolve_scope(self, scope):
+        token = scope_token(scope)
+        scope['auth_token'] = token
+        if token:
+            user = await database_sync_to_async(user_for_token)(token)
+            scope['user']._wrapped = user if user is not None and user.is_active else AnonymousUser()
+        else:
+            scope['user']._wrapped = await database_sync_to_async(user_for_session)(scope['session'])
+
+
+def scope_token(scope):
+    """The API token a WebSocket connection offers as a subprotocol, or None."""
+    subprotocols = scope.get('subprotocols') or []
+    if len(subprotocols) >= 2 and subprotocols[0] == TOKEN_SUBPROTOCOL:
+        return subprotocols[1]
+    return None
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -1,3 +1,67 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITransactionTestCase
+from . import authentication
+from .authentication import user_for_token
 
-# Create your tests here.
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AuthCacheTests(APITransactionTestCase):
+    """
+    Transaction tests, since entries are dropped again on commit. Refused
+    credentials get 403: SessionAuthentication comes first and sends no
+    WWW-Authenticate challenge.
+    """
+    
+    def setUp(self):
+        cache.clear()
+        authentication._local._entries.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.token = Token.objects.create(user=self.user)
+    
+    def get(self):
+        return self.client.get('/api/notes/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+    
+    def auth_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get().status_code, 200)
+        tables = (Token._meta.db_table, User._meta.db_table)
+        return [query['sql'] for query in queries if any(f'"{table}"' in query['sql'] for table in tables)]
+    
+    def test_token_and_user_read_once(self):
+        self.assertTrue(self.auth_queries())
+        self.assertEqual(self.auth_queries(), [])
+        # Past the local tier, the shared cache still answers
+        authentication._local._entries.clear()
+        self.assertEqual(self.auth_queries(), [])
+    
+    def test_only_principal_fields_loaded(self):
+        user = user_for_token(self.token.key)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertIn('password', user.get_deferred_fields())
+        self.assertTrue(user.check_password('secret'))
+    
+    def test_logout_drops_the_token(self):
+        self.assertEqual(self.get().status_code, 200)
+        response = self.client.post('/api/auth/logout/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.get().status_code, 403)
+    
+    def test_deactivation_drops_the_user(self):
+        self.assertEqual(self.get().status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get().status_code, 403)
+    
+    def test_password_change_ends_sessions(self):
+        self.assertTrue(self.client.login(username='alice', password='secret'))
+        self.assertEqual(self.client.get('/api/notes/').status_code, 200)
+        self.assertEqual(self.client.get('/api/notes/').status_code, 200)
+        
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEqual(self.client.get('/api/notes/').status_code, 403)
@@ -1,3 +1,16 @@
-from django.shortcuts import render
+from django.contrib.auth import logout as end_session
+from rest_framework import permissions, status
+from rest_framework.authtoken.models import Token
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
 
-# Create your views here.
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def logout(request):
+    """Delete the request's token, or end its session."""
+    if isinstance(request.auth, str):
+        Token.objects.filter(key=request.auth).delete()
+    else:
+        end_session(request._request)
+    return Response(status=status.HTTP_204_NO_CONTENT)
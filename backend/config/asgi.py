@@ -7,24 +7,55 @@ For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
+import atexit
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from channels.security.websocket import AllowedHostsOriginValidator
-import apps.notes.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
+# Set up Django before importing anything that touches models
 django_asgi_app = get_asgi_application()
 
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
+from channels.security.websocket import AllowedHostsOriginValidator
+import apps.notes.routing
+from apps.notes.sessions import close_all, close_all_sync
+from apps.users.authentication import CachedAuthMiddlewareStack
+from apps.blocks.workers import BlockMaintenanceConsumer, ImageVariantConsumer
+from config.pooling import drain_pools
+
+# Let pooled connections finish their work before the process exits
+atexit.register(drain_pools)
+# Registered later, so it runs first: edits still held by editing sessions
+# are saved while the pools are open, and their notes are released. Servers with a lifespan shutdown
+# (uvicorn, hypercorn) have flushed them already; daphne has not.
+atexit.register(close_all_sync)
+
+
+async def lifespan(scope, receive, send):
+    """Save the editing sessions' unsaved edits and release their notes when the server shuts down."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        CachedAuthMiddlewareStack(
             URLRouter([
                 *apps.notes.routing.websocket_urlpatterns,
             ])
         )
     ),
+    "lifespan": lifespan,
+    "channel": ChannelNameRouter({
+        "block-maintenance": BlockMaintenanceConsumer.as_asgi(),
+        "image-variants": ImageVariantConsumer.as_asgi(),
+    }),
 })
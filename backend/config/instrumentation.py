@@ -0,0 +1,177 @@
+"""
+Per-request instrumentation (INSTRUMENTATION['ENABLED']).
+
+For every HTTP request the middleware counts SQL queries and their time on
+all database aliases, the time spent rendering the response body
+(TimedJSONRenderer, set in DEFAULT_RENDERER_CLASSES) and the response size. Responses carry them in a Server-Timing header, which
+browser dev tools show next to the request:
+
+    Server-Timing: db;dur=12.4;desc="9 queries", serialize;dur=3.1, app;dur=25.0
+
+Totals per view (URL name) and method are kept in the process and served
+at /metrics, with a latency histogram. When disabled, the middleware
+removes itself at startup and the renderer times nothing.
+"""
+import contextvars
+import threading
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.renderers import JSONRenderer
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SERVER_TIMING': True,
+    # Upper bounds of the latency histogram buckets, in seconds
+    'BUCKETS': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+}
+
+INSTRUMENTATION_SETTINGS = {**DEFAULTS, **getattr(settings, 'INSTRUMENTATION', {})}
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+    
+    def __call__(self, execute, sql, params, many, context):
+        # Installed with connection.execute_wrapper()
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += time.perf_counter() - start
+            self.queries += 1
+
+
+class _Totals:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.count = 0
+        self.seconds = 0.0
+        self.histogram = [0] * len(buckets)
+        self.statuses = {}
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        self.bytes = 0
+    
+    def add(self, status_code, seconds, timings, size):
+        self.count += 1
+        self.seconds += seconds
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.histogram[index] += 1
+                break
+        self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+        self.queries += timings.queries
+        self.db += timings.db
+        self.serialize += timings.serialize
+        self.bytes += size
+
+
+_totals = {}
+_lock = threading.Lock()
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSONRenderer that adds its time to the current request's timings."""
+    
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        timings = _current.get()
+        if timings is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        start = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            timings.serialize += time.perf_counter() - start
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def server_timing(timings, seconds):
+    return (
+        f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries", '
+        f'serialize;dur={timings.serialize * 1000:.1f}, '
+        f'app;dur={seconds * 1000:.1f}'
+    )
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not INSTRUMENTATION_SETTINGS['ENABLED']:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        timings = Timings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        seconds = time.perf_counter() - start
+        
+        size = 0 if response.streaming else len(response.content)
+        if INSTRUMENTATION_SETTINGS['SERVER_TIMING']:
+            response['Server-Timing'] = server_timing(timings, seconds)
+        
+        key = (_view_name(request), request.method)
+        with _lock:
+            totals = _totals.get(key)
+            if totals is None:
+                totals = _totals[key] = _Totals(INSTRUMENTATION_SETTINGS['BUCKETS'])
+            totals.add(response.status_code, seconds, timings, size)
+        return response
+
+
+def request_metrics():
+    """Prometheus metrics for the requests seen so far, in the form config.metrics expects."""
+    with _lock:
+        snapshot = [
+            (view, method, totals.count, totals.seconds, list(totals.histogram), dict(totals.statuses),
+             totals.queries, totals.db, totals.serialize, totals.bytes)
+            for (view, method), totals in sorted(_totals.items())
+        ]
+    if not snapshot:
+        return []
+    
+    buckets = INSTRUMENTATION_SETTINGS['BUCKETS']
+    requests, duration, queries, db, serialize, sizes = [], [], [], [], [], []
+    for view, method, count, seconds, histogram, statuses, query_count, db_seconds, serialize_seconds, size in snapshot:
+        labels = {'view': view, 'method': method}
+        for status_code, status_count in sorted(statuses.items()):
+            requests.append(({**labels, 'status': status_code}, status_count))
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, histogram):
+            cumulative += bucket_count
+            duration.append(('_bucket', {**labels, 'le': bound}, cumulative))
+        duration.append(('_bucket', {**labels, 'le': '+Inf'}, count))
+        duration.append(('_sum', labels, seconds))
+        duration.append(('_count', labels, count))
+        queries.append((labels, query_count))
+        db.append((labels, db_seconds))
+        serialize.append((labels, serialize_seconds))
+        sizes.append((labels, size))
+    
+    return [
+        ('http_requests_total', 'counter', 'Requests handled', requests),
+        ('http_request_duration_seconds', 'histogram', 'Time spent handling requests', duration),
+        ('http_request_db_queries_total', 'counter', 'SQL queries run for requests', queries),
+        ('http_request_db_seconds_total', 'counter', 'Time spent in SQL queries', db),
+        ('http_request_serialize_seconds_total', 'counter', 'Time spent rendering response bodies', serialize),
+        ('http_response_bytes_total', 'counter', 'Response body bytes, streamed responses excluded', sizes),
+    ]
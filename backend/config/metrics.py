@@ -0,0 +1,62 @@
+"""
+Prometheus metrics at /metrics.
+
+Each process reports its own numbers, so every server and worker process
+is scraped on its own. Once METRICS['TOKEN'] is set, every request must
+send Authorization: Bearer <TOKEN>, local ones included: behind a proxy
+on the same machine every client looks local. Without a token the
+endpoint answers only requests from the machine itself.
+"""
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotFound
+from django.utils.crypto import constant_time_compare
+from .instrumentation import request_metrics
+from .pooling import pool_metrics
+
+DEFAULTS = {
+    'TOKEN': '',
+}
+
+METRICS_SETTINGS = {**DEFAULTS, **getattr(settings, 'METRICS', {})}
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+# Functions returning [(name, type, help, samples)]; a sample is (labels,
+# value), or (suffix, labels, value) for the _bucket, _sum and _count
+# samples of a histogram
+COLLECTORS = [pool_metrics, request_metrics]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def render():
+    lines = []
+    for collect in COLLECTORS:
+        for name, kind, help_text, samples in collect():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample in samples:
+                suffix, labels, value = sample if len(sample) == 3 else ('', *sample)
+                lines.append(f'{name}{suffix}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def _allowed(request):
+    if not METRICS_SETTINGS['TOKEN']:
+        return request.META.get('REMOTE_ADDR') in LOCAL_ADDRESSES
+    keyword, _, token = request.headers.get('Authorization', '').partition(' ')
+    return keyword == 'Bearer' and constant_time_compare(token, METRICS_SETTINGS['TOKEN'])
+
+
+def metrics(request):
+    if not _allowed(request):
+        return HttpResponseNotFound()
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,68 @@
+"""
+PostgreSQL connection pools (DB_POOL=1 in the environment).
+
+Django keeps one psycopg pool per database alias and process. A sync view
+or database_sync_to_async call checks a connection out on its first query
+and returns it when Django closes the connection at the end of the request
+or call, so a connection is held only while sync code runs. Connections
+are checked before they are handed out and replaced after MAX_LIFETIME.
+
+pool_metrics() reports each pool for /metrics; checkouts that find no free
+connection wait up to TIMEOUT seconds and show up as waiting and as wait
+time. drain_pools() runs when an ASGI server or worker process exits.
+"""
+import logging
+import time
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'DRAIN_TIMEOUT': 10,
+}
+
+POOL_SETTINGS = {**DEFAULTS, **getattr(settings, 'DATABASE_POOL', {})}
+
+
+def _pools():
+    for alias in connections:
+        if connections.settings[alias].get('OPTIONS', {}).get('pool'):
+            yield alias, connections[alias].pool
+
+
+def pool_metrics():
+    """Prometheus metrics for every pool: (name, type, help, [(labels, value)])."""
+    rows = {}
+    for alias, pool in _pools():
+        stats = pool.get_stats()
+        labels = {'alias': alias}
+        in_use = stats['pool_size'] - stats['pool_available']
+        for name, kind, help_text, value in (
+            ('db_pool_connections', 'gauge', 'Connections open in the pool', stats['pool_size']),
+            ('db_pool_connections_in_use', 'gauge', 'Connections checked out', in_use),
+            ('db_pool_max_connections', 'gauge', 'Largest size the pool may grow to', stats['pool_max']),
+            ('db_pool_saturation', 'gauge', 'Share of the largest size checked out', in_use / stats['pool_max']),
+            ('db_pool_waiting', 'gauge', 'Checkouts waiting for a free connection', stats['requests_waiting']),
+            ('db_pool_checkouts_total', 'counter', 'Connections checked out', stats.get('requests_num', 0)),
+            ('db_pool_checkouts_queued_total', 'counter', 'Checkouts that had to wait', stats.get('requests_queued', 0)),
+            ('db_pool_checkout_wait_seconds_total', 'counter', 'Time spent waiting for a connection', stats.get('requests_wait_ms', 0) / 1000),
+            ('db_pool_checkout_timeouts_total', 'counter', 'Checkouts that gave up waiting', stats.get('requests_errors', 0)),
+            ('db_pool_connections_lost_total', 'counter', 'Connections found broken', stats.get('connections_lost', 0) + stats.get('returns_bad', 0)),
+        ):
+            rows.setdefault(name, (name, kind, help_text, []))[3].append((labels, value))
+    return list(rows.values())
+
+
+def drain_pools(timeout=None):
+    """Wait up to `timeout` seconds for checked-out connections to come back, then close the pools."""
+    deadline = time.monotonic() + (POOL_SETTINGS['DRAIN_TIMEOUT'] if timeout is None else timeout)
+    for alias, pool in _pools():
+        while time.monotonic() < deadline:
+            stats = pool.get_stats()
+            if stats['pool_available'] >= stats['pool_size']:
+                break
+            time.sleep(0.05)
+        else:
+            logger.warning("Closing the %s pool with connections still checked out", alias)
+        connections[alias].close_pool()
@@ -0,0 +1,111 @@
+"""
+Read replicas.
+
+Every database alias other than `default` is a read replica of it. Only
+reads made while handling a GET, HEAD or OPTIONS request go to a replica
+(picked at random); writes, reads inside a transaction, reads in requests
+that write, and everything outside requests (WebSocket consumers, workers,
+commands) use the primary.
+
+Replicas lag behind, so a client that has just written keeps reading from
+the primary for STICKY_SECONDS. It is recognised by its API token, or else
+its session; WebSocket connections mark their credential the same way when
+they write. Views whose answer must agree with the operation log or the
+change log call use_primary().
+"""
+import contextvars
+import hashlib
+import random
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+DEFAULTS = {
+    'STICKY_SECONDS': 10,
+}
+
+REPLICA_SETTINGS = {**DEFAULTS, **getattr(settings, 'DATABASE_REPLICAS', {})}
+
+REPLICAS = [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Whether reads in this context may go to a replica
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+
+def use_primary():
+    """Read from the primary for the rest of the current request."""
+    _replica_reads.set(False)
+
+
+def reading_from_replica():
+    return bool(REPLICAS) and _replica_reads.get()
+
+
+def _sticky_key(credential):
+    return f'db-sticky:{hashlib.sha256(credential.encode()).hexdigest()}'
+
+
+def request_credential(request):
+    """The token or session key a request authenticates with, or None."""
+    keyword, _, token = request.headers.get('Authorization', '').partition(' ')
+    if keyword == 'Token' and token:
+        return token
+    return request.session.session_key
+
+
+def scope_credential(scope):
+    """The token or session key a WebSocket connection authenticated with, or None."""
+    # Set by apps.users.authentication.CachedAuthMiddleware
+    if scope.get('auth_token'):
+        return scope['auth_token']
+    session = scope.get('session')
+    return session.session_key if session is not None else None
+
+
+def mark_written(credential):
+    """Keep the client's reads on the primary until its writes have replicated."""
+    if REPLICAS and credential:
+        cache.set(_sticky_key(credential), True, REPLICA_SETTINGS['STICKY_SECONDS'])
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(REPLICAS)
+    
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+    
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+class ReplicaMiddleware:
+    """Lets safe requests read from a replica unless their client wrote recently."""
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        if not REPLICAS:
+            return self.get_response(request)
+        
+        safe = request.method in SAFE_METHODS
+        if safe:
+            credential = request_credential(request)
+            token = _replica_reads.set(not (credential and cache.get(_sticky_key(credential))))
+        else:
+            token = _replica_reads.set(False)
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+        
+        if not safe:
+            # After the view: logging in gives the session a new key
+            mark_written(request_credential(request))
+        return response
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -49,15 +50,18 @@ INSTALLED_APPS = [
     'apps.notes',
     'apps.blocks',
     'apps.users',
+    'apps.search',
 ]
 
 MIDDLEWARE = [
+    'config.instrumentation.InstrumentationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'config.replicas.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apps.users.authentication.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -96,6 +100,85 @@ DATABASES = {
     }
 }
 
+# Read replicas of the primary, e.g. DB_REPLICA_HOSTS=replica-1,replica-2;
+# see config/replicas.py
+for index, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+    DATABASES[f'replica{index}'] = {
+        **DATABASES['default'],
+        'HOST': host.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# DB_LOCAL_REPLICA=1: two SQLite files stand in for the primary and one
+# replica, to try out routing locally. Nothing replicates; copy db.sqlite3
+# over db-replica.sqlite3 to bring the replica up to date.
+if os.environ.get('DB_LOCAL_REPLICA'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        },
+        'replica1': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db-replica.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+
+# DB_POOL=1: keep PostgreSQL connections in a pool per process instead of
+# connecting for every request and every database_sync_to_async call.
+# Needs psycopg 3 (pip install "psycopg[binary,pool]"). A connection is held
+# by one sync thread at a time, so the pool is sized to the sync thread pool
+# (ASGI_THREADS); see config/pooling.py
+DATABASE_POOL = {
+    'MIN_SIZE': 2,
+    'MAX_SIZE': int(os.environ.get('ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4))),
+    # Seconds a checkout waits for a free connection before failing
+    'TIMEOUT': 10,
+    # Seconds before a connection is replaced, and before an idle one is closed
+    'MAX_LIFETIME': 1800,
+    'MAX_IDLE': 300,
+    # Seconds to wait for checked-out connections at shutdown
+    'DRAIN_TIMEOUT': 10,
+}
+
+if os.environ.get('DB_POOL'):
+    for database in DATABASES.values():
+        if database['ENGINE'] == 'django.db.backends.postgresql':
+            # Pooled connections are tested before they are handed out
+            database['CONN_HEALTH_CHECKS'] = True
+            database['OPTIONS'] = {
+                **database.get('OPTIONS', {}),
+                'pool': {
+                    'min_size': DATABASE_POOL['MIN_SIZE'],
+                    'max_size': DATABASE_POOL['MAX_SIZE'],
+                    'timeout': DATABASE_POOL['TIMEOUT'],
+                    'max_lifetime': DATABASE_POOL['MAX_LIFETIME'],
+                    'max_idle': DATABASE_POOL['MAX_IDLE'],
+                },
+            }
+
+DATABASE_ROUTERS = ['config.replicas.ReplicaRouter']
+
+# Query counts, timings and a Server-Timing header per request, totalled at
+# /metrics (config/instrumentation.py); INSTRUMENTATION=1 to turn on
+INSTRUMENTATION = {
+    'ENABLED': bool(os.environ.get('INSTRUMENTATION')),
+    'SERVER_TIMING': True,
+}
+
+# Prometheus metrics at /metrics (config/metrics.py). With a TOKEN every
+# scrape needs Authorization: Bearer <TOKEN>; without one only this host
+# may read them
+METRICS = {
+    'TOKEN': os.environ.get('METRICS_TOKEN', ''),
+}
+
+# Reads of a client that wrote stay on the primary this long
+DATABASE_REPLICAS = {
+    'STICKY_SECONDS': 10,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -145,12 +228,12 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'apps.users.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'config.instrumentation.TimedJSONRenderer',
     ],
 }
 
@@ -162,6 +245,9 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
+# Chunked uploads send where each chunk starts
+CORS_ALLOW_HEADERS = [*default_headers, 'upload-offset']
+
 # Channels Configuration
 ASGI_APPLICATION = 'config.asgi.application'
 
@@ -174,10 +260,96 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cache Configuration
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    },
+}
+
+# Sessions are read from the cache, falling back to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Token and user lookups made while authenticating (apps.users.authentication)
+AUTH_CACHE = {
+    'TIMEOUT': 300,
+    'LOCAL_TIMEOUT': 5,
+    'LOCAL_SIZE': 1024,
+}
+
+# Seconds a (user, note) access lookup stays cached
+NOTE_ACCESS_CACHE_TIMEOUT = 300
+
+# Every Nth block version is stored in full; the ones between are deltas
+BLOCK_VERSION_KEYFRAME_INTERVAL = 20
+
+# Per-note editing sessions (apps.notes.sessions); times are in seconds
+NOTE_SESSION = {
+    'FLUSH_INTERVAL': 2.0,
+    'IDLE_DELAY': 0.5,
+    'MAX_BATCH': 200,
+    'BURST_GAP': 30.0,
+    'PATCH_HISTORY': 200,
+    'GRACE_PERIOD': 10.0,
+    'PRESENCE_TICK': 0.05,
+    # A note is edited through one process at a time, which holds it this long
+    # between renewals; route /ws/notes/<id>/ by note id
+    'LEASE': 30.0,
+    # Below CHANNEL_LAYERS group_expiry
+    'GROUP_REFRESH': 3600.0,
+}
+
+# Recent operations per note, replayed to clients that reconnect
+NOTE_OPLOG = {
+    'BACKEND': 'redis',
+    'URL': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/1'),
+    'MAX_LENGTH': 1000,
+    'TTL': 24 * 60 * 60,
+}
+
 # Media Files Configuration
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Chunked image uploads (apps.blocks.uploads); sizes in bytes
+IMAGE_UPLOADS = {
+    'MAX_SIZE': 10 * 1024 * 1024,
+    'CHUNK_SIZE': 1024 * 1024,
+    'STAGING_DIR': os.path.join(MEDIA_ROOT, 'uploads'),
+    'EXPIRY': 24 * 60 * 60,
+}
+
+# WebP copies made by the image-variants worker (apps.blocks.images)
+IMAGE_VARIANTS = {
+    'WIDTHS': [320, 640, 1280, 1920],
+    'QUALITY': 80,
+    'PLACEHOLDER_WIDTH': 16,
+}
+
+# Change feed at /api/sync/changes/ (apps.notes.changes); prune with
+# manage.py prune_changes
+SYNC_CHANGES = {
+    'PAGE_SIZE': 500,
+    'SETTLE': 1.0,
+    'RETENTION_DAYS': 90,
+}
+
+# Operations for collaborators, written with each change (apps.notes.outbox);
+# run manage.py relay_outbox to send whatever was not sent on commit
+OUTBOX = {
+    'BATCH': 500,
+    'POLL': 1.0,
+    'RETENTION_HOURS': 24,
+}
+
+# Deleted notes and blocks (apps.notes.trash); purge with manage.py purge_trash
+TRASH = {
+    'RETENTION_DAYS': 30,
+    'PURGE_BATCH': 1000,
+    'PURGE_PAUSE': 0.05,
+}
+
 # Static Files Configuration
 STATIC_ROOT = BASE_DIR / 'static'
 
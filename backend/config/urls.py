@@ -19,12 +19,16 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.authtoken.views import obtain_auth_token
+from apps.users.views import logout
+from config.metrics import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('apps.notes.urls')),
     path('', include('apps.blocks.urls')),
     path('api/auth/token/', obtain_auth_token, name='api_token_auth'),
+    path('api/auth/logout/', logout, name='api_logout'),
+    path('metrics', metrics, name='metrics'),
 ]
 
 # Media files serving in development
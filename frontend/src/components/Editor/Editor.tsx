@@ -39,6 +39,7 @@ export const Editor: React.FC<EditorProps> = ({ note, blocks, onBlocksChange })
     WebSocketService.on('block_created', handleRemoteBlockCreate);
     WebSocketService.on('block_deleted', handleRemoteBlockDelete);
     WebSocketService.on('blocks_reordered', handleRemoteBlockReorder);
+    WebSocketService.on('blocks_rebalanced', handleRemoteRebalance);
     WebSocketService.on('user_joined', handleUserJoined);
     WebSocketService.on('user_left', handleUserLeft);
 
@@ -47,6 +48,7 @@ export const Editor: React.FC<EditorProps> = ({ note, blocks, onBlocksChange })
       WebSocketService.off('block_created');
       WebSocketService.off('block_deleted');
       WebSocketService.off('blocks_reordered');
+      WebSocketService.off('blocks_rebalanced');
       WebSocketService.off('user_joined');
       WebSocketService.off('user_left');
       WebSocketService.disconnect();
@@ -91,6 +93,17 @@ export const Editor: React.FC<EditorProps> = ({ note, blocks, onBlocksChange })
     });
   }, [onBlocksChange]);
 
+  const handleRemoteRebalance = useCallback((data: any) => {
+    // Same order, new keys; later window requests must use these
+    setLocalBlocks(prev => {
+      const updated = prev.map(block =>
+        block.id in data.positions ? { ...block, position: data.positions[block.id] } : block
+      );
+      onBlocksChange(updated);
+      return updated;
+    });
+  }, [onBlocksChange]);
+
   const handleUserJoined = useCallback((data: any) => {
     setCollaborativeUsers(prev => [...prev, data]);
   }, []);
@@ -41,6 +41,10 @@ export const ImageBlock: React.FC<ImageBlockProps> = ({
       
       const newContent = {
         url: result.url,
+        // Present when the same image was uploaded before; otherwise the
+        // server adds them once the resized copies are ready
+        variants: result.variants,
+        placeholder: result.placeholder,
         alt: file.name,
         width: block.content?.width,
         height: block.content?.height,
@@ -70,10 +74,7 @@ export const ImageBlock: React.FC<ImageBlockProps> = ({
 
   const handleCaptionChange = (caption: string) => {
     onUpdate({
-      url: block.content?.url,
-      alt: block.content?.alt,
-      width: block.content?.width,
-      height: block.content?.height,
+      ...block.content,
       caption,
     });
   };
@@ -128,12 +129,17 @@ export const ImageBlock: React.FC<ImageBlockProps> = ({
       <div className="image-container">
         <img
           src={block.content?.url}
+          srcSet={block.content?.variants?.map((variant: any) => `${variant.url} ${variant.width}w`).join(', ')}
+          sizes={block.content?.width ? `${block.content?.width}px` : '100vw'}
+          loading="lazy"
           alt={block.content?.alt}
           className="block-image"
           style={{
             width: block.content?.width ? `${block.content?.width}px` : 'auto',
             height: block.content?.height ? `${block.content?.height}px` : 'auto',
             maxWidth: '100%',
+            // Blurred preview until the image has loaded
+            background: block.content?.placeholder ? `center / cover no-repeat url(${block.content?.placeholder})` : undefined,
           }}
         />
         
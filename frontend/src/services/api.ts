@@ -9,6 +9,11 @@ import {
   CreateBlockRequest,
   UpdateBlockRequest,
   ReorderBlocksRequest,
+  BlockBatchOperation,
+  BlockBatchResult,
+  ImageVariant,
+  NoteDuplication,
+  ChangeFeed,
   SearchRequest,
   AddCollaboratorRequest,
   RemoveCollaboratorRequest,
@@ -56,8 +61,12 @@ class ApiServiceClass {
     return response.data;
   }
 
-  logout(): void {
-    localStorage.removeItem('authToken');
+  async logout(): Promise<void> {
+    try {
+      await this.api.post('/api/auth/logout/');
+    } finally {
+      localStorage.removeItem('authToken');
+    }
   }
 
   // Notes API
@@ -71,6 +80,12 @@ class ApiServiceClass {
     return response.data;
   }
 
+  // Note, full blocks, collaborators and realtime seq in one request
+  async getNoteBootstrap(id: string): Promise<{ note: Note; blocks: Block[]; collaborators: User[]; seq: number }> {
+    const response = await this.api.get(`/api/notes/${id}/bootstrap/`);
+    return response.data;
+  }
+
   async createNote(data: CreateNoteRequest): Promise<Note> {
     const response: AxiosResponse<Note> = await this.api.post('/api/notes/', data);
     return response.data;
@@ -85,8 +100,48 @@ class ApiServiceClass {
     await this.api.delete(`/api/notes/${id}/`);
   }
 
-  async duplicateNote(id: string): Promise<Note> {
-    const response: AxiosResponse<Note> = await this.api.post(`/api/notes/${id}/duplicate/`);
+  async getTrash(): Promise<Note[]> {
+    const response: AxiosResponse<ApiResponse<Note>> = await this.api.get('/api/notes/trash/');
+    return response.data.results || [];
+  }
+
+  async restoreNote(id: string): Promise<Note> {
+    const response: AxiosResponse<Note> = await this.api.post(`/api/notes/${id}/restore/`);
+    return response.data;
+  }
+
+  async duplicateNote(
+    id: string,
+    options: { shareHistory?: boolean; onProgress?: (copied: number, total: number) => void } = {}
+  ): Promise<Note> {
+    const response = await this.api.post(`/api/notes/${id}/duplicate/`, {
+      share_history: options.shareHistory ?? false,
+    });
+    if (response.status !== 202) {
+      return response.data;
+    }
+
+    // Large notes are copied in the background; poll the job until it ends
+    let job: NoteDuplication = response.data;
+    while (job.status === 'queued' || job.status === 'running') {
+      options.onProgress?.(job.copied, job.total);
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      job = (await this.api.get(`/api/notes/duplications/${job.id}/`)).data;
+    }
+    if (job.status !== 'done' || !job.note_id) {
+      throw new Error('Note duplication failed');
+    }
+    options.onProgress?.(job.copied, job.total);
+    return this.getNote(job.note_id);
+  }
+
+  // Without a cursor, returns only the cursor for "now"; take it before
+  // loading data, then pass each returned cursor back while has_more is set,
+  // or after retry_after seconds when that is set
+  async getChanges(since?: string): Promise<ChangeFeed> {
+    const response: AxiosResponse<ChangeFeed> = await this.api.get('/api/sync/changes/', {
+      params: since ? { since } : {},
+    });
     return response.data;
   }
 
@@ -144,18 +199,34 @@ class ApiServiceClass {
     await this.api.delete(`/api/blocks/${id}/`);
   }
 
+  async restoreBlock(id: string): Promise<Block> {
+    const response: AxiosResponse<Block> = await this.api.post(`/api/blocks/${id}/restore/`);
+    return response.data;
+  }
+
   async reorderBlocks(data: ReorderBlocksRequest): Promise<void> {
     await this.api.post('/api/blocks/reorder/', data);
   }
 
+  // All operations apply together, or none do
+  async batchBlocks(noteId: string, operations: BlockBatchOperation[]): Promise<BlockBatchResult> {
+    const response: AxiosResponse<BlockBatchResult> = await this.api.post('/api/blocks/batch/', {
+      note_id: noteId,
+      operations,
+    });
+    return response.data;
+  }
+
   async duplicateBlock(id: string): Promise<Block> {
     const response: AxiosResponse<Block> = await this.api.post(`/api/blocks/${id}/duplicate/`);
     return response.data;
   }
 
-  async getBlockVersions(blockId: string): Promise<any[]> {
-    const response: AxiosResponse<any[]> = await this.api.get(`/api/blocks/${blockId}/versions/`);
-    return response.data;
+  async getBlockVersions(blockId: string, page: number = 1): Promise<any[]> {
+    const response: AxiosResponse<ApiResponse<any>> = await this.api.get(`/api/blocks/${blockId}/versions/`, {
+      params: { page },
+    });
+    return response.data.results || [];
   }
 
   async restoreBlockVersion(blockId: string, versionId: string): Promise<Block> {
@@ -166,16 +237,37 @@ class ApiServiceClass {
   }
 
   // File upload
-  async uploadImage(file: File): Promise<{ url: string }> {
-    const formData = new FormData();
-    formData.append('image', file);
-
-    const response: AxiosResponse<{ url: string }> = await this.api.post('/api/upload/image/', formData, {
-      headers: {
-        'Content-Type': 'multipart/form-data',
-      },
-    });
+  // Chunked and resumable: after a failed chunk the upload continues from
+  // the offset the server reports instead of starting over
+  async uploadImage(file: File): Promise<{ url: string; deduplicated?: boolean; variants?: ImageVariant[]; placeholder?: string }> {
+    const upload = (await this.api.post('/api/uploads/images/', {
+      filename: file.name,
+      content_type: file.type,
+      size: file.size,
+    })).data;
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+      try {
+        const chunk = file.slice(offset, offset + upload.chunk_size);
+        const response = await this.api.patch(`/api/uploads/images/${upload.id}/`, chunk, {
+          headers: {
+            'Content-Type': 'application/octet-stream',
+            'Upload-Offset': String(offset),
+          },
+        });
+        offset = response.data.offset;
+        retries = 0;
+      } catch (error) {
+        if (++retries > 3) {
+          throw error;
+        }
+        offset = (await this.api.get(`/api/uploads/images/${upload.id}/`)).data.offset;
+      }
+    }
 
+    const response = await this.api.post(`/api/uploads/images/${upload.id}/complete/`);
     return response.data;
   }
 }
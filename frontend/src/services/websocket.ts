@@ -3,11 +3,18 @@ import { WebSocketMessage, Block, CursorPosition, UserSelection } from '../types
 
 type WebSocketEventHandler = (data: any) => void;
 
+// Close code for a note that is being edited through another server process
+const SESSION_ELSEWHERE_CODE = 4409;
+const RECONNECT_DELAY = 1000;
+const MAX_ELSEWHERE_DELAY = 30000;
+
 class WebSocketServiceClass {
   private socket: Socket | null = null;
   private noteId: string | null = null;
   private isConnected: boolean = false;
   private eventHandlers: Map<string, WebSocketEventHandler[]> = new Map();
+  // Consecutive 4409 closes, for backing off
+  private elsewhereCount: number = 0;
 
   connect(noteId: string): void {
     if (this.socket && this.noteId === noteId) {
@@ -16,12 +23,15 @@ class WebSocketServiceClass {
 
     this.disconnect();
     this.noteId = noteId;
+    this.elsewhereCount = 0;
 
     const token = localStorage.getItem('authToken');
     const wsUrl = process.env.REACT_APP_WS_URL || 'ws://localhost:8000';
 
     this.socket = io(`${wsUrl}/ws/notes/${noteId}/`, {
       transports: ['websocket'],
+      // Offered as the subprotocols `token, <key>`; a token in the URL would be logged
+      protocols: token ? ['token', token] : undefined,
       auth: {
         token,
       },
@@ -33,12 +43,27 @@ class WebSocketServiceClass {
       this.emit('connection_established');
     });
 
-    this.socket.on('disconnect', () => {
+    this.socket.on('disconnect', (reason, details: any) => {
       this.isConnected = false;
       console.log(`Disconnected from note ${noteId}`);
+      if (details?.context?.code === SESSION_ELSEWHERE_CODE && this.socket) {
+        // Reached a process that does not hold the note; the proxy should
+        // route by note id (see README). Retry later, backing off each time.
+        this.elsewhereCount += 1;
+        this.socket.io.reconnectionDelay(Math.min(RECONNECT_DELAY * 2 ** this.elsewhereCount, MAX_ELSEWHERE_DELAY));
+        this.emit('session_elsewhere', { attempt: this.elsewhereCount });
+      }
       this.emit('disconnected');
     });
 
+    // Sent once the server has opened the note's session
+    this.socket.on('connection_established', () => {
+      if (this.elsewhereCount && this.socket) {
+        this.elsewhereCount = 0;
+        this.socket.io.reconnectionDelay(RECONNECT_DELAY);
+      }
+    });
+
     this.socket.on('error', (error) => {
       console.error('WebSocket error:', error);
       this.emit('error', error);
@@ -69,6 +94,32 @@ class WebSocketServiceClass {
       this.emit('blocks_reordered', data);
     });
 
+    // Every key of the note was rewritten; positions maps block id to its new key
+    this.socket.on('blocks_rebalanced', (data) => {
+      this.emit('blocks_rebalanced', data);
+    });
+
+    this.socket.on('blocks_batch', (data) => {
+      this.emit('blocks_batch', data);
+    });
+
+    this.socket.on('block_moved', (data) => {
+      this.emit('block_moved', data);
+    });
+
+    // Changes made through the REST API arrive here too
+    this.socket.on('note_updated', (data) => {
+      this.emit('note_updated', data);
+    });
+
+    this.socket.on('note_deleted', (data) => {
+      this.emit('note_deleted', data);
+    });
+
+    this.socket.on('note_restored', (data) => {
+      this.emit('note_restored', data);
+    });
+
     this.socket.on('cursor_moved', (data) => {
       this.emit('cursor_moved', data);
     });
@@ -76,6 +127,19 @@ class WebSocketServiceClass {
     this.socket.on('user_selection_changed', (data) => {
       this.emit('user_selection_changed', data);
     });
+
+    // Cursors and selections arrive batched, one frame per server tick
+    this.socket.on('presence_update', (data) => {
+      this.emit('presence_update', data);
+      data.users.forEach((user: any) => {
+        if (user.cursor) {
+          this.emit('cursor_moved', { ...user.cursor, user_id: user.user_id, username: user.username });
+        }
+        if (user.selection) {
+          this.emit('user_selection_changed', { ...user.selection, user_id: user.user_id, username: user.username });
+        }
+      });
+    });
   }
 
   disconnect(): void {
@@ -19,6 +19,7 @@ export interface Note {
   collaborators_count: number;
   blocks_count: number;
   blocks?: Block[];
+  deleted_at?: string | null;
 }
 
 export interface Block {
@@ -27,6 +28,8 @@ export interface Block {
   block_type: BlockType;
   content: BlockContent;
   order: number;
+  // Fractional order key; rewritten when the note is rebalanced
+  position?: string;
   created_at: string;
   updated_at: string;
   content_preview?: string;
@@ -151,6 +154,53 @@ export interface ReorderBlocksRequest {
   block_ids: string[];
 }
 
+export interface BlockBatchOperation {
+  op: 'create' | 'update' | 'delete' | 'move';
+  id?: string;
+  block_type?: BlockType;
+  content?: BlockContent;
+  after_id?: string | null;
+  before_id?: string | null;
+}
+
+export interface ImageVariant {
+  width: number;
+  height: number;
+  url: string;
+}
+
+export interface BlockBatchResult {
+  created: Block[];
+  updated: Block[];
+  deleted: string[];
+  seq: number;
+}
+
+export interface NoteDuplication {
+  id: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  source_id: string;
+  note_id: string | null;
+  copied: number;
+  total: number;
+  url: string;
+}
+
+export interface ChangeFeed {
+  notes: Note[];
+  blocks: Block[];
+  memberships: { note_id: string; user: User; role: 'owner' | 'collaborator' }[];
+  deleted: {
+    notes: string[];
+    blocks: string[];
+    memberships: { note_id: string; user_id: number }[];
+  };
+  cursor: string;
+  has_more: boolean;
+  // Seconds until changes that are still settling can be fetched
+  retry_after: number | null;
+}
+
 export interface SearchRequest {
   q: string;
 }